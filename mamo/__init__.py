@@ -1,6 +1,8 @@
 from mamo.internal import main
 
 from mamo.internal.main import init_mamo
+from mamo.internal.persistence_policy import persist_if_worth_it
+from mamo.internal.store_server import start_store_server
 
 # TODO: what about exceptions?
 # TODO: what about wrapping methods in class definitions?
@@ -55,6 +57,76 @@ def flush_online_cache():
     main.mamo.flush_cache()
 
 
+def flush_metadata():
+    _require_mamo()
+    main.mamo.flush_metadata()
+
+
+def flush_writes():
+    _require_mamo()
+    main.mamo.flush_writes()
+
+
+def set_compression(compression, func=None):
+    """
+    Sets the compression for externally cached results (of `func` or of all functions).
+
+    `compression` is None, a codec id (e.g. "zlib", "lzma", "bz2" or "zstd") or "adaptive".
+    """
+    _ensure_mamo_init()
+    main.mamo.set_compression(compression, func)
+
+
+def set_disk_budget(disk_budget, eviction_policy="cost_benefit"):
+    """
+    Evicts persisted results to keep their total stored size within `disk_budget` bytes (None for no budget).
+
+    `eviction_policy` is "cost_benefit" (saved compute time per byte), "lru" or "lfu". Tagged results are kept.
+    """
+    _ensure_mamo_init()
+    main.mamo.set_disk_budget(disk_budget, eviction_policy)
+
+
+def set_memory_budget(memory_budget, eviction_policy="lru"):
+    """
+    Only keeps results with a total estimated size of `memory_budget` bytes alive (None for no budget).
+
+    Evicted results are reloaded from the persisted store when needed. `eviction_policy` is "lru" or "cost_benefit".
+    """
+    _ensure_mamo_init()
+    main.mamo.set_memory_budget(memory_budget, eviction_policy)
+
+
+def set_persistence_policy(persistence_policy):
+    """
+    Decides which results are worth persisting, e.g. `persist_if_worth_it()`, which keeps results that are faster to
+    recompute than to load in memory only. None persists all results.
+
+    The decision and its reason are recorded in the metadata (see `get_metadata`).
+    """
+    _ensure_mamo_init()
+    main.mamo.set_persistence_policy(persistence_policy)
+
+
+def set_lease_duration(lease_duration):
+    """
+    Makes processes that share the externally cached path execute each call only once: one process executes it,
+    and the others wait for its result. They stop waiting after `lease_duration` seconds. None disables leases.
+    """
+    _ensure_mamo_init()
+    main.mamo.set_lease_duration(lease_duration)
+
+
+def gc(background=False, pack=True):
+    """
+    Deletes unlinked and orphaned cache files and packs the store.
+
+    Returns a `GarbageCollectionReport` (or a future of it if `background`).
+    """
+    _require_mamo()
+    return main.mamo.gc(background, pack)
+
+
 def flush_value(value):
     _require_mamo()
     main.mamo.flush_value(value)
@@ -1,6 +1,16 @@
 # noinspection PyUnresolvedReferences
-from mamo.internal.cached_values import CachedValue, ExternallyCachedFilePath, ExternallyCachedValue
+from mamo.internal.cached_values import (
+    CachedValue,
+    ExternallyCachedFilePath,
+    ExternallyCachedValue,
+    choose_codec,
+    open_external_file,
+    COMPRESSION_SAMPLE_SIZE,
+)
 from mamo.internal.db_stored_value import DBPickledValue
 
+# noinspection PyUnresolvedReferences
+from mamo.internal.digests import compute_digest, get_digest_algorithm
+
 # noinspection PyUnresolvedReferences
 from mamo.internal.module_extension import ModuleExtension, ObjectSaver, MODULE_EXTENSIONS
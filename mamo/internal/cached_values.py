@@ -1,9 +1,94 @@
+import bz2
+import gzip
+import lzma
 import os
+import zlib
 from abc import ABC
-from dataclasses import dataclass, replace
-from typing import Optional, NoReturn
+from dataclasses import dataclass, field, replace
+from timeit import default_timer
+from typing import Optional, NoReturn, Callable, Dict, IO, Tuple
 from pathvalidate import sanitize_filename
 
+# Compression settings: None (no compression), the id of a registered codec or `ADAPTIVE_COMPRESSION`.
+ADAPTIVE_COMPRESSION = "adaptive"
+
+# Adaptive compression compresses a sample of this size with each codec in `ADAPTIVE_CODECS`...
+COMPRESSION_SAMPLE_SIZE = 2 ** 18
+# ...and picks the one with the best ratio that compresses faster than this (bytes/second).
+MIN_ADAPTIVE_COMPRESSION_SPEED = 32 * 2 ** 20
+# We don't compress if no codec reaches this ratio.
+MAX_ADAPTIVE_COMPRESSION_RATIO = 0.8
+
+
+@dataclass(frozen=True)
+class Codec:
+    codec_id: str
+    # Opens a (compressed) file, like `open(path, mode)` for binary modes.
+    open: Callable[[str, str], IO]
+    compress: Callable[[bytes], bytes]
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.codec_id] = codec
+
+
+# We use the gzip file format for zlib (deflate) streams.
+register_codec(Codec("zlib", gzip.open, zlib.compress))
+register_codec(Codec("lzma", lzma.open, lzma.compress))
+register_codec(Codec("bz2", bz2.open, bz2.compress))
+
+try:
+    import zstandard
+
+    register_codec(Codec("zstd", zstandard.open, zstandard.ZstdCompressor().compress))
+except ImportError:
+    pass
+
+# Ordered from fastest to slowest.
+ADAPTIVE_CODECS = ("zstd", "zlib", "bz2", "lzma")
+
+
+def get_codec(compression: str) -> Codec:
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression codec {compression}! (Available: {', '.join(CODECS)})")
+    return CODECS[compression]
+
+
+def choose_codec(compression: Optional[str], get_sample: Callable[[], bytes]) -> Optional[str]:
+    """Returns the id of the codec to use or None if we should not compress."""
+    if compression is None:
+        return None
+    if compression != ADAPTIVE_COMPRESSION:
+        return get_codec(compression).codec_id
+
+    sample = get_sample()[:COMPRESSION_SAMPLE_SIZE]
+    if not sample:
+        return None
+
+    best_codec_id = None
+    best_ratio = MAX_ADAPTIVE_COMPRESSION_RATIO
+    for codec_id in ADAPTIVE_CODECS:
+        codec = CODECS.get(codec_id)
+        if codec is None:
+            continue
+
+        start_time = default_timer()
+        ratio = len(codec.compress(sample)) / len(sample)
+        speed = len(sample) / max(default_timer() - start_time, 1e-9)
+        if speed >= MIN_ADAPTIVE_COMPRESSION_SPEED and ratio < best_ratio:
+            best_codec_id = codec_id
+            best_ratio = ratio
+    return best_codec_id
+
+
+def open_external_file(path: str, mode: str, codec_id: Optional[str]) -> IO:
+    if codec_id is None:
+        return open(path, mode)
+    return get_codec(codec_id).open(path, mode)
+
 
 class CachedValue:
     """Wraps a value that is being cached offline."""
@@ -19,6 +104,26 @@ class CachedValue:
     def get_stored_size(self) -> int:
         raise NotImplementedError()
 
+    def get_raw_size(self) -> int:
+        """The stored size before compression."""
+        return self.get_stored_size()
+
+    def get_external_paths(self) -> Tuple[str, ...]:
+        """The files that this value is stored in."""
+        return ()
+
+
+class BlobStore:
+    """Deduplicates externally cached values by the digest of their content (see `cache_deduplicated`)."""
+
+    def cache(self, digest: Optional[bytes], create: Callable[[], Optional[CachedValue]]) -> Optional[CachedValue]:
+        """
+        Returns the existing cached value for `digest` or registers the one that `create` returns.
+
+        Values without digest are registered too, so all externally cached values are tracked.
+        """
+        raise NotImplementedError()
+
 
 @dataclass
 class ExternallyCachedFilePath:
@@ -27,6 +132,9 @@ class ExternallyCachedFilePath:
     path: str
     external_id: str
     vid_info: str
+    # See `choose_codec`.
+    compression: Optional[str] = None
+    blob_store: Optional[BlobStore] = field(default=None, compare=False, repr=False)
 
     @staticmethod
     def for_tuple_item(path: "Optional[ExternallyCachedFilePath]", i: int) -> "Optional[ExternallyCachedFilePath]":
@@ -41,13 +149,35 @@ class ExternallyCachedFilePath:
                                                          max_len=255 - len(necessary_suffix)) + necessary_suffix)
 
 
+def cache_deduplicated(object_saver,
+                       external_path_builder: Optional[ExternallyCachedFilePath]) -> Optional[CachedValue]:
+    """
+    Caches the value of `object_saver` unless an identical value has been cached externally already.
+
+    Values are identical if their content digests are (see `ObjectSaver.compute_content_digest`).
+    """
+    if external_path_builder is None or external_path_builder.blob_store is None:
+        return object_saver.cache_value(external_path_builder)
+
+    return external_path_builder.blob_store.cache(object_saver.compute_content_digest(),
+                                                  lambda: object_saver.cache_value(external_path_builder))
+
+
 @dataclass
 class ExternallyCachedValue(CachedValue, ABC):
     """A value that is cached with external resources."""
 
     path: str
+    # None if the file is not compressed.
+    codec_id: Optional[str] = None
+    # The size before compression (if compressed).
+    raw_size: Optional[int] = None
+
+    def open(self, mode="rb"):
+        return open_external_file(self.path, mode, self.codec_id)
 
     def unlink(self):
+        # Garbage collection deletes these (see `PersistedStore.gc`).
         unlinked_path = self.path + ".unlinked"
         # TODO: shall we pass the vid as argument and store it in a file next to
         # the unlinked entry?
@@ -59,3 +189,9 @@ class ExternallyCachedValue(CachedValue, ABC):
 
     def get_stored_size(self):
         return os.path.getsize(self.path)
+
+    def get_raw_size(self):
+        return self.raw_size if self.raw_size is not None else self.get_stored_size()
+
+    def get_external_paths(self):
+        return self.path,
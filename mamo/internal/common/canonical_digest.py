@@ -0,0 +1,76 @@
+import dataclasses
+import hashlib
+import struct
+import weakref
+
+# Digests of (nested) identities and fingerprints. We cache them for values that support weakrefs,
+# so nested identities are only encoded once.
+_DIGEST_CACHE: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+DIGEST_SIZE = 16
+
+
+def _encode_bytes(tag: bytes, data: bytes) -> bytes:
+    return tag + struct.pack("<Q", len(data)) + data
+
+
+def _encode_sequence(tag: bytes, items) -> bytes:
+    return _encode_bytes(tag, b"".join(items))
+
+
+def _encode_nested(value) -> bytes:
+    if dataclasses.is_dataclass(value):
+        return _encode_bytes(b"d", canonical_digest(value))
+    return canonical_encode(value)
+
+
+def canonical_encode(value) -> bytes:
+    """
+    Encodes identities and fingerprints into bytes that are stable across processes.
+
+    Unlike `hash`, this does not depend on the hash seed and orders set members.
+    Like `hash`, numbers that compare equal are encoded equally (e.g. `True`, `1` and `1.0`).
+    Dataclasses are encoded by their type and the fields that take part in comparisons,
+    and nested dataclasses are encoded by their digest.
+
+    Only None, numbers, strings, bytes, tuples, frozensets and dataclasses of those are supported,
+    which covers all identities and fingerprints (digests are bytes).
+    Everything else raises a TypeError because there is no stable encoding for it.
+    """
+    if value is None:
+        return b"N"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int):
+        return _encode_bytes(b"i", str(int(value)).encode())
+    if isinstance(value, float):
+        return _encode_bytes(b"f", struct.pack("<d", value))
+    if isinstance(value, str):
+        return _encode_bytes(b"s", value.encode("utf-8", "surrogatepass"))
+    if isinstance(value, bytes):
+        return _encode_bytes(b"b", value)
+    if isinstance(value, tuple):
+        return _encode_sequence(b"t", map(_encode_nested, value))
+    if isinstance(value, frozenset):
+        return _encode_sequence(b"z", sorted(map(_encode_nested, value)))
+    if dataclasses.is_dataclass(value):
+        cls = type(value)
+        type_name = f"{cls.__module__}.{cls.__qualname__}".encode()
+        fields = (_encode_nested(getattr(value, field.name)) for field in dataclasses.fields(value) if field.compare)
+        return _encode_sequence(b"c", [_encode_bytes(b"n", type_name), *fields])
+
+    raise TypeError(f"Cannot canonically encode {type(value)} (for {value})!")
+
+
+def canonical_digest(value) -> bytes:
+    """Returns a compact digest of `canonical_encode(value)`."""
+    try:
+        digest = _DIGEST_CACHE.get(value)
+    except TypeError:
+        # Doesn't support weakrefs or isn't hashable.
+        return hashlib.blake2b(canonical_encode(value), digest_size=DIGEST_SIZE).digest()
+
+    if digest is None:
+        digest = hashlib.blake2b(canonical_encode(value), digest_size=DIGEST_SIZE).digest()
+        _DIGEST_CACHE[value] = digest
+    return digest
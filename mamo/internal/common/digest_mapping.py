@@ -0,0 +1,68 @@
+from typing import MutableMapping, TypeVar, Iterator, Tuple
+
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+from mamo.internal.common.canonical_digest import canonical_digest
+
+KT = TypeVar("KT")  # Key type.
+VT = TypeVar("VT")  # Value type.
+
+
+class PersistentDigestMapping(MutableMapping[KT, VT], Persistent):
+    """
+    A persistent mapping that is backed by a BTree keyed by the canonical digests of its keys.
+
+    Unlike a `PersistentMapping`, which is stored as a single record, only the BTree buckets that change
+    are written on commit. Keys can be any identity or fingerprint (they don't need to be orderable).
+    """
+
+    tree: OOBTree
+
+    def __init__(self, items=()):
+        self.tree = OOBTree()
+        self.update(items)
+
+    def _get_entry(self, key: KT):
+        entry = self.tree.get(canonical_digest(key))
+        # Guard against digest collisions.
+        if entry is None or entry[0] != key:
+            return None
+        return entry
+
+    def __getitem__(self, key: KT) -> VT:
+        entry = self._get_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def get(self, key: KT, default=None):
+        entry = self._get_entry(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def __setitem__(self, key: KT, value: VT):
+        self.tree[canonical_digest(key)] = (key, value)
+
+    def __delitem__(self, key: KT):
+        if self._get_entry(key) is None:
+            raise KeyError(key)
+        del self.tree[canonical_digest(key)]
+
+    def __contains__(self, key) -> bool:
+        return self._get_entry(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    def __iter__(self) -> Iterator[KT]:
+        for key, value in self.tree.values():
+            yield key
+
+    def items(self) -> Iterator[Tuple[KT, VT]]:
+        return iter(self.tree.values())
+
+    def values(self) -> Iterator[VT]:
+        for key, value in self.tree.values():
+            yield value
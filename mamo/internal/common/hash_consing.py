@@ -0,0 +1,75 @@
+import dataclasses
+import threading
+import weakref
+from typing import Dict, Tuple, TypeVar
+
+T = TypeVar("T", bound="HashConsed")
+
+_FIELD_NAMES: Dict[type, Tuple[str, ...]] = {}
+
+
+def _get_field_names(cls) -> Tuple[str, ...]:
+    field_names = _FIELD_NAMES.get(cls)
+    if field_names is None:
+        field_names = tuple(field.name for field in dataclasses.fields(cls))
+        _FIELD_NAMES[cls] = field_names
+    return field_names
+
+
+class HashConsed:
+    """
+    Base class for immutable values that are used as keys a lot (identities and fingerprints).
+
+    The hash is computed once on construction, and `hash_cons` canonicalizes equal values to a single instance,
+    so equality checks between canonical values are identity checks.
+
+    Subclasses must be frozen dataclasses with `eq=False` that declare their fields in `__slots__`.
+    """
+
+    __slots__ = ("_hash", "__weakref__")
+
+    def __post_init__(self):
+        object.__setattr__(self, "_hash", hash((type(self), self._get_field_values())))
+
+    def _get_field_values(self) -> tuple:
+        return tuple(getattr(self, name) for name in _get_field_names(type(self)))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._hash == other._hash and self._get_field_values() == other._get_field_values()
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return _reconstruct_hash_consed, (type(self),) + self._get_field_values()
+
+    def __setstate__(self, state):
+        # Values that have been pickled as plain frozen dataclasses are restored from their __dict__.
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+        self.__post_init__()
+
+
+# Maps (type, field values) to the canonical instance.
+_CANONICAL_VALUES: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+# So concurrent threads agree on the canonical instance.
+_CANONICAL_VALUES_LOCK = threading.Lock()
+
+
+def hash_cons(value: T) -> T:
+    """Returns the canonical instance that is equal to `value`."""
+    key = (type(value), value._get_field_values())
+    with _CANONICAL_VALUES_LOCK:
+        canonical_value = _CANONICAL_VALUES.get(key)
+        if canonical_value is None:
+            _CANONICAL_VALUES[key] = value
+            return value
+    return canonical_value
+
+
+def _reconstruct_hash_consed(cls, *field_values):
+    return hash_cons(cls(*field_values))
@@ -0,0 +1,43 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Generic, TypeVar, Tuple
+
+KT = TypeVar("KT")
+
+
+class SingleFlight(Generic[KT]):
+    """
+    Reentrant locks by key, so only one thread at a time computes a value for a key.
+
+    Threads that want to compute the same value wait until the current computation is done (or has failed), and
+    should then check whether they still need to compute it. Locks only exist while they are held or waited for.
+    """
+    # key -> (lock, number of threads holding or waiting for it)
+    flights: Dict[KT, Tuple[threading.RLock, int]]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    @contextmanager
+    def flight(self, key: KT):
+        with self.lock:
+            flight_lock, num_users = self.flights.get(key, (None, 0))
+            if flight_lock is None:
+                flight_lock = threading.RLock()
+            self.flights[key] = (flight_lock, num_users + 1)
+
+        try:
+            with flight_lock:
+                yield
+        finally:
+            with self.lock:
+                flight_lock, num_users = self.flights[key]
+                if num_users == 1:
+                    del self.flights[key]
+                else:
+                    self.flights[key] = (flight_lock, num_users - 1)
+
+    def __len__(self):
+        """The number of keys that are being computed."""
+        return len(self.flights)
@@ -0,0 +1,12 @@
+from functools import wraps
+
+
+def synchronized(method):
+    """Runs the method while holding `self.lock`."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -21,6 +21,19 @@ class ObjectProxy(objproxies.ObjectProxy):
     __slots__ = ("__weakref__",)
 
 
+class LazyProxy(objproxies.LazyProxy):
+    """Proxy for a value that is only obtained (via the callback) on first access."""
+    __slots__ = ("__weakref__",)
+
+
+def is_loaded(proxy: LazyProxy):
+    try:
+        objproxies.get_cache(proxy)
+    except AttributeError:
+        return False
+    return True
+
+
 class IdMapFinalizer(Generic[KT]):
     id_to_finalizer: Dict[int, weakref.finalize]
 
@@ -1,19 +1,91 @@
+import mmap
 import pickle
+import struct
 from dataclasses import dataclass
 
 from mamo.internal.common.weakref_utils import ObjectProxy
 
 from typing import Optional, Tuple
 
-from mamo.internal.cached_values import ExternallyCachedFilePath, CachedValue, ExternallyCachedValue
+from mamo.internal.cached_values import (
+    ExternallyCachedFilePath,
+    CachedValue,
+    ExternallyCachedValue,
+    choose_codec,
+    open_external_file,
+    cache_deduplicated,
+    COMPRESSION_SAMPLE_SIZE,
+)
 from mamo.internal.db_stored_value import DBPickledValue
 from mamo.internal.module_extension import ModuleExtension, ObjectSaver
 
-import hashlib
-
+from mamo.internal.digests import compute_digest, get_digest_algorithm
 from mamo.internal.reflection import get_type_qualified_name
 
 MAX_PICKLE_SIZE = 2 ** 30
+# We only keep pickled bytes up to this size in memory. Larger values are pickled again (streaming) when cached.
+MAX_IN_MEMORY_PICKLE_SIZE = 2 ** 20
+# When we pickle large values into external files, buffers of at least this size are written out-of-band.
+MIN_OUT_OF_BAND_BUFFER_SIZE = 2 ** 16
+OUT_OF_BAND_ALIGNMENT = 64
+OUT_OF_BAND_MAGIC = b"MAMOOOB5"
+
+
+class DigestingWriter:
+    """A file-like object for `pickle.dump` that digests and counts the written bytes and forwards them to `file`."""
+
+    def __init__(self, file=None, max_buffer_size=0):
+        self.file = file
+        self.max_buffer_size = max_buffer_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.digest_algorithm = get_digest_algorithm()
+        self.hash_method = self.digest_algorithm.new()
+
+    def write(self, data):
+        self.hash_method.update(data)
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+        if self.buffer is not None:
+            if len(self.buffer) + len(data) > self.max_buffer_size:
+                self.buffer = None
+            else:
+                self.buffer += data
+        return len(data)
+
+    def get_digest(self):
+        return self.digest_algorithm.finalize(self.hash_method)
+
+    def get_buffered_bytes(self) -> Optional[bytes]:
+        """Returns None if the written bytes exceeded `max_buffer_size`."""
+        return bytes(self.buffer) if self.buffer is not None else None
+
+
+class _SampleComplete(Exception):
+    pass
+
+
+class _SampleWriter:
+    def __init__(self, sample_size):
+        self.sample_size = sample_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.sample_size:
+            raise _SampleComplete()
+        return len(data)
+
+
+def get_pickle_sample(value, sample_size=COMPRESSION_SAMPLE_SIZE) -> bytes:
+    """Returns the first `sample_size` pickled bytes of `value` (without pickling all of it)."""
+    writer = _SampleWriter(sample_size)
+    try:
+        pickle.dump(value, writer)
+    except _SampleComplete:
+        pass
+    return bytes(writer.buffer[:sample_size])
 
 
 @dataclass
@@ -30,6 +102,12 @@ class CachedTuple(CachedValue):
     def get_stored_size(self) -> int:
         return sum(item.get_stored_size() for item in self.values)
 
+    def get_raw_size(self) -> int:
+        return sum(item.get_raw_size() for item in self.values)
+
+    def get_external_paths(self):
+        return tuple(external_path for item in self.values for external_path in item.get_external_paths())
+
 
 class DefaultTupleObjectSaver(ObjectSaver):
     def __init__(self, value, object_savers: Tuple[ObjectSaver]):
@@ -40,14 +118,11 @@ class DefaultTupleObjectSaver(ObjectSaver):
         return sum(object_saver.get_estimated_size() for object_saver in self.object_savers)
 
     def compute_digest_(self):
-        hash_method = hashlib.md5()
-        for object_saver in self.object_savers:
-            hash_method.update(object_saver.compute_digest())
-        return hash_method.digest()
+        return compute_digest(*(object_saver.compute_digest() for object_saver in self.object_savers))
 
     def cache_value(self, external_path_builder: Optional[ExternallyCachedFilePath]) -> Optional[CachedValue]:
         cached_items = tuple(
-            object_saver.cache_value(ExternallyCachedFilePath.for_tuple_item(external_path_builder, i))
+            cache_deduplicated(object_saver, ExternallyCachedFilePath.for_tuple_item(external_path_builder, i))
             for i, object_saver in enumerate(self.object_savers))
         if any(item is None for item in cached_items):
             return None
@@ -56,43 +131,132 @@ class DefaultTupleObjectSaver(ObjectSaver):
 
 class DefaultExternallyCachedValue(ExternallyCachedValue):
 
+    def load(self):
+        # Unpickle from the (buffered) file directly, so we don't hold all the bytes in memory.
+        with self.open() as external_file:
+            try:
+                return pickle.load(external_file)
+            except pickle.PickleError as err:
+                # TODO: log err
+                print(err)
+                return None
+
+    @staticmethod
+    def save(external_path, pickled_bytes, codec_id: Optional[str] = None):
+        # TODO: add error handling!
+        with open_external_file(external_path, "wb", codec_id) as external_file:
+            external_file.write(pickled_bytes)
+
+        return DefaultExternallyCachedValue(external_path, codec_id, len(pickled_bytes) if codec_id else None)
+
+    @staticmethod
+    def dump(external_path, value, codec_id: str, raw_size: int):
+        """Pickles `value` straight into the compressed external file."""
+        # TODO: add error handling!
+        with open_external_file(external_path, "wb", codec_id) as external_file:
+            pickle.dump(value, external_file)
+
+        return DefaultExternallyCachedValue(external_path, codec_id, raw_size)
+
+
+class OutOfBandExternallyCachedValue(ExternallyCachedValue):
+    """
+    A protocol 5 pickle whose large buffers are stored as separate aligned segments.
+
+    Layout: magic, pickle, aligned buffers, (offset, size) of each buffer, number of buffers and pickle size.
+    We memory-map the file on load, so the buffers are loaded as zero-copy (read-only) views.
+    """
+
     def load(self):
         with open(self.path, "br") as external_file:
-            pickled_bytes = external_file.read()
+            view = memoryview(mmap.mmap(external_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        trailer_offset = len(view) - 16
+        num_buffers, pickle_size = struct.unpack_from("<QQ", view, trailer_offset)
+        table = view[trailer_offset - 16 * num_buffers:trailer_offset]
+        buffers = [view[offset:offset + size] for offset, size in struct.iter_unpack("<QQ", table)]
 
         try:
-            return pickle.loads(pickled_bytes)
+            return pickle.loads(view[len(OUT_OF_BAND_MAGIC):len(OUT_OF_BAND_MAGIC) + pickle_size], buffers=buffers)
         except pickle.PickleError as err:
             # TODO: log err
             print(err)
             return None
 
     @staticmethod
-    def save(external_path, pickled_bytes):
+    def dump(external_path, value):
+        """Pickles `value` straight into the external file (without copying large buffers)."""
+        buffers = []
+
+        def buffer_callback(buffer: pickle.PickleBuffer):
+            try:
+                raw_buffer = buffer.raw()
+            except BufferError:
+                # Not contiguous.
+                return True
+            if raw_buffer.nbytes < MIN_OUT_OF_BAND_BUFFER_SIZE:
+                return True
+            buffers.append(raw_buffer)
+            return False
+
         # TODO: add error handling!
         with open(external_path, "bw") as external_file:
-            external_file.write(pickled_bytes)
+            external_file.write(OUT_OF_BAND_MAGIC)
+            pickle.dump(value, external_file, protocol=5, buffer_callback=buffer_callback)
+            pickle_size = external_file.tell() - len(OUT_OF_BAND_MAGIC)
 
-        return DefaultExternallyCachedValue(external_path)
+            table = []
+            for raw_buffer in buffers:
+                external_file.write(bytes(-external_file.tell() % OUT_OF_BAND_ALIGNMENT))
+                table.append((external_file.tell(), raw_buffer.nbytes))
+                external_file.write(raw_buffer)
+
+            for entry in table:
+                external_file.write(struct.pack("<QQ", *entry))
+            external_file.write(struct.pack("<QQ", len(table), pickle_size))
+
+        return OutOfBandExternallyCachedValue(external_path)
 
 
 class DefaultObjectSaver(ObjectSaver):
-    def __init__(self, value, pickled_bytes):
+    def __init__(self, value, pickled_bytes: Optional[bytes], pickled_size: int, digest: bytes):
         super().__init__(value)
+        # None if the value was too large to keep in memory.
         self.pickled_bytes = pickled_bytes
+        self.pickled_size = pickled_size
+        self.digest = digest
 
     def get_estimated_size(self) -> Optional[int]:
-        return len(self.pickled_bytes)
+        return self.pickled_size
 
     def compute_digest_(self):
-        return hashlib.md5(self.pickled_bytes).digest()
+        # Computed while pickling.
+        return self.digest
+
+    def compute_content_digest(self):
+        # The pickled bytes include the type.
+        return b"pickle:" + self.digest
+
+    def get_sample(self):
+        if self.pickled_bytes is not None:
+            return self.pickled_bytes[:COMPRESSION_SAMPLE_SIZE]
+        return get_pickle_sample(self.value)
 
     def cache_value(self, external_path_builder: Optional[ExternallyCachedFilePath]) -> Optional[CachedValue]:
         if external_path_builder is not None:
             external_path = external_path_builder.build(get_type_qualified_name(self.value), "pickle")
-            cached_value = DefaultExternallyCachedValue.save(external_path, self.pickled_bytes)
-        else:
+            codec_id = choose_codec(external_path_builder.compression, self.get_sample)
+            if self.pickled_bytes is not None:
+                cached_value = DefaultExternallyCachedValue.save(external_path, self.pickled_bytes, codec_id)
+            elif codec_id is not None:
+                # Out-of-band buffers are memory-mapped, so we can't compress them.
+                cached_value = DefaultExternallyCachedValue.dump(external_path, self.value, codec_id, self.pickled_size)
+            else:
+                cached_value = OutOfBandExternallyCachedValue.dump(external_path, self.value)
+        elif self.pickled_bytes is not None:
             cached_value = DBPickledValue(self.pickled_bytes)
+        else:
+            cached_value = DBPickledValue.cache_value(self.value)
 
         # TODO: catch transactions error for objects that cannot be pickled here?
         return cached_value
@@ -106,18 +270,20 @@ class DefaultModuleExtension(ModuleExtension):
         if isinstance(value, tuple):
             return DefaultTupleObjectSaver(value, tuple(self.module_registry.get_object_saver(item) for item in value))
 
+        # Digest and measure the pickled value without materializing large pickles.
+        writer = DigestingWriter(max_buffer_size=MAX_IN_MEMORY_PICKLE_SIZE)
         try:
-            pickled_bytes = pickle.dumps(value)
+            pickle.dump(value, writer)
         except pickle.PicklingError as err:
             # TODO: log err
             print(err)
             return None
 
-        if len(pickled_bytes) > MAX_PICKLE_SIZE:
+        if writer.size > MAX_PICKLE_SIZE:
             # TODO: log
             return None
 
-        return DefaultObjectSaver(value, pickled_bytes)
+        return DefaultObjectSaver(value, writer.get_buffered_bytes(), writer.size, writer.get_digest())
 
     def wrap_return_value(self, value):
         # Treat tuples different for functions returning multiple values.
@@ -1,4 +1,5 @@
 import signal
+import threading
 from contextlib import contextmanager
 from typing import Iterable, Optional
 
@@ -9,18 +10,28 @@ from typing import Iterable, Optional
 def delayed_interruption():
     """
     Context manager that delays the delivery of SIGINT until the context is exited.
+
+    Python only delivers signals to the main thread (and only allows it to set handlers), so this does nothing in
+    other threads.
     """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
     signal_received: Optional[Iterable] = None
 
-    def handler(self, sig, frame):
+    def handler(sig, frame):
         nonlocal signal_received
         signal_received = (sig, frame)
 
     old_handler = signal.signal(signal.SIGINT, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, old_handler)
 
-    yield
-
-    signal.signal(signal.SIGINT, old_handler)
     if signal_received:
-        old_handler(*signal_received)
-
+        if callable(old_handler):
+            old_handler(*signal_received)
+        elif old_handler == signal.SIG_DFL:
+            raise KeyboardInterrupt()
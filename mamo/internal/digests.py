@@ -0,0 +1,78 @@
+import hashlib
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Dict, Union
+
+
+@dataclass(frozen=True)
+class DigestAlgorithm:
+    """
+    A hashlib-style hash function for fingerprints.
+
+    Digests are prefixed with the algorithm id, so fingerprints from different algorithms never compare equal.
+    MD5 digests are not prefixed to stay compatible with existing stores.
+    """
+    algorithm_id: str
+    new: Callable[[], object]
+    prefix: bytes
+
+    def digest(self, *chunks) -> bytes:
+        hash_method = self.new()
+        for chunk in chunks:
+            hash_method.update(chunk)
+        return self.finalize(hash_method)
+
+    def finalize(self, hash_method) -> bytes:
+        """Returns the digest of a hash method that was created with `new` (for incremental digests)."""
+        return self.prefix + hash_method.digest()
+
+
+def create_digest_algorithm(algorithm_id: str, new: Callable[[], object]):
+    return DigestAlgorithm(algorithm_id, new, f"{algorithm_id}:".encode())
+
+
+def blake2b(digest_size=16):
+    return create_digest_algorithm(f"blake2b-{digest_size * 8}", partial(hashlib.blake2b, digest_size=digest_size))
+
+
+MD5 = DigestAlgorithm("md5", hashlib.md5, b"")
+
+DIGEST_ALGORITHMS: Dict[str, DigestAlgorithm] = {}
+
+
+def register_digest_algorithm(algorithm: DigestAlgorithm):
+    DIGEST_ALGORITHMS[algorithm.algorithm_id] = algorithm
+
+
+register_digest_algorithm(MD5)
+register_digest_algorithm(create_digest_algorithm("sha256", hashlib.sha256))
+register_digest_algorithm(blake2b(16))
+register_digest_algorithm(blake2b(32))
+
+try:
+    import xxhash
+
+    # Not cryptographic but much faster.
+    register_digest_algorithm(create_digest_algorithm("xxh3-128", xxhash.xxh3_128))
+except ImportError:
+    pass
+
+_digest_algorithm = MD5
+
+
+def get_digest_algorithm() -> DigestAlgorithm:
+    return _digest_algorithm
+
+
+def set_digest_algorithm(algorithm: Union[str, DigestAlgorithm]):
+    global _digest_algorithm
+
+    if isinstance(algorithm, str):
+        if algorithm not in DIGEST_ALGORITHMS:
+            raise ValueError(f"Unknown digest algorithm {algorithm}! (Available: {', '.join(DIGEST_ALGORITHMS)})")
+        algorithm = DIGEST_ALGORITHMS[algorithm]
+    _digest_algorithm = algorithm
+
+
+def compute_digest(*chunks) -> bytes:
+    return _digest_algorithm.digest(*chunks)
@@ -1,9 +1,12 @@
 import inspect
-from types import CodeType, FunctionType
-from typing import Optional, Set, Dict, MutableMapping
+import threading
+from dataclasses import dataclass
+from types import CodeType, FunctionType, MethodType
+from typing import Optional, Set, Dict, MutableMapping, Tuple
 from weakref import WeakKeyDictionary
 
 from mamo.internal import reflection
+from mamo.internal.common.hash_consing import hash_cons
 from mamo.internal.fingerprints import (
     FunctionFingerprint,
     DeepFunctionFingerprint,
@@ -24,6 +27,57 @@ from mamo.internal.reflection import FunctionDependencies
 # TODO: This can be part of the default module extension! (or its own extension!!)
 # We can define a FunctionCall wrapper and pass that through the module system to allow for customization!
 from mamo.internal.common.weakref_utils import WeakKeyIdMap
+from mamo.internal.common.synchronized import synchronized
+
+
+# (namespace, qualified name, resolved object, code object of the resolved object)
+GlobalBinding = Tuple[dict, Tuple[str, ...], object, Optional[CodeType]]
+
+
+@dataclass
+class DeepFingerprintCacheEntry:
+    namespace: dict
+    fingerprint: FunctionFingerprint
+    # Whether the fingerprint cut a call cycle at a function further up the call stack.
+    # Such fingerprints depend on the call stack and can only be reused at the top-level.
+    cyclic: bool
+    # All global bindings the fingerprint depends on (including those of callees).
+    bindings: Tuple[GlobalBinding, ...]
+
+
+@dataclass
+class CodeDependencies:
+    """The code of some functions and the global bindings their fingerprints depend on."""
+
+    # (function, code object)
+    codes: Tuple[Tuple[object, Optional[CodeType]], ...]
+    bindings: Tuple[GlobalBinding, ...]
+
+    def is_current(self):
+        return all(_get_code(func) is code for func, code in self.codes) and all(
+            map(is_binding_current, self.bindings))
+
+
+def _get_code(obj) -> Optional[CodeType]:
+    obj = getattr(obj, "mamo_unwrapped_func", obj)
+    return getattr(obj, "__code__", None)
+
+
+def _is_same_binding(resolved, current):
+    if resolved is current:
+        return True
+    # Bound methods are recreated on every attribute access.
+    return isinstance(current, MethodType) and resolved == current
+
+
+def is_binding_current(binding: GlobalBinding):
+    """Whether the qualified name still resolves to the same object with the same code (see autoreload)."""
+    namespace, qualified_name, resolved, code = binding
+    try:
+        current = reflection.resolve_qualified_name(qualified_name, namespace)
+    except AttributeError:
+        current = None
+    return _is_same_binding(resolved, current) and _get_code(current) is code
 
 
 class FingerprintRegistry(FingerprintProvider):
@@ -34,11 +88,25 @@ class FingerprintRegistry(FingerprintProvider):
 
     cache: WeakKeyIdMap[object, Fingerprint]
 
-    # actually a WeakKeyDictionary!
+    # actually WeakKeyDictionaries!
     code_object_deps: MutableMapping[CodeType, FunctionDependencies]
+    code_object_fingerprints: MutableMapping[CodeType, bytes]
+    deep_fingerprint_cache: MutableMapping[CodeType, DeepFingerprintCacheEntry]
+
+    # Incremented whenever all cached deep fingerprints are invalidated.
+    code_epoch: int
+
     # If not None, allows for deep function fingerprinting.
-    deep_fingerprint_source_prefix: Optional[str]
-    deep_fingerprint_stack: Set[CodeType]
+    _deep_fingerprint_source_prefix: Optional[str]
+    # Maps code objects to their depth on the stack.
+    deep_fingerprint_stack: Dict[CodeType, int]
+    # The lowest stack depth a cycle has been cut at while fingerprinting the current subtree.
+    _lowest_cut_depth: float
+    # The global bindings the current subtree depends on.
+    _subtree_bindings: Dict[Tuple[int, Tuple[str, ...]], GlobalBinding]
+
+    # Guards the caches and the state of the current deep fingerprint (which is shared across threads).
+    lock: threading.RLock
 
     def __init__(
             self,
@@ -50,14 +118,37 @@ class FingerprintRegistry(FingerprintProvider):
         self.cache = WeakKeyIdMap()
 
         self.code_object_deps = WeakKeyDictionary()
+        self.code_object_fingerprints = WeakKeyDictionary()
+        self.deep_fingerprint_cache = WeakKeyDictionary()
+
+        self.code_epoch = 0
 
-        self.deep_fingerprint_source_prefix = deep_fingerprint_source_prefix
-        self.deep_fingerprint_stack = set()
+        self._deep_fingerprint_source_prefix = deep_fingerprint_source_prefix
+        self.deep_fingerprint_stack = {}
+        self._lowest_cut_depth = float("inf")
+        self._subtree_bindings = {}
+
+        self.lock = threading.RLock()
 
         self.value_provider = value_provider
         self.value_oracle = value_oracle
         self.function_provider = function_provider
 
+    @property
+    def deep_fingerprint_source_prefix(self) -> Optional[str]:
+        return self._deep_fingerprint_source_prefix
+
+    @deep_fingerprint_source_prefix.setter
+    def deep_fingerprint_source_prefix(self, value: Optional[str]):
+        self._deep_fingerprint_source_prefix = value
+        # The prefix determines which functions are fingerprinted deeply.
+        self.invalidate_deep_fingerprints()
+
+    @synchronized
+    def invalidate_deep_fingerprints(self):
+        self.deep_fingerprint_cache.clear()
+        self.code_epoch += 1
+
     def fingerprint_value(self, value):
         # TODO: do I want to store strings like that?
         if value is None or isinstance(value, (bool, int, float)) or (isinstance(value, str) and len(value) <
@@ -65,7 +156,8 @@ class FingerprintRegistry(FingerprintProvider):
             # TODO: special-case strings and summarize them?
             return FingerprintDigestRepr(value, repr(value))
 
-        fingerprint = self.cache.get(value)
+        with self.lock:
+            fingerprint = self.cache.get(value)
         if fingerprint is not None:
             return fingerprint
 
@@ -86,22 +178,24 @@ class FingerprintRegistry(FingerprintProvider):
                 " or register it with a name"
             )
 
-        self.cache[value] = fingerprint
+        with self.lock:
+            self.cache[value] = fingerprint
 
         return fingerprint
 
+    @synchronized
     def fingerprint_function(self, func):
-        # Function fingerprints (when we allow deep fingerprints) cannot be cached
+        # Deep function fingerprints are cached and invalidated when any global they depend on is rebound.
         return self._get_function_fingerprint(func, allow_deep=True)
 
     def fingerprint_call(self, func: FunctionType, args, kwargs: Dict):
-        # Call fingerprints (when we allow deep fingerprints) cannot be cached
         func_fingerprint = self._get_function_fingerprint(func)
         args_fingerprints = tuple(self.value_oracle.fingerprint_value(arg) for arg in args)
         kwargs_fingerprints = frozenset((name, self.value_oracle.fingerprint_value(arg)) for name, arg in kwargs.items())
 
-        return CallFingerprint(func_fingerprint, args_fingerprints, kwargs_fingerprints)
+        return hash_cons(CallFingerprint(func_fingerprint, args_fingerprints, kwargs_fingerprints))
 
+    @synchronized
     def fingerprint_cell(self, cell_function: FunctionType) -> CellFingerprint:
         cell_code_fingerprint = self._get_deep_fingerprint(cell_function.__code__, cell_function.__globals__)
 
@@ -114,12 +208,15 @@ class FingerprintRegistry(FingerprintProvider):
             (name, (self.value_oracle.identify_value(value), self.value_oracle.fingerprint_value(value)))
             for name, value in resolved_globals_loads.items()
         )
-        cell_fingerprint = CellFingerprint(cell_code_fingerprint, globals_load_fingerprint, frozenset(global_stores))
+        cell_fingerprint = hash_cons(
+            CellFingerprint(cell_code_fingerprint, globals_load_fingerprint, frozenset(global_stores))
+        )
         return cell_fingerprint
 
     def fingerprint_cell_result(self, cell_fingerprint: CellFingerprint, key: str):
         return CellResultFingerprint(cell_fingerprint, key)
 
+    @synchronized
     def fingerprint_computed_value(self, vid: ComputedValueIdentity):
         # TODO: move back to main.py:is_stale_vid!
         outer_self = self
@@ -136,7 +233,9 @@ class FingerprintRegistry(FingerprintProvider):
                     (name, outer_self.value_provider.resolve_fingerprint(arg_vid))
                     for name, arg_vid in vid.kwargs_vid
                 ]
-                return CallFingerprint(func_fingerprint, tuple(arg_fingerprints), frozenset(kwarg_fingerprints))
+                return hash_cons(
+                    CallFingerprint(func_fingerprint, tuple(arg_fingerprints), frozenset(kwarg_fingerprints))
+                )
 
             def visit_cell_result(self, vid: ValueCellResultIdentity):
                 cell_function = outer_self.function_provider.resolve_function(vid.cell)
@@ -151,14 +250,78 @@ class FingerprintRegistry(FingerprintProvider):
             self.code_object_deps[code_object] = code_object_deps
         return code_object_deps
 
+    def _get_code_object_fingerprint(self, code_object) -> bytes:
+        code_object_fingerprint = self.code_object_fingerprints.get(code_object)
+        if code_object_fingerprint is None:
+            code_object_fingerprint = reflection.get_code_object_fingerprint(code_object)
+            self.code_object_fingerprints[code_object] = code_object_fingerprint
+        return code_object_fingerprint
+
+    def _add_subtree_bindings(self, bindings):
+        for binding in bindings:
+            namespace, qualified_name, resolved, code = binding
+            self._subtree_bindings[(id(namespace), qualified_name)] = binding
+
+    def _get_valid_cache_entry(self, code_object, namespace) -> Optional[DeepFingerprintCacheEntry]:
+        cache_entry = self.deep_fingerprint_cache.get(code_object)
+        if cache_entry is None or cache_entry.namespace is not namespace:
+            return None
+        # Only check the bindings this fingerprint depends on.
+        if not all(map(is_binding_current, cache_entry.bindings)):
+            del self.deep_fingerprint_cache[code_object]
+            return None
+        return cache_entry
+
+    def _get_code_bindings(self, func) -> Tuple[GlobalBinding, ...]:
+        func = getattr(func, "mamo_unwrapped_func", func)
+        code_object = _get_code(func)
+        if code_object is None:
+            return ()
+        self._get_function_fingerprint(func)
+        cache_entry = self._get_valid_cache_entry(code_object, getattr(func, "__globals__", None))
+        if cache_entry is None:
+            # Shallow fingerprints only depend on the code.
+            return ()
+        return cache_entry.bindings
+
+    @synchronized
+    def get_code_dependencies(self, funcs) -> CodeDependencies:
+        """Returns what the fingerprints of `funcs` depend on."""
+        codes = {}
+        bindings = {}
+        for func in funcs:
+            codes[id(func)] = (func, _get_code(func))
+            for binding in self._get_code_bindings(func):
+                namespace, qualified_name, resolved, code = binding
+                bindings[(id(namespace), qualified_name)] = binding
+        return CodeDependencies(tuple(codes.values()), tuple(bindings.values()))
+
     def _get_deep_fingerprint(self, code_object, namespace):
-        if code_object in self.deep_fingerprint_stack:
-            return FunctionFingerprint(reflection.get_code_object_fingerprint(code_object))
-        self.deep_fingerprint_stack.add(code_object)
+        depth = len(self.deep_fingerprint_stack)
+
+        cache_entry = self._get_valid_cache_entry(code_object, namespace)
+        if cache_entry is not None and (not cache_entry.cyclic or depth == 0):
+            if depth > 0:
+                self._add_subtree_bindings(cache_entry.bindings)
+            return cache_entry.fingerprint
+
+        stack_depth = self.deep_fingerprint_stack.get(code_object)
+        if stack_depth is not None:
+            self._lowest_cut_depth = min(self._lowest_cut_depth, stack_depth)
+            return hash_cons(FunctionFingerprint(self._get_code_object_fingerprint(code_object)))
+
+        outer_lowest_cut_depth = self._lowest_cut_depth
+        outer_subtree_bindings = self._subtree_bindings
+        self._lowest_cut_depth = float("inf")
+        self._subtree_bindings = {}
+        self.deep_fingerprint_stack[code_object] = depth
         try:
             func_deps = self._get_code_object_deps(code_object)
 
             resolved_funcs = reflection.resolve_qualified_names(func_deps.func_calls, namespace)
+            self._add_subtree_bindings(
+                (namespace, qn, resolved_func, _get_code(resolved_func)) for qn, resolved_func in resolved_funcs.items()
+            )
 
             # TODO: this does not seem to resolve builtins!!?!?! debug
 
@@ -167,18 +330,31 @@ class FingerprintRegistry(FingerprintProvider):
                 for qn, resolved_func in resolved_funcs.items() if resolved_func
             }
 
-            return DeepFunctionFingerprint(
-                reflection.get_code_object_fingerprint(code_object), frozenset(global_funcs.items())
+            fingerprint = hash_cons(
+                DeepFunctionFingerprint(self._get_code_object_fingerprint(code_object), frozenset(global_funcs.items()))
             )
+
+            cyclic = self._lowest_cut_depth < depth
+            if not cyclic or depth == 0:
+                self.deep_fingerprint_cache[code_object] = DeepFingerprintCacheEntry(
+                    namespace, fingerprint, cyclic, tuple(self._subtree_bindings.values())
+                )
+
+            return fingerprint
         finally:
-            self.deep_fingerprint_stack.remove(code_object)
+            del self.deep_fingerprint_stack[code_object]
+            self._lowest_cut_depth = min(outer_lowest_cut_depth, self._lowest_cut_depth)
+            if depth > 0:
+                outer_subtree_bindings.update(self._subtree_bindings)
+            self._subtree_bindings = outer_subtree_bindings
 
+    @synchronized
     def _get_function_fingerprint(self, callee, allow_deep=True) -> Optional[FunctionFingerprint]:
         # TODO: necessary?
         if callee is None:
             return None
         elif reflection.is_func_builtin(callee):
-            func_fingerprint = FunctionFingerprint(callee.__qualname__)
+            func_fingerprint = hash_cons(FunctionFingerprint(callee.__qualname__))
         else:
             # TODO: more tests? code review?
             if isinstance(callee, FunctionType):
@@ -207,6 +383,6 @@ class FingerprintRegistry(FingerprintProvider):
             if allow_deep and reflection.is_func_local(callee, self.deep_fingerprint_source_prefix):
                 func_fingerprint = self._get_deep_fingerprint(callee.__code__, callee.__globals__)
             else:
-                func_fingerprint = FunctionFingerprint(reflection.get_func_fingerprint(callee))
+                func_fingerprint = hash_cons(FunctionFingerprint(self._get_code_object_fingerprint(callee.__code__)))
 
         return func_fingerprint
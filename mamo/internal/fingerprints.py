@@ -1,12 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Tuple, FrozenSet, Optional
 
+from mamo.internal.common.hash_consing import HashConsed
 
 MAX_FINGERPRINT_VALUE_LENGTH = 1024
 
 
 class Fingerprint:
-    pass
+    __slots__ = ()
 
 
 @dataclass(frozen=True)
@@ -26,7 +27,7 @@ class FingerprintName(Fingerprint):
 class FingerprintDigestRepr(FingerprintDigest):
     """A `FingerprintDigest` that carries its original value to be more informative."""
 
-    value: str
+    value: str = field(compare=False)
 
     def __eq__(self, other):
         return super().__eq__(other)
@@ -38,31 +39,39 @@ class FingerprintDigestRepr(FingerprintDigest):
 # We keep this separate from FunctionIdentity, so we cache by identity
 # and determine staleness using fingerprints.
 # (Otherwise, we lack a key to index with and find stale entries.)
-@dataclass(frozen=True)
-class FunctionFingerprint(Fingerprint):
+@dataclass(frozen=True, eq=False)
+class FunctionFingerprint(HashConsed, Fingerprint):
+    __slots__ = ("fingerprint",)
+
     fingerprint: object
 
 
 # Includes dependencies.
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class DeepFunctionFingerprint(FunctionFingerprint):
+    __slots__ = ("func_calls",)
+
     func_calls: FrozenSet[Tuple[Tuple[str, ...], FunctionFingerprint]]
 
 
 class ResultFingerprint(Fingerprint):
-    pass
+    __slots__ = ()
 
 
-@dataclass(frozen=True)
-class CallFingerprint(ResultFingerprint):
+@dataclass(frozen=True, eq=False)
+class CallFingerprint(HashConsed, ResultFingerprint):
+    __slots__ = ("function", "args", "kwargs")
+
     function: FunctionFingerprint
     # Need fingerprints everywhere! This needs to be a separate hierarchy!
     args: Tuple[Optional[Fingerprint], ...]
     kwargs: FrozenSet[Tuple[str, Optional[Fingerprint]]]
 
 
-@dataclass(frozen=True)
-class CellFingerprint:
+@dataclass(frozen=True, eq=False)
+class CellFingerprint(HashConsed):
+    __slots__ = ("cell_code_fingerprint", "globals_load", "outputs")
+
     cell_code_fingerprint: FunctionFingerprint
     globals_load: FrozenSet[Tuple[Tuple[str, ...], Tuple["ValueIdentity", Fingerprint]]]
     outputs: FrozenSet[str]
@@ -1,3 +1,4 @@
+import threading
 from types import FunctionType
 from typing import Dict
 
@@ -8,19 +9,29 @@ from mamo.internal.providers import FunctionProvider
 
 class FunctionRegistry(FunctionProvider):
     fid_to_func: Dict[FunctionIdentity, FunctionType]
+    # Incremented whenever a function identity is bound to a different function.
+    epoch: int
 
     def __init__(self):
         super().__init__()
         self.fid_to_func = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def _bind(self, fid: FunctionIdentity, func: FunctionType):
+        if self.fid_to_func.get(fid) is not func:
+            with self.lock:
+                self.fid_to_func[fid] = func
+                self.epoch += 1
 
     def identify_function(self, func) -> FunctionIdentity:
         fid = FunctionIdentity(reflection.get_func_qualified_name(func))
-        self.fid_to_func[fid] = func
+        self._bind(fid, func)
         return fid
 
     def identify_cell(self, name: str, cell_function: FunctionType) -> CellIdentity:
         fid = CellIdentity(name)
-        self.fid_to_func[fid] = cell_function
+        self._bind(fid, cell_function)
         return fid
 
     def resolve_function(self, fid):
@@ -0,0 +1,118 @@
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Tuple
+
+from mamo.internal.fingerprint_registry import CodeDependencies
+from mamo.internal.fingerprints import MAX_FINGERPRINT_VALUE_LENGTH
+from mamo.internal.identities import ComputedValueIdentity
+from mamo.internal.common.synchronized import synchronized
+from mamo.internal.common.weakref_utils import supports_weakrefs
+
+MAX_HIT_CACHE_ENTRIES = 1024
+
+# Marks arguments that we cannot reference safely.
+_UNSUPPORTED = object()
+
+
+def _reference(value):
+    # Check this first, so we don't load lazy proxies.
+    if supports_weakrefs(value):
+        return weakref.ref(value)
+    # Primitive values are kept alive, so their ids stay valid.
+    if value is None or isinstance(value, (bool, int, float)) or (
+        isinstance(value, str) and len(value) < MAX_FINGERPRINT_VALUE_LENGTH
+    ):
+        return value
+    return _UNSUPPORTED
+
+
+def _dereference(reference):
+    if isinstance(reference, weakref.ref):
+        return reference()
+    return reference
+
+
+def _get_key(args, kwargs):
+    return tuple(map(id, args)), tuple((name, id(value)) for name, value in kwargs.items())
+
+
+@dataclass
+class HitCacheEntry:
+    """A cache hit for a call with specific live arguments."""
+
+    mamo_ref: weakref.ref
+    epoch: Tuple[int, ...]
+    args_refs: tuple
+    kwargs_refs: tuple
+    result_ref: weakref.ref
+    vid: ComputedValueIdentity
+    estimated_nomamo_call_duration: float
+    code_dependencies: CodeDependencies
+
+    def resolve(self, mamo, args, kwargs):
+        """Returns the cached result if the entry is still valid for the given call, and None otherwise."""
+        if self.mamo_ref() is not mamo:
+            return None
+        for reference, arg in zip(self.args_refs, args):
+            if _dereference(reference) is not arg:
+                return None
+        for (name, reference), value in zip(self.kwargs_refs, kwargs.values()):
+            if _dereference(reference) is not value:
+                return None
+        if mamo.get_epoch() != self.epoch or not self.code_dependencies.is_current():
+            return None
+        return self.result_ref()
+
+
+class HitCache:
+    """
+    Caches cache hits of a memoized function keyed by the identities of the live arguments.
+
+    Entries are only valid as long as the arguments are alive, Mamo's epoch does not change (no values have been
+    added or removed and the re-execution policy is the same), and the code the result depends on has not changed.
+    The least recently used entries are evicted first.
+    """
+
+    entries: "OrderedDict[tuple, HitCacheEntry]"
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @synchronized
+    def lookup(self, mamo, args, kwargs):
+        key = _get_key(args, kwargs)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+        result = entry.resolve(mamo, args, kwargs)
+        if result is None:
+            del self.entries[key]
+            return None, None
+        self.entries.move_to_end(key)
+        return result, entry
+
+    @synchronized
+    def add(self, mamo, epoch, args, kwargs, result, vid, estimated_nomamo_call_duration: float,
+            code_dependencies: CodeDependencies):
+        if not supports_weakrefs(result):
+            return
+
+        args_refs = tuple(map(_reference, args))
+        kwargs_refs = tuple((name, _reference(value)) for name, value in kwargs.items())
+        if any(reference is _UNSUPPORTED for reference in args_refs) or any(
+            reference is _UNSUPPORTED for name, reference in kwargs_refs
+        ):
+            return
+
+        key = _get_key(args, kwargs)
+        self.entries.pop(key, None)
+        while len(self.entries) >= MAX_HIT_CACHE_ENTRIES:
+            self.entries.popitem(last=False)
+
+        self.entries[key] = HitCacheEntry(
+            weakref.ref(mamo), epoch, args_refs, kwargs_refs, weakref.ref(result), vid, estimated_nomamo_call_duration,
+            code_dependencies
+        )
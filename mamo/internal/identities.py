@@ -2,10 +2,13 @@ from abc import ABC
 from dataclasses import dataclass
 from typing import Tuple, FrozenSet
 
+from mamo.internal.common.hash_consing import HashConsed
 from mamo.internal.fingerprints import Fingerprint, FingerprintName, FingerprintDigestRepr, FingerprintDigest
 
 
 class ValueIdentity:
+    __slots__ = ()
+
     def get_external_info(self):
         raise NotImplementedError()
 
@@ -41,12 +44,14 @@ class CellIdentity(FunctionIdentity):
 
 
 class ComputedValueIdentity(ValueIdentity, ABC):
-    pass
+    __slots__ = ()
 
 
 # TODO: merge this into CallIdentity?
-@dataclass(frozen=True)
-class ValueCallIdentity(ComputedValueIdentity):
+@dataclass(frozen=True, eq=False)
+class ValueCallIdentity(HashConsed, ComputedValueIdentity):
+    __slots__ = ("fid", "args_vid", "kwargs_vid")
+
     fid: FunctionIdentity
     args_vid: Tuple[ValueIdentity, ...]
     kwargs_vid: FrozenSet[Tuple[str, ValueIdentity]]
@@ -1,4 +1,5 @@
 from mamo.internal import reflection
+from mamo.internal.common.hash_consing import hash_cons
 
 from mamo.internal.identities import (
     ValueFingerprintIdentity,
@@ -20,7 +21,7 @@ class IdentityRegistry(IdentityProvider):
         args_vid = tuple(self.value_oracle.identify_value(arg) for arg in args)
         kwargs_vid = frozenset((name, self.value_oracle.identify_value(value)) for name, value in kwargs.items())
 
-        return ValueCallIdentity(fid, args_vid, kwargs_vid)
+        return hash_cons(ValueCallIdentity(fid, args_vid, kwargs_vid))
 
     def identify_cell_result(self, cell_identity: CellIdentity, key: str) -> ValueCellResultIdentity:
         return ValueCellResultIdentity(cell_identity, key)
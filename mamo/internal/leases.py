@@ -0,0 +1,107 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
+
+from mamo.internal.common.canonical_digest import canonical_digest
+from mamo.internal.identities import ValueIdentity
+
+# How long a process may compute a result before others stop waiting for it (in seconds).
+DEFAULT_LEASE_DURATION = 60 * 60.
+# How often we check whether a lease has been released or has expired (in seconds).
+LEASE_POLL_INTERVAL = 0.05
+LEASE_SUFFIX = ".lease"
+
+
+def supports_leases() -> bool:
+    return fcntl is not None
+
+
+class LeaseManager:
+    """
+    Coordinates the computation of results across processes with lease files in a shared directory.
+
+    A lease is an `fcntl` lock on a file named after the digest of the vid, so the OS releases it when the process that
+    holds it crashes. The file also records when the lease expires, and other processes stop waiting for it once it
+    has (e.g. when the holder hangs). `fcntl` locks are only reliable on local filesystems.
+    """
+
+    def __init__(self, path: str, duration: float = DEFAULT_LEASE_DURATION,
+                 poll_interval: float = LEASE_POLL_INTERVAL):
+        assert supports_leases()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.duration = duration
+        self.poll_interval = poll_interval
+
+    def get_lease_path(self, vid: ValueIdentity) -> str:
+        return os.path.join(self.path, canonical_digest(vid).hex() + LEASE_SUFFIX)
+
+    def try_acquire(self, vid: ValueIdentity) -> Optional[int]:
+        """Returns the file descriptor of the lease file if we got the lease and None otherwise."""
+        lease_path = self.get_lease_path(vid)
+        while True:
+            fd = os.open(lease_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+
+            # The previous holder might have removed the file after we opened it.
+            try:
+                is_current = os.fstat(fd).st_ino == os.stat(lease_path).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if is_current:
+                os.ftruncate(fd, 0)
+                os.write(fd, f"{time.time() + self.duration} {os.getpid()}".encode())
+                return fd
+            os.close(fd)
+
+    def release(self, vid: ValueIdentity, fd: int):
+        # Remove the file before unlocking it, so nobody locks a file that is about to be removed.
+        try:
+            os.unlink(self.get_lease_path(vid))
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    def get_expiry(self, vid: ValueIdentity) -> Optional[float]:
+        """Returns when the current lease expires (None if we can't tell, e.g. while it is being written)."""
+        try:
+            with open(self.get_lease_path(vid), "rb") as lease_file:
+                return float(lease_file.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @contextmanager
+    def lease(self, vid: ValueIdentity):
+        """
+        Holds the lease for `vid` within the context and waits for other processes to release it first.
+
+        Yields False if we stopped waiting for an expired lease (without holding it) and True otherwise.
+        """
+        while True:
+            fd = self.try_acquire(vid)
+            if fd is not None:
+                try:
+                    yield True
+                finally:
+                    self.release(vid, fd)
+                return
+
+            expiry = self.get_expiry(vid)
+            if expiry is not None and time.time() > expiry:
+                # TODO: log?
+                print(f"Lease for {vid} has expired!")
+                yield False
+                return
+
+            time.sleep(self.poll_interval)
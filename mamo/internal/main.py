@@ -1,10 +1,13 @@
 import ast
 import dataclasses
-from typing import Optional, List
+import threading
+from typing import Optional, List, Dict, Tuple, Union
 
 from functools import wraps
+from timeit import default_timer
 
-from mamo.internal.fingerprint_registry import FingerprintRegistry
+from mamo.internal.digests import DigestAlgorithm, set_digest_algorithm
+from mamo.internal.fingerprint_registry import FingerprintRegistry, CodeDependencies
 from mamo.internal.fingerprints import Fingerprint, CellResultFingerprint, ResultFingerprint
 from mamo.internal.identities import (
     ValueIdentity,
@@ -14,14 +17,18 @@ from mamo.internal.identities import (
     ValueCellResultIdentity)
 from mamo.internal.identity_registry import IdentityRegistry
 from mamo.internal.function_registry import FunctionRegistry
+from mamo.internal.hit_cache import HitCache
 from mamo.internal.module_extension import MODULE_EXTENSIONS
+from mamo.internal.persistence_policy import PersistencePolicy
 from mamo.internal.result_metadata import ResultMetadata
 from mamo.internal.result_registry import ResultRegistry
+from mamo.internal.common.single_flight import SingleFlight
 from mamo.internal.common.stopwatch_context import StopwatchContext
 from mamo.internal.value_provider_mediator import ValueProviderMediator
 from mamo.internal.value_registries import ValueRegistry
 from mamo.internal.staleness_registry import StalenessRegistry
 from mamo.internal.persisted_store import PersistedStore
+from mamo.internal import reflection
 
 from mamo.internal import default_module_extension
 
@@ -58,6 +65,23 @@ def execute_decision_stale(max_depth):
     return decider
 
 
+class CallDurationStacks(threading.local):
+    """
+    The summed durations of the memoized subcalls of the calls that are running in the current thread.
+
+    Each thread has its own stacks, so concurrent calls don't mix up their timings.
+    """
+
+    def __init__(self):
+        self.call_durations = [0.0]
+        self.nomamo_call_durations = [0.0]
+
+
+def _covers_depth(depth: int, other_depth: int):
+    """Whether checking up to `depth` includes checking up to `other_depth`. Negative depths are unlimited."""
+    return depth < 0 or (0 <= other_depth <= depth)
+
+
 class Mamo:
     fingerprint_registry: FingerprintRegistry
     identity_registry: IdentityRegistry
@@ -72,18 +96,22 @@ class Mamo:
 
     re_execution_policy: ReExecutionPolicy
 
-    _call_duration_stack: List
-    _nomamo_call_duration_stack: List
+    _call_duration_stacks: CallDurationStacks
+    # Calls that are being executed (so concurrent identical calls only execute once).
+    call_flights: SingleFlight[ComputedValueIdentity]
+
+    # Incremented when the persisted store is swapped.
+    _store_epoch: int
 
     def __init__(self, persisted_store, deep_fingerprint_source_prefix: Optional[str],
-                 re_execution_policy: Optional[ReExecutionPolicy]):
+                 re_execution_policy: Optional[ReExecutionPolicy], lazy_loading: bool = False):
         self.persisted_store = persisted_store
 
         self.value_provider_mediator = ValueProviderMediator()
 
         self.staleness_registry = StalenessRegistry()
         self.external_value_registry = ValueRegistry(self.staleness_registry)
-        self.result_registry = ResultRegistry(self.staleness_registry, persisted_store)
+        self.result_registry = ResultRegistry(self.staleness_registry, persisted_store, lazy_loading)
 
         self.function_registry = FunctionRegistry()
         self.fingerprint_registry = FingerprintRegistry(deep_fingerprint_source_prefix, self.value_provider_mediator,
@@ -95,13 +123,63 @@ class Mamo:
 
         self.re_execution_policy = re_execution_policy or execute_decision_stale(-1)
 
-        self._call_duration_stack = [0.0]
-        self._nomamo_call_duration_stack = [0.0]
+        self._call_duration_stacks = CallDurationStacks()
+        self.call_flights = SingleFlight()
+
+        self._store_epoch = 0
 
     def swap_persisted_store(self, new_persisted_store):
+        new_persisted_store.compression = self.persisted_store.compression
+        new_persisted_store.function_compression = self.persisted_store.function_compression
+        new_persisted_store.set_disk_budget(self.persisted_store.disk_budget, self.persisted_store.eviction_policy)
+        new_persisted_store.set_persistence_policy(self.persisted_store.persistence_policy)
+        if self.persisted_store.leases is not None and new_persisted_store.externally_cached_path is not None:
+            new_persisted_store.set_lease_duration(self.persisted_store.leases.duration)
         self.persisted_store.close()
         self.persisted_store = new_persisted_store
         self.result_registry.persisted_store = new_persisted_store
+        self._store_epoch += 1
+
+    def get_epoch(self) -> tuple:
+        """
+        Returns a token that changes whenever cached values, function identities or the re-execution policy change,
+        or all deep fingerprints are invalidated.
+
+        Changes to code are tracked by `CodeDependencies` instead.
+        """
+        return (
+            self.fingerprint_registry.code_epoch,
+            self.function_registry.epoch,
+            self.value_provider_mediator.epoch,
+            self._store_epoch,
+            self.re_execution_policy,
+        )
+
+    def _get_code_dependencies(self, vid: ComputedValueIdentity) -> Optional[CodeDependencies]:
+        """
+        Returns the code dependencies of the functions that computed `vid` and its ancestors.
+
+        Returns None if any of them is a cell result, as those depend on the user namespace.
+        """
+        funcs = []
+        visited = set()
+        pending = [vid]
+        while pending:
+            current = pending.pop()
+            if current in visited:
+                continue
+            visited.add(current)
+
+            if isinstance(current, ValueCallIdentity):
+                func = self.function_registry.resolve_function(current.fid)
+                if func is not None:
+                    funcs.append(func)
+                pending.extend(current.args_vid)
+                pending.extend(arg_vid for name, arg_vid in current.kwargs_vid)
+            elif isinstance(current, ComputedValueIdentity):
+                return None
+
+        return self.fingerprint_registry.get_code_dependencies(funcs)
 
     @property
     def deep_fingerprint_source_prefix(self):
@@ -154,11 +232,30 @@ class Mamo:
         return self.is_stale_vid(vid, depth=depth)
 
     def is_stale_vid(self, vid: Optional[ValueIdentity], *, depth):
+        # Shared ancestors in the computational graph are only checked once per check.
+        # (Cell results depend on the current user namespace, so we cannot keep results across checks.)
+        return self._is_stale_vid(vid, depth, {})
+
+    def _is_stale_vid(self, vid: Optional[ValueIdentity], depth, memo: Dict[ValueIdentity, Tuple[int, bool]]):
         if vid is None:
             return False
         if not isinstance(vid, ComputedValueIdentity):
             return False
 
+        cached = memo.get(vid)
+        if cached is not None:
+            cached_depth, cached_is_stale = cached
+            # Staleness is monotonic in the depth.
+            if cached_is_stale and _covers_depth(depth, cached_depth):
+                return True
+            if not cached_is_stale and _covers_depth(cached_depth, depth):
+                return False
+
+        is_stale = self._compute_is_stale_vid(vid, depth, memo)
+        memo[vid] = (depth, is_stale)
+        return is_stale
+
+    def _compute_is_stale_vid(self, vid: ComputedValueIdentity, depth, memo):
         fingerprint = self.fingerprint_registry.fingerprint_computed_value(vid)
         stored_fingerprint = self.value_provider_mediator.resolve_fingerprint(vid)
 
@@ -171,15 +268,16 @@ class Mamo:
             return False
 
         if isinstance(vid, ValueCallIdentity):
-            return any(self.is_stale_vid(arg_vid, depth=depth - 1) for arg_vid in vid.args_vid) or any(
-                self.is_stale_vid(arg_vid, depth=depth - 1) for name, arg_vid in vid.kwargs_vid
+            return any(self._is_stale_vid(arg_vid, depth - 1, memo) for arg_vid in vid.args_vid) or any(
+                self._is_stale_vid(arg_vid, depth - 1, memo) for name, arg_vid in vid.kwargs_vid
             )
         elif isinstance(vid, ValueCellResultIdentity):
             assert isinstance(fingerprint, CellResultFingerprint)
             return any(
-                self.is_stale_vid(input_vid, depth=depth - 1)
+                self._is_stale_vid(input_vid, depth - 1, memo)
                 for name, (input_vid, input_fingerprint) in fingerprint.cell.globals_load
             )
+        return False
 
     def is_cached_call(self, func, args, kwargs):
         fid = self.function_registry.identify_function(func)
@@ -221,10 +319,29 @@ class Mamo:
         stored_fingerprint = mamo.result_registry.resolve_fingerprint(vid)
         return stored_fingerprint is None or self.re_execution_policy(self, vid, fingerprint, stored_fingerprint)
 
+    def _record_call_duration(self, elapsed_time: float, estimated_nomamo_call_duration: float):
+        stacks = self._call_duration_stacks
+        stacks.call_durations[-1] += elapsed_time
+        stacks.nomamo_call_durations[-1] += estimated_nomamo_call_duration
+
     @staticmethod
     def wrap_function(func):
+        hit_cache = HitCache()
+
         @wraps(func)
         def wrapped_func(*args, **kwargs):
+            start_time = default_timer()
+
+            # Fast path for repeated calls with the same live arguments.
+            if mamo is not None:
+                wrapped_result, hit_cache_entry = hit_cache.lookup(mamo, args, kwargs)
+                if wrapped_result is not None:
+                    elapsed_time = default_timer() - start_time
+                    mamo.persisted_store.record_cache_hit(hit_cache_entry.vid, elapsed_time)
+                    mamo.result_registry.touch_value(wrapped_result)
+                    mamo._record_call_duration(elapsed_time, hit_cache_entry.estimated_nomamo_call_duration)
+                    return wrapped_result
+
             with StopwatchContext() as total_stopwatch:
                 nonlocal fid
 
@@ -237,34 +354,56 @@ class Mamo:
 
                     fid = mamo.function_registry.identify_function(func)
 
+                epoch = mamo.get_epoch()
                 vid = mamo.identity_registry.identify_call(fid, args, kwargs)
 
                 call_fingerprint = mamo.fingerprint_registry.fingerprint_call(func, args, kwargs)
-                result_metadata = mamo.persisted_store.get_result_metadata(vid)
-
-                if mamo._shall_execute(vid, call_fingerprint):
-                    mamo._call_duration_stack.append(0.)
-                    mamo._nomamo_call_duration_stack.append(0.)
-                    with StopwatchContext() as call_stopwatch:
-                        result = func(*args, **kwargs)
-                    wrapped_result = MODULE_EXTENSIONS.wrap_return_value(result)
-                    mamo.value_provider_mediator.add(vid, wrapped_result, call_fingerprint)
 
-                    result_metadata = mamo.persisted_store.get_result_metadata(vid)
-                    result_metadata.call_duration = call_stopwatch.elapsed_time
-                    result_metadata.subcall_duration = mamo._call_duration_stack.pop()
-                    result_metadata.estimated_nomamo_call_duration = result_metadata.call_duration - result_metadata.subcall_duration + mamo._nomamo_call_duration_stack.pop()
-                else:
+                executed = mamo._shall_execute(vid, call_fingerprint)
+                if executed:
+                    # Concurrent identical calls (also in other processes) wait for the first one and then use its
+                    # result.
+                    with mamo.call_flights.flight(vid), mamo.persisted_store.lease(vid):
+                        executed = mamo._shall_execute(vid, call_fingerprint)
+                        if executed:
+                            stacks = mamo._call_duration_stacks
+                            stacks.call_durations.append(0.)
+                            stacks.nomamo_call_durations.append(0.)
+                            try:
+                                with StopwatchContext() as call_stopwatch:
+                                    result = func(*args, **kwargs)
+                            finally:
+                                subcall_duration = stacks.call_durations.pop()
+                                nomamo_subcall_duration = stacks.nomamo_call_durations.pop()
+                            call_duration = call_stopwatch.elapsed_time
+                            wrapped_result = MODULE_EXTENSIONS.wrap_return_value(result)
+                            mamo.value_provider_mediator.add(vid, wrapped_result, call_fingerprint, call_duration)
+
+                            estimated_nomamo_call_duration = (
+                                call_duration - subcall_duration + nomamo_subcall_duration
+                            )
+
+                if not executed:
                     wrapped_result = mamo._get_value(vid)
                     if wrapped_result is None:
                         # log?
                         raise RuntimeError(f"Couldn't find cached result for {vid}!")
 
-                    result_metadata.num_cache_hits += 1
-
-            result_metadata.total_durations += total_stopwatch.elapsed_time
-            mamo._call_duration_stack[-1] += total_stopwatch.elapsed_time
-            mamo._nomamo_call_duration_stack[-1] += result_metadata.estimated_nomamo_call_duration
+                    result_metadata = mamo.persisted_store.get_result_metadata(vid)
+                    estimated_nomamo_call_duration = (
+                        result_metadata.estimated_nomamo_call_duration if result_metadata else 0.
+                    )
+                    code_dependencies = mamo._get_code_dependencies(vid) if result_metadata else None
+                    if code_dependencies is not None:
+                        hit_cache.add(mamo, epoch, args, kwargs, wrapped_result, vid, estimated_nomamo_call_duration,
+                                      code_dependencies)
+
+            if executed:
+                mamo.persisted_store.record_call(vid, call_duration, subcall_duration, estimated_nomamo_call_duration,
+                                                 total_stopwatch.elapsed_time)
+            else:
+                mamo.persisted_store.record_cache_hit(vid, total_stopwatch.elapsed_time)
+            mamo._record_call_duration(total_stopwatch.elapsed_time, estimated_nomamo_call_duration)
             return wrapped_result
 
         wrapped_func.mamo_unwrapped_func = func
@@ -373,6 +512,36 @@ class Mamo:
         vid = value_name_identity(unique_name)
         return self.value_provider_mediator.resolve_value(vid)
 
+    def set_compression(self, compression: Optional[str], func=None):
+        qualified_name = None
+        if func is not None:
+            func = getattr(func, "mamo_unwrapped_func", func)
+            qualified_name = reflection.get_func_qualified_name(func)
+        self.persisted_store.set_compression(compression, qualified_name)
+
+    def set_disk_budget(self, disk_budget: Optional[int], eviction_policy="cost_benefit"):
+        self.persisted_store.set_disk_budget(disk_budget, eviction_policy)
+
+    def set_memory_budget(self, memory_budget: Optional[int], eviction_policy="lru"):
+        self.result_registry.set_memory_budget(memory_budget, eviction_policy)
+
+    def set_persistence_policy(self, persistence_policy: Optional[PersistencePolicy]):
+        self.persisted_store.set_persistence_policy(persistence_policy)
+
+    def set_lease_duration(self, lease_duration: Optional[float]):
+        self.persisted_store.set_lease_duration(lease_duration)
+
+    def flush_metadata(self):
+        self.persisted_store.flush_metadata()
+
+    def flush_writes(self):
+        self.persisted_store.flush_writes()
+
+    def gc(self, background=False, pack=True):
+        if background:
+            return self.persisted_store.start_gc(pack)
+        return self.persisted_store.gc(pack)
+
     # noinspection PyTypeChecker
     def testing_close(self):
         self.persisted_store.close()
@@ -386,23 +555,69 @@ class Mamo:
 mamo: Optional[Mamo] = None
 
 
+def _create_persisted_store(memory_only: bool, path: Optional[str], externally_cached_path: Optional[str],
+                            max_pending_writes: Optional[int], server_address: Optional[str],
+                            read_only: bool) -> PersistedStore:
+    if server_address is not None:
+        return PersistedStore.from_server(server_address, externally_cached_path or path or "./", max_pending_writes,
+                                          read_only=read_only)
+    if memory_only:
+        if read_only:
+            raise ValueError("A memory-only store can't be read-only!")
+        return PersistedStore.from_memory(max_pending_writes)
+    return PersistedStore.from_file(path, externally_cached_path, max_pending_writes, read_only)
+
+
 def init_mamo(
         memory_only=True,
         path: Optional[str] = None,
         externally_cached_path: Optional[str] = None,
         # By default, we don't use deep fingerprints except in the main module/jupyter notebooks.
         deep_fingerprint_source_prefix: Optional[str] = None,
-        re_execution_policy: Optional[ReExecutionPolicy] = None
+        re_execution_policy: Optional[ReExecutionPolicy] = None,
+        # If not None, results are persisted in the background (see PersistedStore).
+        max_pending_writes: Optional[int] = None,
+        # If True, persisted results are only loaded on first access (see LazyResultProxy).
+        lazy_loading: bool = False,
+        # The id of a registered digest algorithm or a DigestAlgorithm (see digests.DIGEST_ALGORITHMS).
+        digest_algorithm: Union[str, DigestAlgorithm] = "md5",
+        # Compression for externally cached values: None, a codec id or "adaptive" (see cached_values.choose_codec).
+        compression: Optional[str] = None,
+        # If not None, we evict persisted results to stay within this many bytes (see PersistedStore.set_disk_budget).
+        disk_budget: Optional[int] = None,
+        # "cost_benefit", "lru" or "lfu" (see persisted_store.EVICTION_POLICIES).
+        eviction_policy: str = "cost_benefit",
+        # If not None, we only keep this many bytes of results in memory (see ResultRegistry.set_memory_budget).
+        memory_budget: Optional[int] = None,
+        # "lru" or "cost_benefit" (see online_cache.OnlineCache).
+        memory_eviction_policy: str = "lru",
+        # If not None, decides which results are worth persisting (e.g. persistence_policy.persist_if_worth_it()).
+        persistence_policy: Optional[PersistencePolicy] = None,
+        # If not None, processes that share the externally cached path execute each call only once
+        # (see PersistedStore.set_lease_duration).
+        lease_duration: Optional[float] = None,
+        # If not None, connect to the storage server at this address instead of opening the store in `path`
+        # (see store_server.start_store_server and PersistedStore.from_server).
+        server_address: Optional[str] = None,
+        # If True, open the store without locking it and never write to it, so many processes can read the results
+        # of a single writer (see PersistedStore.from_file).
+        read_only: bool = False
 ):
     global mamo
     assert mamo is None
 
-    new_persisted_store = (
-        PersistedStore.from_memory()
-        if memory_only
-        else PersistedStore.from_file(path, externally_cached_path)
-    )
-    mamo = Mamo(new_persisted_store, deep_fingerprint_source_prefix, re_execution_policy)
+    set_digest_algorithm(digest_algorithm)
+    # Cached digests might use a different algorithm.
+    MODULE_EXTENSIONS.clear_object_savers()
+
+    new_persisted_store = _create_persisted_store(memory_only, path, externally_cached_path, max_pending_writes,
+                                                  server_address, read_only)
+    mamo = Mamo(new_persisted_store, deep_fingerprint_source_prefix, re_execution_policy, lazy_loading)
+    mamo.set_compression(compression)
+    mamo.set_disk_budget(disk_budget, eviction_policy)
+    mamo.set_memory_budget(memory_budget, memory_eviction_policy)
+    mamo.set_persistence_policy(persistence_policy)
+    mamo.set_lease_duration(lease_duration)
 
 
 # TODO: add tests!
@@ -410,14 +625,14 @@ def init_mamo(
 def swap_storage(
     memory_only=True,
     path: Optional[str] = None,
-    externally_cached_path: Optional[str] = None
+    externally_cached_path: Optional[str] = None,
+    max_pending_writes: Optional[int] = None,
+    server_address: Optional[str] = None,
+    read_only: bool = False
 ):
     assert mamo is not None
 
-    new_persisted_store = (
-        PersistedStore.from_memory()
-        if memory_only
-        else PersistedStore.from_file(path, externally_cached_path)
-    )
+    new_persisted_store = _create_persisted_store(memory_only, path, externally_cached_path, max_pending_writes,
+                                                  server_address, read_only)
 
     mamo.swap_persisted_store(new_persisted_store)
@@ -1,8 +1,11 @@
+import threading
+import weakref
 from abc import ABC
 from dataclasses import dataclass, field
 from typing import Optional, Dict, TypeVar
 
 from mamo.internal.cached_values import ExternallyCachedFilePath, CachedValue
+from mamo.internal.common.weakref_utils import WeakKeyIdMap, supports_weakrefs
 from mamo.internal.fingerprints import FingerprintDigest, FingerprintDigestRepr, MAX_FINGERPRINT_VALUE_LENGTH
 from mamo.internal.reflection import get_module_name
 
@@ -17,6 +20,18 @@ class ObjectSaver(ABC):
         self.value = value
         self.digest = MISSING_DIGEST
 
+    @property
+    def value(self):
+        return self._value() if isinstance(self._value, weakref.ref) else self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    def hold_value_weakly(self):
+        """Cached ObjectSavers must not keep their values alive (see `ModuleRegistry.get_object_saver`)."""
+        self._value = weakref.ref(self._value)
+
     def get_estimated_size(self) -> Optional[int]:
         """Returns None if the size couldn't be estimated."""
         raise NotImplementedError()
@@ -31,6 +46,15 @@ class ObjectSaver(ABC):
 
         return self.digest
 
+    def compute_content_digest(self) -> Optional[bytes]:
+        """
+        Returns a digest of all of the content that we store (including its type and shape), so identical values can
+        share externally cached files (see `cache_deduplicated`). Returns None if the value shall not be deduplicated.
+
+        Unlike fingerprint digests, this must never be sampled.
+        """
+        return None
+
     def compute_fingerprint(self):
         """Returns None if the fingerprint couldn't be created."""
         digest = self.compute_digest()
@@ -68,6 +92,10 @@ class ModuleExtension:
 class ModuleRegistry:
     default_extension: ModuleExtension = None
     store: Dict[str, ModuleExtension] = field(default_factory=dict, init=False)
+    # ObjectSavers by value, so fingerprinting and persisting a value only pickles and digests it once.
+    object_savers: WeakKeyIdMap = field(default_factory=WeakKeyIdMap, init=False)
+    # Results are persisted from writer threads.
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
 
     def set_default_extension(self, handler: ModuleExtension):
         self.default_extension = handler
@@ -83,15 +111,28 @@ class ModuleRegistry:
         return extension
 
     def get_object_saver(self, value) -> ObjectSaver:
+        with self.lock:
+            object_saver = self.object_savers.get(value)
+        if object_saver is not None:
+            return object_saver
+
         extension = self.get(value)
-        object_saver = None
         if extension is not None and extension.supports(value):
             object_saver = extension.get_object_saver(value)
 
         if object_saver is None:
             object_saver = self.default_extension.get_object_saver(value)
+
+        if object_saver is not None and supports_weakrefs(value):
+            object_saver.hold_value_weakly()
+            with self.lock:
+                self.object_savers[value] = object_saver
         return object_saver
 
+    def clear_object_savers(self):
+        with self.lock:
+            self.object_savers.clear()
+
     def wrap_return_value(self, value):
         # We cannot really do anything about None sadly.
         # Why?
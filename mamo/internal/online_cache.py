@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from typing import MutableSet, TypeVar, Iterator, Callable, Optional, List
+
+T = TypeVar('T')
+T_co = TypeVar('T_co', covariant=True)  # Any type covariant containers.
+
+# Orders in which `OnlineCache` evicts values.
+ONLINE_EVICTION_POLICIES = ("lru", "cost_benefit")
+
+# When we evict, we evict down to this fraction of the memory budget, so we don't evict on every add.
+EVICTION_TARGET_FRACTION = 0.9
+
+
+class OnlineCache(MutableSet[T]):
+    """
+    An id set of values that keeps them alive, in least recently used order.
+
+    Without a memory budget, it behaves like an `IdSet`. With one, adding a value evicts other values until their
+    estimated sizes fit into the budget again. `lru` evicts the least recently added or touched values first,
+    `cost_benefit` the values with the lowest `get_score` (e.g. the reload cost per byte) first.
+    Values for which `can_evict` returns False are never evicted.
+    """
+    id_value: "OrderedDict[int, T]"
+    # Estimated sizes by id (only tracked with a memory budget).
+    id_size: dict
+
+    def __init__(self, estimate_size: Callable[[T], int], get_score: Callable[[T], float],
+                 can_evict: Callable[[T], bool]):
+        self.id_value = OrderedDict()
+        self.id_size = {}
+        self.total_size = 0
+
+        self.estimate_size = estimate_size
+        self.get_score = get_score
+        self.can_evict = can_evict
+
+        self.memory_budget: Optional[int] = None
+        self.eviction_policy = "lru"
+
+    def set_memory_budget(self, memory_budget: Optional[int], eviction_policy="lru"):
+        if eviction_policy not in ONLINE_EVICTION_POLICIES:
+            raise ValueError(
+                f"Unknown eviction policy {eviction_policy}! (Available: {', '.join(ONLINE_EVICTION_POLICIES)})")
+        self.memory_budget = memory_budget
+        self.eviction_policy = eviction_policy
+
+        self.id_size.clear()
+        self.total_size = 0
+        if memory_budget is not None:
+            for value in list(self):
+                self._track_size(value)
+            self.evict()
+
+    def _track_size(self, value: T):
+        size = self.id_size[id(value)] = self.estimate_size(value)
+        self.total_size += size
+
+    def add(self, x: T) -> None:
+        if x in self:
+            self.touch(x)
+            return
+
+        self.id_value[id(x)] = x
+        if self.memory_budget is not None:
+            self._track_size(x)
+            self.evict(keep=x)
+
+    def touch(self, x: T) -> None:
+        """Marks `x` as recently used."""
+        if x in self:
+            self.id_value.move_to_end(id(x))
+
+    def discard(self, x: T) -> None:
+        if x in self:
+            del self.id_value[id(x)]
+            self.total_size -= self.id_size.pop(id(x), 0)
+
+    def clear(self) -> None:
+        self.id_value.clear()
+        self.id_size.clear()
+        self.total_size = 0
+
+    def evict(self, keep: T = None) -> List[T]:
+        """Evicts values (except `keep`) until we are within the memory budget. Returns the evicted values."""
+        if self.memory_budget is None or self.total_size <= self.memory_budget:
+            return []
+
+        candidates = [value for value in self if value is not keep and self.can_evict(value)]
+        if self.eviction_policy == "cost_benefit":
+            # Stable, so ties are evicted in LRU order.
+            candidates.sort(key=self.get_score)
+
+        evicted = []
+        target_size = self.memory_budget * EVICTION_TARGET_FRACTION
+        for value in candidates:
+            if self.total_size <= target_size:
+                break
+            self.discard(value)
+            evicted.append(value)
+        return evicted
+
+    def __contains__(self, x: object) -> bool:
+        return id(x) in self.id_value
+
+    def __len__(self) -> int:
+        return len(self.id_value)
+
+    def __iter__(self) -> Iterator[T_co]:
+        return iter(self.id_value.values())
+
+    def __repr__(self):
+        return f"OnlineCache{{{ ', '.join(map(repr, self))}}}"
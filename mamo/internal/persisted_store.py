@@ -1,24 +1,118 @@
+import atexit
+import dataclasses
 import os
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional, Dict
+from timeit import default_timer
+from typing import Optional, Dict, Set, Tuple, Callable
 
 from ZODB import DB
 from ZODB.FileStorage.FileStorage import FileStorage
 from persistent import Persistent
 from persistent.mapping import PersistentMapping
+from ZODB.POSException import ConflictError, ReadOnlyError
 from transaction import TransactionManager
 
 from mamo.internal.common.bimap import PersistentBimap
-from mamo.internal.cached_values import CachedValue, ExternallyCachedFilePath
+from mamo.internal.common.digest_mapping import PersistentDigestMapping
+from mamo.internal.cached_values import (
+    CachedValue,
+    ExternallyCachedFilePath,
+    ExternallyCachedValue,
+    BlobStore,
+    ADAPTIVE_COMPRESSION,
+    cache_deduplicated,
+    get_codec,
+)
 from mamo.internal.fingerprints import Fingerprint
-from mamo.internal.identities import ValueIdentity
+from mamo.internal.identities import ValueIdentity, ValueCallIdentity
+from mamo.internal.leases import LeaseManager, supports_leases
 from mamo.internal.module_extension import MODULE_EXTENSIONS
-from mamo.internal.result_metadata import ResultMetadata
+from mamo.internal.persistence_policy import (
+    DurationModel,
+    PersistenceDecision,
+    PersistenceEstimate,
+    PersistencePolicy,
+    PERSIST,
+    NO_POLICY,
+    READ_ONLY_STORE,
+    UNKNOWN_CALL_DURATION,
+)
+from mamo.internal.result_metadata import ResultMetadata, ResultMetadataUpdate
+from mamo.internal.store_server import STORE_FILE_NAME
 from mamo.internal.common.stopwatch_context import StopwatchContext
+from mamo.internal.common.synchronized import synchronized
 from mamo.internal.common.weakref_utils import ObjectProxy
 
 MAX_DB_CACHED_VALUE_SIZE = 1024
 
+# Metadata updates (loads, cache hits and durations) are written to the DB at most every so many seconds.
+METADATA_FLUSH_INTERVAL = 30.
+
+# Number of threads that write results in write-behind mode.
+NUM_WRITER_THREADS = 2
+
+# Garbage collection only deletes unreferenced files that are at least this old (in seconds),
+# so we don't delete files of writes that are still in progress.
+MIN_ORPHAN_AGE = 10 * 60.
+
+# Externally cached files end with their external id (see `ExternallyCachedFilePath`), e.g. "_0000000042.pickle".
+_EXTERNAL_FILE_PATTERN = re.compile(r"_\d{10}(_\d+)*\.[^.]+$")
+UNLINKED_SUFFIX = ".unlinked"
+
+# Number of files that garbage collection deletes between checking for references.
+GC_BATCH_SIZE = 256
+
+# Eviction scores for results (see `PersistedStore.set_disk_budget`). We evict results with the lowest score first.
+EVICTION_POLICIES: Dict[str, Callable[[ResultMetadata], float]] = {
+    # Expected compute time saved per stored byte.
+    "cost_benefit": lambda metadata: (
+        metadata.estimated_nomamo_call_duration * metadata.num_calls / max(metadata.stored_size, 1)
+    ),
+    "lru": lambda metadata: metadata.last_access_time,
+    "lfu": lambda metadata: metadata.num_calls + metadata.num_loads,
+}
+
+# When we evict, we evict down to this fraction of the disk budget, so we don't evict on every add.
+EVICTION_TARGET_FRACTION = 0.9
+
+# Assumed save and load costs until we have observed some (see `persistence_policy.DurationModel`).
+DEFAULT_SAVE_OVERHEAD = 1e-3
+DEFAULT_SAVE_THROUGHPUT = 100 * (1 << 20)
+DEFAULT_LOAD_OVERHEAD = 5e-4
+DEFAULT_LOAD_THROUGHPUT = 200 * (1 << 20)
+
+# The directory for lease files in the externally cached path (see `PersistedStore.set_lease_duration`).
+LEASES_DIR_NAME = "leases"
+
+# Client stores (see `PersistedStore.from_server`):
+# The size of the per-client object cache of the storage server connection (in bytes).
+DEFAULT_CLIENT_CACHE_SIZE = 256 * (1 << 20)
+# How often reads process invalidations from other clients (in seconds). Misses always do.
+SYNC_INTERVAL = 1.
+# How many external ids a client reserves at once, so clients rarely conflict on the counter.
+EXTERNAL_ID_BLOCK_SIZE = 256
+# How often we retry transactions that conflict with other clients.
+MAX_COMMIT_ATTEMPTS = 5
+
+# How often read-only stores check whether the store file has changed and reopen it (in seconds).
+READ_ONLY_SYNC_INTERVAL = 5.
+
+# Stores whose pending writes and metadata updates we need to flush at exit.
+_OPEN_PERSISTED_STORES: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+
+@atexit.register
+def _flush_open_persisted_stores():
+    for persisted_store in list(_OPEN_PERSISTED_STORES.values()):
+        persisted_store.flush_writes()
+        persisted_store.flush_metadata()
+
 
 @dataclass
 class MamoPersistedCacheStorage(Persistent):
@@ -27,18 +121,52 @@ class MamoPersistedCacheStorage(Persistent):
     vid_to_fingerprint: Dict[ValueIdentity, Fingerprint]
     vid_to_result_metadata: Dict[ValueIdentity, ResultMetadata]
     tag_to_vid: PersistentBimap[str, ValueIdentity]
+    # Externally cached values by content digest (see `PersistedBlobStore`): digest -> (cached value, reference
+    # count). The counts include pending references of writes in progress, so other clients keep the blobs.
+    blobs: Dict[bytes, Tuple[ExternallyCachedValue, int]]
+    # The blobs that each (externally cached) result references.
+    vid_to_blob_digests: Dict[ValueIdentity, Tuple[bytes, ...]]
 
     def __init__(self):
-        self.vid_to_cached_value = PersistentMapping()
-        self.vid_to_fingerprint = PersistentMapping()
-        self.vid_to_result_metadata = PersistentMapping()
+        self.vid_to_cached_value = PersistentDigestMapping()
+        self.vid_to_fingerprint = PersistentDigestMapping()
+        self.vid_to_result_metadata = PersistentDigestMapping()
         self.tag_to_vid = PersistentBimap()
+        self.blobs = PersistentDigestMapping()
+        self.vid_to_blob_digests = PersistentDigestMapping()
         self.external_cache_id = 0
 
+    def needs_migration(self):
+        return isinstance(self.vid_to_cached_value, PersistentMapping) or not hasattr(self, "blobs")
+
+    def migrate(self):
+        """Converts `PersistentMapping`s from older stores into `PersistentDigestMapping`s and adds blobs."""
+        if isinstance(self.vid_to_cached_value, PersistentMapping):
+            self.vid_to_cached_value = PersistentDigestMapping(self.vid_to_cached_value.items())
+            self.vid_to_fingerprint = PersistentDigestMapping(self.vid_to_fingerprint.items())
+            self.vid_to_result_metadata = PersistentDigestMapping(self.vid_to_result_metadata.items())
+        if not hasattr(self, "blobs"):
+            # Existing externally cached values are not deduplicated.
+            self.blobs = PersistentDigestMapping()
+            self.vid_to_blob_digests = PersistentDigestMapping()
+
     def get_new_external_id(self):
+        return format_external_id(self.reserve_external_ids(1)[0])
+
+    def reserve_external_ids(self, num_ids: int) -> range:
         drawn_external_cache_id = self.external_cache_id
-        self.external_cache_id += 1
-        return f"{drawn_external_cache_id:010}"
+        self.external_cache_id += num_ids
+        return range(drawn_external_cache_id, self.external_cache_id)
+
+
+def format_external_id(external_id: int):
+    return f"{external_id:010}"
+
+
+def _get_file_state(file_path: str):
+    stat = os.stat(file_path)
+    # Packing replaces the file.
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
 
 
 @dataclass
@@ -47,6 +175,45 @@ class CacheOperationResult:
     result_size: int
     stored_size: int
     save_duration: float
+    # The stored size before compression.
+    raw_stored_size: Optional[int] = None
+    # The blobs that the cached value references (None if it is stored in the DB).
+    blob_digests: Optional[Tuple[bytes, ...]] = None
+
+
+class PersistedBlobStore(BlobStore):
+    """Deduplicates the externally cached values of a single result (see `PersistedStore.try_create_cached_value`)."""
+
+    def __init__(self, persisted_store: "PersistedStore"):
+        self.persisted_store = persisted_store
+        self.digests = []
+
+    def cache(self, digest: Optional[bytes], create):
+        cached_value = self.persisted_store.acquire_blob(digest) if digest is not None else None
+        if cached_value is None:
+            cached_value = create()
+            if not isinstance(cached_value, ExternallyCachedValue):
+                # Either failed or not a blob itself (like tuples of blobs).
+                return cached_value
+            if digest is None:
+                digest = b"path:" + cached_value.path.encode()
+            cached_value = self.persisted_store.register_blob(digest, cached_value)
+
+        self.digests.append(digest)
+        return cached_value
+
+
+@dataclass
+class GarbageCollectionReport:
+    num_unlinked_files: int = 0
+    num_orphaned_files: int = 0
+    num_unreferenced_blobs: int = 0
+    reclaimed_file_bytes: int = 0
+    reclaimed_db_bytes: int = 0
+
+    @property
+    def reclaimed_bytes(self):
+        return self.reclaimed_file_bytes + self.reclaimed_db_bytes
 
 
 # TODO: to repr method
@@ -57,14 +224,31 @@ class PersistedStore:
     db: DB
     path: str
     externally_cached_path: str
+    pending_metadata_updates: Dict[ValueIdentity, ResultMetadataUpdate]
+    last_metadata_flush_time: float
+
+    lock: threading.RLock
+    # Write-behind mode: results that are still being written (vid -> (value, fingerprint)).
+    pending_writes: Dict[ValueIdentity, Tuple[object, Fingerprint]]
+    pending_write_futures: Set[Future]
+    write_slots: Optional[threading.BoundedSemaphore]
+    writer: Optional[ThreadPoolExecutor]
 
     @staticmethod
-    def from_memory():
+    def from_memory(max_pending_writes: Optional[int] = None):
         db = DB(None, large_record_size=64*(1 << 20))
-        return PersistedStore(db, None, None)
+        return PersistedStore(db, None, None, max_pending_writes)
 
     @staticmethod
-    def from_file(path: Optional[str] = None, externally_cached_path: Optional[str] = None):
+    def from_file(path: Optional[str] = None, externally_cached_path: Optional[str] = None,
+                  max_pending_writes: Optional[int] = None, read_only=False):
+        """
+        Opens (or creates) the store in `path`.
+
+        A `read_only` store doesn't lock the DB file, so any number of processes can read it while a single process
+        writes to it. It sees the writer's commits when it refreshes (at most every `READ_ONLY_SYNC_INTERVAL` seconds
+        or with `sync`).
+        """
         if path is None:
             path = "./"
         if externally_cached_path is None:
@@ -77,32 +261,289 @@ class PersistedStore:
         # TODO: log the paths?
         # TODO: in general, make properties available for quering in the console/Jupyter?
 
-        db = DB(FileStorage(os.path.join(path, "mamo_store")))
-        return PersistedStore(db, path, externally_cached_path)
+        store_file_path = os.path.join(path, STORE_FILE_NAME)
+        if read_only:
+            if not os.path.exists(store_file_path):
+                raise ValueError(f"There is no store in {path} to open read-only!")
+            return PersistedStore(None, path, externally_cached_path, max_pending_writes, read_only=True)
 
-    def __init__(self, db: DB, path: Optional[str], externally_cached_path: Optional[str]):
-        self.db = db
+        db = DB(FileStorage(store_file_path))
+        return PersistedStore(db, path, externally_cached_path, max_pending_writes)
+
+    @staticmethod
+    def from_server(address: str, externally_cached_path: str, max_pending_writes: Optional[int] = None,
+                    cache_size: int = DEFAULT_CLIENT_CACHE_SIZE, read_only=False):
+        """
+        Connects to a storage server (see `store_server.start_store_server`) that owns the DB.
+
+        Many processes can connect to the same server. Each keeps a single connection with its own object cache of
+        `cache_size` bytes, and the server sends it invalidations when other clients commit changes. Externally
+        cached values are read from and written to `externally_cached_path` directly, so all clients need to share it.
+        `read_only` clients never write.
+        """
+        from ZEO.ClientStorage import ClientStorage
+
+        os.makedirs(externally_cached_path, exist_ok=True)
+        # With `server_sync`, beginning a transaction waits for outstanding invalidations, so `sync` makes all prior
+        # commits visible. We only begin transactions to write or to sync (see `SYNC_INTERVAL`), not to read.
+        db = DB(ClientStorage(address, cache_size=cache_size, server_sync=True, read_only=read_only))
+        return PersistedStore(db, None, externally_cached_path, max_pending_writes, shared=True, read_only=read_only)
+
+    def __init__(self, db: Optional[DB], path: Optional[str], externally_cached_path: Optional[str],
+                 max_pending_writes: Optional[int] = None, shared=False, read_only=False):
+        """
+        If `max_pending_writes` is not None, results are written by background threads (write-behind), and `add`
+        blocks when that many writes are pending. Use `flush_writes` to wait for all pending writes.
+
+        `shared` stores have other clients that change the DB concurrently (see `from_server`).
+
+        `read_only` stores never write to the DB: results that are added are only kept in memory, and metadata updates
+        are not flushed. Without a `db`, we open the store file in `path` read-only (see `from_file`).
+        """
         self.path = os.path.abspath(path) if path else path
         self.externally_cached_path = (
             os.path.abspath(externally_cached_path) if externally_cached_path else externally_cached_path
         )
         self.transaction_manager = TransactionManager()
+        self.shared = shared
+        self.read_only = read_only
+        self.sync_interval = READ_ONLY_SYNC_INTERVAL if read_only and not shared else SYNC_INTERVAL
+        self.last_sync_time = default_timer()
+        # External ids that we have reserved but not used yet (only for shared stores).
+        self.reserved_external_ids = []
 
-        connection = db.open(self.transaction_manager)
-        root = connection.root
+        # The state of the store file when we opened it (only for read-only stores that we open ourselves).
+        self.store_file_state = None
+        self._open(db)
 
-        if not hasattr(root, "storage"):
-            with self.transaction_manager:
+        self.pending_metadata_updates = {}
+        self.last_metadata_flush_time = default_timer()
+
+        # See `set_disk_budget`.
+        self.disk_budget = None
+        self.eviction_policy = "cost_benefit"
+        # Sum of the stored sizes of all results (computed lazily).
+        self.total_stored_size = None
+        # Results that must not be evicted (vid -> count, see `pin_vid`).
+        self.pinned_vids: Dict[ValueIdentity, int] = {}
+
+        # See `set_persistence_policy`.
+        self.persistence_policy: Optional[PersistencePolicy] = None
+        self.save_duration_model = DurationModel(DEFAULT_SAVE_OVERHEAD, DEFAULT_SAVE_THROUGHPUT)
+        self.load_duration_model = DurationModel(DEFAULT_LOAD_OVERHEAD, DEFAULT_LOAD_THROUGHPUT)
+        # Metadata of results that we decided not to persist (only for this session).
+        self.unpersisted_result_metadata: Dict[ValueIdentity, ResultMetadata] = {}
+
+        # See `set_lease_duration`.
+        self.leases: Optional[LeaseManager] = None
+
+        # Runs `gc` in the background.
+        self.gc_executor = None
+
+        # References to blobs that are being written but have not been added yet (digest -> count).
+        self.pending_blob_refs = {}
+        # Cached values to unlink once the current transaction has been committed (see `_commit_with_retries`).
+        self.unlinks_after_commit = []
+
+        # See `cached_values.choose_codec`.
+        self.compression = None
+        # Compression settings by qualified function name (overriding `compression`).
+        self.function_compression = {}
+
+        # Serializes access to the DB connection, which is shared with the writer threads.
+        self.lock = threading.RLock()
+        self.pending_writes = {}
+        self.pending_write_futures = set()
+        if max_pending_writes is not None:
+            self.write_slots = threading.BoundedSemaphore(max_pending_writes)
+            self.writer = ThreadPoolExecutor(NUM_WRITER_THREADS, thread_name_prefix="mamo_writer")
+        else:
+            self.write_slots = None
+            self.writer = None
+
+        _OPEN_PERSISTED_STORES[id(self)] = self
+
+    def _open(self, db: Optional[DB]):
+        if db is None:
+            # Take the state first, so we reopen if the writer commits while we open the file.
+            store_file_path = os.path.join(self.path, STORE_FILE_NAME)
+            self.store_file_state = _get_file_state(store_file_path)
+            db = DB(FileStorage(store_file_path, read_only=True))
+
+        self.db = db
+        self.connection = db.open(self.transaction_manager)
+        root = self.connection.root
+
+        def create_storage():
+            # Another client might have created it in the meantime.
+            if not hasattr(root, "storage"):
                 root.storage = MamoPersistedCacheStorage()
 
+        if not hasattr(root, "storage"):
+            if self.read_only:
+                raise ValueError(f"{db.storage.getName()} is empty and can't be initialized read-only!")
+            self._commit_with_retries(create_storage)
+
         self.storage = root.storage
+        if self.storage.needs_migration():
+            if self.read_only:
+                raise RuntimeError(f"{db.storage.getName()} needs to be migrated by opening it writable first!")
+            # TODO: log?
+            with self.transaction_manager:
+                self.storage.migrate()
+
+    def _reopen_if_changed(self):
+        """A read-only `FileStorage` doesn't see commits of other processes, so we reopen it when the file changes."""
+        if _get_file_state(os.path.join(self.path, STORE_FILE_NAME)) == self.store_file_state:
+            return
+
+        self.connection.close()
+        self.db.close()
+        self._open(None)
+        self.total_stored_size = None
 
     def close(self):
+        self.flush_writes()
+        if self.writer is not None:
+            self.writer.shutdown()
+        if self.gc_executor is not None:
+            self.gc_executor.shutdown()
+        self.flush_metadata()
+        _OPEN_PERSISTED_STORES.pop(id(self), None)
         self.db.close()
         self.transaction_manager.clearSynchs()
 
+    def _commit_with_retries(self, func: Callable[[], object]):
+        """
+        Runs `func` in a transaction and retries it when it conflicts with another client. Needs the lock.
+
+        Retries start from the latest committed state, so `func` has to read what it changes. It must not have other
+        side effects: it defers unlinking cached values (see `_unlink_after_commit`), which we do after the commit.
+        """
+        for i, attempt in enumerate(self.transaction_manager.attempts(MAX_COMMIT_ATTEMPTS)):
+            with attempt:
+                self.unlinks_after_commit = []
+                if i > 0:
+                    # The previous attempt has changed it.
+                    self.total_stored_size = None
+                result = func()
+
+        unlinks_after_commit, self.unlinks_after_commit = self.unlinks_after_commit, []
+        for cached_value in unlinks_after_commit:
+            cached_value.unlink()
+        return result
+
+    def _unlink_after_commit(self, cached_value: CachedValue):
+        self.unlinks_after_commit.append(cached_value)
+
+    @synchronized
     def get_new_external_id(self):
-        return self.storage.get_new_external_id()
+        # Commit right away: blobs are registered in separate transactions before the result is added.
+        if not self.shared:
+            with self.transaction_manager:
+                return self.storage.get_new_external_id()
+
+        if not self.reserved_external_ids:
+            external_ids = self._commit_with_retries(
+                lambda: self.storage.reserve_external_ids(EXTERNAL_ID_BLOCK_SIZE))
+            self.reserved_external_ids = list(reversed(external_ids))
+        return format_external_id(self.reserved_external_ids.pop())
+
+    @synchronized
+    def set_disk_budget(self, disk_budget: Optional[int], eviction_policy="cost_benefit"):
+        """
+        Bounds the total stored size of results (in bytes). When adding a result would exceed it, we evict results
+        with the lowest score under `eviction_policy` (see `EVICTION_POLICIES`). Tagged and pinned results are never
+        evicted.
+        """
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {eviction_policy}! (Available: {', '.join(EVICTION_POLICIES)})")
+        self.disk_budget = disk_budget
+        self.eviction_policy = eviction_policy
+
+    @synchronized
+    def pin_vid(self, vid: ValueIdentity):
+        """Keeps the result from being evicted until it is unpinned (e.g. while it still needs to be loaded)."""
+        self.pinned_vids[vid] = self.pinned_vids.get(vid, 0) + 1
+
+    @synchronized
+    def unpin_vid(self, vid: ValueIdentity):
+        self.pinned_vids[vid] -= 1
+        if self.pinned_vids[vid] == 0:
+            del self.pinned_vids[vid]
+
+    def _get_total_stored_size(self):
+        # Other clients change it, too.
+        if self.total_stored_size is None or self.shared:
+            self.total_stored_size = sum(metadata.stored_size
+                                         for metadata in self.storage.vid_to_result_metadata.values())
+        return self.total_stored_size
+
+    def _update_total_stored_size(self, delta: int):
+        if self.total_stored_size is not None:
+            self.total_stored_size += delta
+
+    def _evict_for(self, vid: ValueIdentity, stored_size: int):
+        """Evicts results until `stored_size` more bytes fit into the disk budget. Needs the lock and a transaction."""
+        if self.disk_budget is None or self._get_total_stored_size() + stored_size <= self.disk_budget:
+            return
+
+        # Rank with up-to-date metadata (unless a conflict with another client might make us retry).
+        if not self.shared:
+            self._apply_metadata_updates()
+
+        score = EVICTION_POLICIES[self.eviction_policy]
+        candidates = sorted(
+            (candidate_vid
+             for candidate_vid in self.storage.vid_to_result_metadata
+             if candidate_vid != vid and candidate_vid not in self.pinned_vids
+             and self.storage.tag_to_vid.get_key(candidate_vid) is None),
+            key=lambda candidate_vid: score(self.storage.vid_to_result_metadata[candidate_vid]),
+        )
+        target_size = self.disk_budget * EVICTION_TARGET_FRACTION - stored_size
+        for candidate_vid in candidates:
+            if self._get_total_stored_size() <= target_size:
+                break
+            self._remove_vid(candidate_vid)
+
+    def set_persistence_policy(self, persistence_policy: Optional[PersistencePolicy]):
+        """
+        Decides whether results that are added with a call duration are persisted, kept in memory only or not cached
+        (e.g. `persistence_policy.persist_if_worth_it()`). Without a policy, we persist all results.
+        """
+        self.persistence_policy = persistence_policy
+
+    def _decide_persistence(self, value, call_duration: Optional[float]) -> Tuple[PersistenceDecision, Optional[int]]:
+        """Returns the decision and the estimated size of the value."""
+        if self.persistence_policy is None:
+            return NO_POLICY, None
+        if call_duration is None:
+            return UNKNOWN_CALL_DURATION, None
+
+        object_saver = MODULE_EXTENSIONS.get_object_saver(value)
+        estimated_size = object_saver.get_estimated_size() if object_saver is not None else None
+        predicted_save_duration = predicted_load_duration = None
+        if estimated_size is not None:
+            with self.lock:
+                predicted_save_duration = self.save_duration_model.predict(estimated_size)
+                predicted_load_duration = self.load_duration_model.predict(estimated_size)
+
+        estimate = PersistenceEstimate(call_duration, estimated_size, predicted_save_duration, predicted_load_duration)
+        return self.persistence_policy(estimate), estimated_size
+
+    def set_compression(self, compression: Optional[str], qualified_name: Optional[str] = None):
+        if compression is not None and compression != ADAPTIVE_COMPRESSION:
+            get_codec(compression)
+
+        if qualified_name is None:
+            self.compression = compression
+        else:
+            self.function_compression[qualified_name] = compression
+
+    def get_compression(self, vid: ValueIdentity) -> Optional[str]:
+        if isinstance(vid, ValueCallIdentity):
+            return self.function_compression.get(vid.fid.qualified_name, self.compression)
+        return self.compression
 
     def try_create_cached_value(
             self, vid: ValueIdentity, value: object
@@ -124,99 +565,592 @@ class PersistedStore:
             # However, if we are memory-only, we don't cache in external files.
             if estimated_size > MAX_DB_CACHED_VALUE_SIZE and self.externally_cached_path is not None:
                 external_path_builder = ExternallyCachedFilePath(
-                    self.externally_cached_path, self.get_new_external_id(), vid.get_external_info()
+                    self.externally_cached_path, self.get_new_external_id(), vid.get_external_info(),
+                    self.get_compression(vid), PersistedBlobStore(self)
                 )
 
-            cached_value = object_saver.cache_value(external_path_builder)
+            cached_value = cache_deduplicated(object_saver, external_path_builder)
+            blob_digests = tuple(external_path_builder.blob_store.digests) if external_path_builder else None
             if not cached_value:
+                if blob_digests:
+                    self.release_pending_blobs(blob_digests)
                 return None
 
             stored_size = cached_value.get_stored_size()
+            raw_stored_size = cached_value.get_raw_size()
 
         return CacheOperationResult(cached_value=cached_value, result_size=estimated_size, stored_size=stored_size,
-                                    save_duration=stopwatch.elapsed_time)
+                                    save_duration=stopwatch.elapsed_time, raw_stored_size=raw_stored_size,
+                                    blob_digests=blob_digests)
+
+    @synchronized
+    def acquire_blob(self, digest: bytes) -> Optional[ExternallyCachedValue]:
+        """Returns the blob for `digest` (if any) and adds a pending reference to it."""
+        def acquire():
+            entry = self.storage.blobs.get(digest)
+            if entry is None:
+                return None
+            cached_value, ref_count = entry
+            self.storage.blobs[digest] = (cached_value, ref_count + 1)
+            return cached_value
+
+        cached_value = self._commit_with_retries(acquire)
+        if cached_value is not None:
+            self._add_pending_blob_ref(digest)
+        return cached_value
+
+    @synchronized
+    def register_blob(self, digest: bytes, cached_value: ExternallyCachedValue) -> ExternallyCachedValue:
+        """Adds a new blob with a pending reference (or returns the existing one if another write was faster)."""
+        def register():
+            entry = self.storage.blobs.get(digest)
+            if entry is None:
+                self.storage.blobs[digest] = (cached_value, 1)
+                return cached_value
+            existing_cached_value, ref_count = entry
+            self.storage.blobs[digest] = (existing_cached_value, ref_count + 1)
+            return existing_cached_value
+
+        registered_cached_value = self._commit_with_retries(register)
+        if registered_cached_value is not cached_value:
+            cached_value.unlink()
+        self._add_pending_blob_ref(digest)
+        return registered_cached_value
+
+    @synchronized
+    def release_pending_blobs(self, digests: Tuple[bytes, ...]):
+        self._commit_with_retries(lambda: self._release_blobs(digests))
+        for digest in digests:
+            self._drop_pending_blob_ref(digest)
+
+    def _release_blobs(self, digests: Tuple[bytes, ...]):
+        """Drops references and unlinks blobs that are not referenced anymore. Needs a transaction."""
+        for digest in digests:
+            cached_value, ref_count = self.storage.blobs[digest]
+            ref_count -= 1
+            if ref_count == 0:
+                del self.storage.blobs[digest]
+                self._unlink_after_commit(cached_value)
+            else:
+                self.storage.blobs[digest] = (cached_value, ref_count)
+
+    def _add_pending_blob_ref(self, digest: bytes):
+        self.pending_blob_refs[digest] = self.pending_blob_refs.get(digest, 0) + 1
+
+    def _drop_pending_blob_ref(self, digest: bytes):
+        self.pending_blob_refs[digest] -= 1
+        if self.pending_blob_refs[digest] == 0:
+            del self.pending_blob_refs[digest]
 
-    def add(self, vid: ValueIdentity, value: object, fingerprint: Fingerprint):
+    def _unlink_cached_value(self, vid: ValueIdentity, cached_value: CachedValue):
+        blob_digests = self.storage.vid_to_blob_digests.pop(vid, None)
+        if blob_digests is not None:
+            self._release_blobs(blob_digests)
+        else:
+            self._unlink_after_commit(cached_value)
+
+    def _discard(self, result: CacheOperationResult):
+        """Unlinks a cached value that we won't add after all. Needs the lock."""
+        if result.blob_digests is not None:
+            self.release_pending_blobs(result.blob_digests)
+        else:
+            result.cached_value.unlink()
+
+    def add(self, vid: ValueIdentity, value: object, fingerprint: Fingerprint,
+            call_duration: Optional[float] = None) -> PersistenceDecision:
+        """
+        Persists the value unless the persistence policy decides against it (given how long the call took).
+
+        Returns the decision, which is also recorded in the result's metadata.
+        """
         assert value is not None
 
-        with self.transaction_manager:
-            existing_cached_value = self.storage.vid_to_cached_value.get(vid)
-            if existing_cached_value:
-                # assert isinstance(existing_cached_value, CachedValue)
-                # TODO: add test cases for unlinking!!!
-                existing_cached_value.unlink()
+        # Unwrap object proxy
+        if isinstance(value, ObjectProxy):
+            value = value.__subject__
+
+        decision, estimated_size = self._decide_persistence(value, call_duration)
+        if self.read_only:
+            decision = READ_ONLY_STORE
+
+        with self.lock:
+            # Drop metadata updates for the previous value.
+            self.pending_metadata_updates.pop(vid, None)
+            self.unpersisted_result_metadata.pop(vid, None)
+
+        if decision.action != PERSIST:
+            # Don't load a previous result instead.
+            self.remove_vid(vid)
+            with self.lock:
+                self.unpersisted_result_metadata[vid] = ResultMetadata(result_size=estimated_size or 0,
+                                                                       stored_size=0,
+                                                                       save_duration=0.,
+                                                                       last_access_time=time.time(),
+                                                                       persistence=decision.action,
+                                                                       persistence_reason=decision.reason)
+            return decision
+
+        if self.writer is None:
+            self._write(vid, value, fingerprint, decision)
+            return decision
+
+        # Back-pressure: wait until there is a free slot.
+        self.write_slots.acquire()
+        pending_write = (value, fingerprint)
+        with self.lock:
+            self.pending_writes[vid] = pending_write
+            future = self.writer.submit(self._write_pending, vid, pending_write, decision)
+            self.pending_write_futures.add(future)
+        future.add_done_callback(self._on_write_done)
+        return decision
 
-            # TODO: logic to decide whether to store the value at all or not depending
-            # on computational budget.
+    def _on_write_done(self, future: Future):
+        with self.lock:
+            self.pending_write_futures.discard(future)
+        self.write_slots.release()
 
-            # Unwrap object proxy
-            if isinstance(value, ObjectProxy):
-                value = value.__subject__
+    def _write_pending(self, vid: ValueIdentity, pending_write, decision: PersistenceDecision):
+        try:
+            value, fingerprint = pending_write
+            self._write(vid, value, fingerprint, decision, pending_write)
+        except Exception as error:
+            # TODO: log?
+            print(f"Failed to persist {vid}: {error}")
+            with self.lock:
+                if self.pending_writes.get(vid) is pending_write:
+                    del self.pending_writes[vid]
+
+    def _write(self, vid: ValueIdentity, value: object, fingerprint: Fingerprint,
+               decision: PersistenceDecision = NO_POLICY, pending_write=None):
+        # Serialize outside of the lock, so the DB stays available while we write large results.
+        result = self.try_create_cached_value(vid, value)
+
+        with self.lock:
+            if pending_write is not None:
+                if self.pending_writes.get(vid) is not pending_write:
+                    # The vid has been removed or added again in the meantime.
+                    if result:
+                        self._discard(result)
+                    return
+                del self.pending_writes[vid]
+
+            try:
+                self._commit_with_retries(lambda: self._write_result(vid, fingerprint, decision, result))
+            except ConflictError as error:
+                # TODO: log?
+                print(f"Failed to persist {vid}: {error}")
+                if result:
+                    self._discard(result)
+                return
 
-            result = self.try_create_cached_value(vid, value)
             if result:
-                self.storage.vid_to_cached_value[vid] = result.cached_value
-                self.storage.vid_to_fingerprint[vid] = fingerprint
+                # The pending references are references of the result now.
+                for digest in result.blob_digests or ():
+                    self._drop_pending_blob_ref(digest)
+                self.save_duration_model.observe(result.result_size, result.save_duration)
 
-                result_metadata = ResultMetadata(result_size=result.result_size,
-                                                 stored_size=result.stored_size,
-                                                 save_duration=result.save_duration)
-                self.storage.vid_to_result_metadata[vid] = result_metadata
-            else:
-                # TODO: log? result is None means caching has failed!
-                if existing_cached_value:
-                    del self.storage.vid_to_cached_value[vid]
-                    del self.storage.vid_to_fingerprint[vid]
-                    del self.storage.vid_to_result_metadata[vid]
+    def _write_result(self, vid: ValueIdentity, fingerprint: Fingerprint, decision: PersistenceDecision,
+                      result: Optional[CacheOperationResult]):
+        """Needs the lock and a transaction."""
+        existing_cached_value = self.storage.vid_to_cached_value.get(vid)
+        existing_blob_digests = self.storage.vid_to_blob_digests.pop(vid, None)
 
-    def remove_vid(self, vid: ValueIdentity):
-        value = self.storage.vid_to_cached_value.get(vid)
-        if value is not None:
+        # The blobs of the new value have pending references, so we keep blobs that it shares with the existing one.
+        if result and result.blob_digests is not None:
+            self.storage.vid_to_blob_digests[vid] = result.blob_digests
+
+        if existing_blob_digests is not None:
+            self._release_blobs(existing_blob_digests)
+        elif existing_cached_value:
+            # assert isinstance(existing_cached_value, CachedValue)
             # TODO: add test cases for unlinking!!!
-            with self.transaction_manager:
+            self._unlink_after_commit(existing_cached_value)
+
+        existing_metadata = self.storage.vid_to_result_metadata.get(vid)
+        if existing_metadata is not None:
+            self._update_total_stored_size(-existing_metadata.stored_size)
+
+        if result:
+            self._evict_for(vid, result.stored_size)
+
+            self.storage.vid_to_cached_value[vid] = result.cached_value
+            self.storage.vid_to_fingerprint[vid] = fingerprint
+
+            result_metadata = ResultMetadata(result_size=result.result_size,
+                                             stored_size=result.stored_size,
+                                             save_duration=result.save_duration,
+                                             raw_stored_size=result.raw_stored_size,
+                                             last_access_time=time.time(),
+                                             persistence=decision.action,
+                                             persistence_reason=decision.reason)
+            self.storage.vid_to_result_metadata[vid] = result_metadata
+            self._update_total_stored_size(result.stored_size)
+        else:
+            # TODO: log? result is None means caching has failed!
+            if existing_cached_value:
                 del self.storage.vid_to_cached_value[vid]
                 del self.storage.vid_to_fingerprint[vid]
                 del self.storage.vid_to_result_metadata[vid]
-                value.unlink()
 
+        # Piggyback pending metadata updates on this transaction (unless other clients might update the
+        # same metadata and make the write conflict).
+        if not self.shared:
+            self._apply_metadata_updates()
+
+    def set_lease_duration(self, lease_duration: Optional[float]):
+        """
+        Coordinates executing calls with other processes that share the externally cached path (see `lease`).
+
+        Other processes stop waiting for a lease after `lease_duration` seconds. None disables leases.
+        """
+        if lease_duration is None:
+            self.leases = None
+            return
+        if self.externally_cached_path is None:
+            raise ValueError("Leases need a persisted store with an externally cached path!")
+        if not supports_leases():
+            raise RuntimeError("Leases need fcntl, which is not available on this platform!")
+        self.leases = LeaseManager(os.path.join(self.externally_cached_path, LEASES_DIR_NAME), lease_duration)
+
+    @contextmanager
+    def lease(self, vid: ValueIdentity):
+        """
+        Holds the cross-process lease for computing `vid` (if leases are enabled).
+
+        Waits for other processes that compute `vid` and makes their results visible. The result of the computation
+        within the context is written before we release the lease, so waiting processes can load it.
+        """
+        if self.leases is None:
+            yield
+            return
+
+        with self.leases.lease(vid):
+            # Another process might have persisted the result while we waited.
+            self.sync()
+            try:
+                yield
+            finally:
+                if self.has_pending_write(vid):
+                    self.flush_writes()
+
+    @synchronized
+    def sync(self):
+        """Makes changes that other processes have committed visible."""
+        if self.store_file_state is not None:
+            self._reopen_if_changed()
+        else:
+            # Beginning a transaction processes the invalidations of our connection.
+            self.transaction_manager.begin()
+            self.transaction_manager.abort()
+        self.last_sync_time = default_timer()
+
+    def _maybe_sync(self):
+        """Syncs every so often (only for shared and read-only stores). Needs the lock."""
+        if (self.shared or self.read_only) and default_timer() - self.last_sync_time > self.sync_interval:
+            self.sync()
+
+    @synchronized
+    def has_pending_write(self, vid: ValueIdentity):
+        return vid in self.pending_writes
+
+    def flush_writes(self):
+        """Waits until all pending writes have been committed."""
+        while True:
+            with self.lock:
+                futures = list(self.pending_write_futures)
+            if not futures:
+                return
+            wait(futures)
+
+    def gc(self, pack=True, min_orphan_age=MIN_ORPHAN_AGE) -> GarbageCollectionReport:
+        """
+        Deletes unlinked and orphaned external files (and unreferenced blobs) and packs the DB.
+
+        Only holds the lock for short periods, so it can run in the background (see `start_gc`).
+        """
+        if self.read_only:
+            # We might not see the files of recent writes.
+            raise ReadOnlyError("Can't collect garbage in a read-only store!")
+
+        report = GarbageCollectionReport()
+        start_time = time.time()
+
+        self._collect_unreferenced_blobs(report)
+
+        if self.externally_cached_path is not None:
+            candidates = []
+            for file_name in os.listdir(self.externally_cached_path):
+                if file_name.endswith(UNLINKED_SUFFIX) or _EXTERNAL_FILE_PATTERN.search(file_name):
+                    candidates.append(os.path.join(self.externally_cached_path, file_name))
+
+            for i in range(0, len(candidates), GC_BATCH_SIZE):
+                referenced_paths = self._get_referenced_paths()
+                for file_path in candidates[i:i + GC_BATCH_SIZE]:
+                    self._collect_file(file_path, referenced_paths, start_time - min_orphan_age, report)
+
+        if pack:
+            size_before = self.db.getSize()
+            self.db.pack()
+            report.reclaimed_db_bytes = max(size_before - self.db.getSize(), 0)
+
+        return report
+
+    def start_gc(self, pack=True, min_orphan_age=MIN_ORPHAN_AGE) -> Future:
+        """Runs `gc` in a background thread. The future's result is the `GarbageCollectionReport`."""
+        with self.lock:
+            if self.gc_executor is None:
+                self.gc_executor = ThreadPoolExecutor(1, thread_name_prefix="mamo_gc")
+            return self.gc_executor.submit(self.gc, pack, min_orphan_age)
+
+    @synchronized
+    def _collect_unreferenced_blobs(self, report: GarbageCollectionReport):
+        def collect():
+            # Only we write to unshared stores, so we can recount the references. This drops pending references of
+            # writes that never finished (e.g. because the process crashed). We can't see other clients' pending
+            # references, though.
+            ref_counts = None if self.shared else self._count_blob_refs()
+            num_unreferenced_blobs = 0
+            for digest, (cached_value, ref_count) in list(self.storage.blobs.items()):
+                if ref_counts is not None and ref_counts.get(digest, 0) != ref_count:
+                    ref_count = ref_counts.get(digest, 0)
+                    self.storage.blobs[digest] = (cached_value, ref_count)
+                if ref_count == 0:
+                    del self.storage.blobs[digest]
+                    self._unlink_after_commit(cached_value)
+                    num_unreferenced_blobs += 1
+            return num_unreferenced_blobs
+
+        report.num_unreferenced_blobs += self._commit_with_retries(collect)
+
+    def _count_blob_refs(self) -> Dict[bytes, int]:
+        ref_counts = dict(self.pending_blob_refs)
+        for digests in self.storage.vid_to_blob_digests.values():
+            for digest in digests:
+                ref_counts[digest] = ref_counts.get(digest, 0) + 1
+        return ref_counts
+
+    @synchronized
+    def _get_referenced_paths(self) -> Set[str]:
+        if self.shared:
+            # Don't miss the files of results that other clients have added since we last synced.
+            self.sync()
+        referenced_paths = set()
+        for cached_value in self.storage.vid_to_cached_value.values():
+            referenced_paths.update(map(os.path.abspath, cached_value.get_external_paths()))
+        for cached_value, _ in self.storage.blobs.values():
+            referenced_paths.update(map(os.path.abspath, cached_value.get_external_paths()))
+        return referenced_paths
+
+    @staticmethod
+    def _collect_file(file_path: str, referenced_paths: Set[str], max_orphan_mtime: float,
+                      report: GarbageCollectionReport):
+        try:
+            stat = os.stat(file_path)
+            if file_path.endswith(UNLINKED_SUFFIX):
+                os.remove(file_path)
+                report.num_unlinked_files += 1
+            elif os.path.abspath(file_path) not in referenced_paths and stat.st_mtime < max_orphan_mtime:
+                os.remove(file_path)
+                report.num_orphaned_files += 1
+            else:
+                return
+        except FileNotFoundError:
+            return
+        report.reclaimed_file_bytes += stat.st_size
+
+    @synchronized
+    def remove_vid(self, vid: ValueIdentity):
+        self.pending_metadata_updates.pop(vid, None)
+        self.unpersisted_result_metadata.pop(vid, None)
+        # A pending write will notice that it has been superseded.
+        self.pending_writes.pop(vid, None)
+        if self.read_only:
+            return
+
+        def remove():
+            # Another client might have added it since we last synced.
+            if vid in self.storage.vid_to_cached_value:
+                # TODO: add test cases for unlinking!!!
+                self._remove_vid(vid)
+
+        self._commit_with_retries(remove)
+
+    def _remove_vid(self, vid: ValueIdentity):
+        """Needs the lock and a transaction."""
+        self.pending_metadata_updates.pop(vid, None)
+        value = self.storage.vid_to_cached_value.pop(vid)
+        del self.storage.vid_to_fingerprint[vid]
+        metadata = self.storage.vid_to_result_metadata.pop(vid)
+        self._update_total_stored_size(-metadata.stored_size)
+        self._unlink_cached_value(vid, value)
+
+    @synchronized
     def get_vids(self):
-        return set(self.storage.vid_to_cached_value.keys())
+        return set(self.storage.vid_to_cached_value.keys()) | set(self.pending_writes)
 
+    @synchronized
     def get_cached_value(self, vid: ValueIdentity):
         return self.storage.vid_to_cached_value.get(vid)
 
     def load_value(self, vid: ValueIdentity):
-        cached_value = self.get_cached_value(vid)
+        with self.lock:
+            pending_write = self.pending_writes.get(vid)
+            if pending_write is not None:
+                value, fingerprint = pending_write
+                return value
+
+            cached_value = self.storage.vid_to_cached_value.get(vid)
         if not cached_value:
             return None
 
         # Load value
         with StopwatchContext() as stopwatch:
-            loaded_value = cached_value.load()
+            try:
+                loaded_value = cached_value.load()
+            except FileNotFoundError:
+                if not (self.shared or self.read_only):
+                    raise
+                # Another process has replaced or evicted the result since we last synced.
+                self.sync()
+                cached_value = self.get_cached_value(vid)
+                if not cached_value:
+                    return None
+                loaded_value = cached_value.load()
             wrapped_value = MODULE_EXTENSIONS.wrap_return_value(loaded_value)
 
-        metadata = self.get_result_metadata(vid)
-        with self.transaction_manager:
-            metadata.total_load_durations += stopwatch.elapsed_time
-            metadata.num_loads += 1
+        self.record_load(vid, stopwatch.elapsed_time)
 
         return wrapped_value
 
+    @synchronized
     def get_fingerprint(self, vid: ValueIdentity) -> Fingerprint:
-        return self.storage.vid_to_fingerprint.get(vid)
+        pending_write = self.pending_writes.get(vid)
+        if pending_write is not None:
+            value, fingerprint = pending_write
+            return fingerprint
+
+        self._maybe_sync()
+        fingerprint = self.storage.vid_to_fingerprint.get(vid)
+        if fingerprint is None and self.shared:
+            # Another client might have just added it, and a miss is about to be expensive anyway.
+            self.sync()
+            fingerprint = self.storage.vid_to_fingerprint.get(vid)
+        return fingerprint
+
+    @synchronized
+    def get_result_metadata(self, vid: ValueIdentity) -> Optional[ResultMetadata]:
+        """Returns a copy of the metadata that includes pending updates (None while the result is being written)."""
+        # Read-only stores keep newer results in memory only.
+        metadata = self.unpersisted_result_metadata.get(vid) or self.storage.vid_to_result_metadata.get(vid)
+        if metadata is None:
+            return None
+
+        update = self.pending_metadata_updates.get(vid)
+        if update is None:
+            return dataclasses.replace(metadata)
+        return update.apply(metadata)
+
+    def _get_metadata_update(self, vid: ValueIdentity) -> ResultMetadataUpdate:
+        update = self.pending_metadata_updates.get(vid)
+        if update is None:
+            update = self.pending_metadata_updates[vid] = ResultMetadataUpdate()
+        return update
+
+    def _maybe_flush_metadata(self):
+        if default_timer() - self.last_metadata_flush_time > METADATA_FLUSH_INTERVAL:
+            self.flush_metadata()
+
+    @synchronized
+    def record_load(self, vid: ValueIdentity, load_duration: float):
+        update = self._get_metadata_update(vid)
+        update.total_load_durations += load_duration
+        update.num_loads += 1
+        update.last_access_time = time.time()
+        metadata = self.storage.vid_to_result_metadata.get(vid)
+        if metadata is not None:
+            self.load_duration_model.observe(metadata.result_size, load_duration)
+        self._maybe_flush_metadata()
+
+    @synchronized
+    def record_cache_hit(self, vid: ValueIdentity, total_duration: float):
+        update = self._get_metadata_update(vid)
+        update.num_cache_hits += 1
+        update.last_access_time = time.time()
+        update.total_durations += total_duration
+        self._maybe_flush_metadata()
+
+    @synchronized
+    def record_call(self, vid: ValueIdentity, call_duration: float, subcall_duration: float,
+                    estimated_nomamo_call_duration: float, total_duration: float):
+        update = self._get_metadata_update(vid)
+        update.call_duration = call_duration
+        update.subcall_duration = subcall_duration
+        update.estimated_nomamo_call_duration = estimated_nomamo_call_duration
+        update.last_access_time = time.time()
+        update.total_durations += total_duration
+        self._maybe_flush_metadata()
+
+    def _apply_metadata_updates(self):
+        vid_to_result_metadata = self.storage.vid_to_result_metadata
+        for vid, update in list(self.pending_metadata_updates.items()):
+            # Keep updates for results that are still being written.
+            if vid in self.pending_writes:
+                continue
+            metadata = vid_to_result_metadata.get(vid)
+            # The value might not have been cached.
+            if metadata is not None:
+                vid_to_result_metadata[vid] = update.apply(metadata)
+            elif vid in self.unpersisted_result_metadata:
+                self.unpersisted_result_metadata[vid] = update.apply(self.unpersisted_result_metadata[vid])
+            del self.pending_metadata_updates[vid]
+        self.last_metadata_flush_time = default_timer()
+
+    @synchronized
+    def flush_metadata(self):
+        """Writes pending metadata updates to the DB in a single transaction."""
+        if not self.pending_metadata_updates or self.read_only:
+            # Read-only stores keep their updates in memory (see `get_result_metadata`).
+            self.last_metadata_flush_time = default_timer()
+            return
+
+        if not self.shared:
+            with self.transaction_manager:
+                self._apply_metadata_updates()
+            return
+
+        # Retries apply the updates to the metadata that the conflicting client has committed. (Updates of
+        # unpersisted results are applied in memory by the first attempt already.)
+        pending_metadata_updates = {vid: update for vid, update in self.pending_metadata_updates.items()
+                                    if vid not in self.unpersisted_result_metadata}
+
+        def apply_metadata_updates():
+            self.pending_metadata_updates.update(pending_metadata_updates)
+            self._apply_metadata_updates()
 
-    def get_result_metadata(self, vid: ValueIdentity) -> ResultMetadata:
-        return self.storage.vid_to_result_metadata.get(vid)
+        try:
+            self._commit_with_retries(apply_metadata_updates)
+        except Exception as error:
+            # TODO: log?
+            print(f"Failed to flush metadata: {error}")
+            self.pending_metadata_updates.update(pending_metadata_updates)
 
+    @synchronized
     def tag(self, tag_name: str, vid: Optional[ValueIdentity]):
-        with self.transaction_manager:
-            self.storage.tag_to_vid.update(tag_name, vid)
+        if self.read_only:
+            raise ReadOnlyError(f"Can't tag {vid} as {tag_name} in a read-only store!")
+        self._commit_with_retries(lambda: self.storage.tag_to_vid.update(tag_name, vid))
 
+    @synchronized
     def get_tag_vid(self, tag_name) -> Optional[ValueIdentity]:
         return self.storage.tag_to_vid.get_value(tag_name)
 
+    @synchronized
     def get_tag_name(self, vid: ValueIdentity) -> Optional[str]:
         return self.storage.tag_to_vid.get_key(vid)
 
+    @synchronized
     def has_vid(self, vid):
+        if vid in self.pending_writes:
+            return True
+        self._maybe_sync()
         return vid in self.storage.vid_to_cached_value
@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+# Persistence actions (see `PersistenceDecision`).
+# Persist the result, so it can be loaded instead of recomputed.
+PERSIST = "persist"
+# Keep the result in memory, but don't persist it.
+MEMORY_ONLY = "memory_only"
+# Don't keep the result alive at all (we still identify it while it is referenced elsewhere).
+DONT_CACHE = "dont_cache"
+
+
+@dataclass(frozen=True)
+class PersistenceDecision:
+    action: str
+    reason: str
+
+
+NO_POLICY = PersistenceDecision(PERSIST, "no persistence policy")
+UNKNOWN_CALL_DURATION = PersistenceDecision(PERSIST, "unknown call duration")
+UNKNOWN_SIZE = PersistenceDecision(PERSIST, "unknown result size")
+READ_ONLY_STORE = PersistenceDecision(MEMORY_ONLY, "read-only store")
+
+
+@dataclass
+class PersistenceEstimate:
+    call_duration: float
+    estimated_size: Optional[int]
+    # Both None if the size is unknown.
+    predicted_save_duration: Optional[float]
+    predicted_load_duration: Optional[float]
+
+
+# Decides whether and how to cache a result.
+PersistencePolicy = Callable[[PersistenceEstimate], PersistenceDecision]
+
+
+def persist_if_worth_it(expected_reuses=1, max_memory_only_size=64 * (1 << 20)) -> PersistencePolicy:
+    """
+    Persists results whose recomputation is slower than loading them, once the time saved over `expected_reuses`
+    reuses pays for saving them. Other results are kept in memory only, or not cached at all if their estimated size
+    exceeds `max_memory_only_size`.
+    """
+    def policy(estimate: PersistenceEstimate) -> PersistenceDecision:
+        if estimate.estimated_size is None:
+            return UNKNOWN_SIZE
+
+        call_duration = estimate.call_duration
+        save_duration = estimate.predicted_save_duration
+        load_duration = estimate.predicted_load_duration
+        saved_duration = (call_duration - load_duration) * expected_reuses
+        if saved_duration >= save_duration:
+            return PersistenceDecision(
+                PERSIST,
+                f"call ({call_duration:.3g}s) is slower than loading (~{load_duration:.3g}s) and saving "
+                f"(~{save_duration:.3g}s) pays off")
+
+        reason = (f"call ({call_duration:.3g}s) is too fast to pay off loading (~{load_duration:.3g}s) and saving "
+                  f"(~{save_duration:.3g}s)")
+        if estimate.estimated_size > max_memory_only_size:
+            return PersistenceDecision(DONT_CACHE, f"{reason} and the result is too large to keep in memory")
+        return PersistenceDecision(MEMORY_ONLY, reason)
+
+    return policy
+
+
+@dataclass
+class DurationModel:
+    """
+    Predicts save or load durations from result sizes as a fixed overhead plus size over throughput.
+
+    We fit both to the observed durations (least squares) and fall back to the defaults until we can.
+    """
+    default_overhead: float
+    # In bytes per second.
+    default_throughput: float
+
+    num_observations: int = 0
+    sum_sizes: float = 0
+    sum_durations: float = 0
+    sum_squared_sizes: float = 0
+    sum_size_durations: float = 0
+
+    def observe(self, size: int, duration: float):
+        self.num_observations += 1
+        self.sum_sizes += size
+        self.sum_durations += duration
+        self.sum_squared_sizes += size * size
+        self.sum_size_durations += size * duration
+
+    def predict(self, size: int) -> float:
+        overhead = self.default_overhead
+        seconds_per_byte = 1 / self.default_throughput
+
+        n = self.num_observations
+        if n > 0:
+            variance = n * self.sum_squared_sizes - self.sum_sizes ** 2
+            if variance > 0:
+                slope = (n * self.sum_size_durations - self.sum_sizes * self.sum_durations) / variance
+            else:
+                slope = 0
+            if slope > 0:
+                seconds_per_byte = slope
+            # Attribute what the throughput doesn't explain to the overhead.
+            overhead = max((self.sum_durations - seconds_per_byte * self.sum_sizes) / n, 0.)
+
+        return overhead + size * seconds_per_byte
@@ -1,5 +1,4 @@
 import dis
-import hashlib
 import inspect
 import marshal
 from dataclasses import dataclass
@@ -9,6 +8,8 @@ import builtins
 # Bytecode-extracted features. Independent of runtime and can be cached.
 from typing import FrozenSet, Tuple, Optional, List, Set
 
+from mamo.internal.digests import compute_digest
+
 
 @dataclass(frozen=True)
 class FunctionDependencies:
@@ -175,10 +176,8 @@ class CodeAnalyzer:
 
 def get_code_object_fingerprint(code_object: CodeType):
     # TODO: add cache?
-    hash_method = hashlib.md5(code_object.co_code)
     # This seems to only output stable objects for version==2!
-    hash_method.update(marshal.dumps(code_object.co_consts, 2))
-    return hash_method.digest()
+    return compute_digest(code_object.co_code, marshal.dumps(code_object.co_consts, 2))
 
 
 def get_func_fingerprint(func: FunctionType):
@@ -1,4 +1,8 @@
+import dataclasses
 from dataclasses import dataclass
+from typing import Optional
+
+from mamo.internal.persistence_policy import PERSIST
 
 
 @dataclass
@@ -18,6 +22,16 @@ class ResultMetadata:
 
     estimated_nomamo_call_duration: float = 0
 
+    # The stored size before compression (None for results stored before we tracked it).
+    raw_stored_size: Optional[int] = None
+
+    # Wall-clock time (time.time()) of the last call, hit or load.
+    last_access_time: float = 0
+
+    # How we cached the result and why (see `persistence_policy.PersistenceDecision`).
+    persistence: str = PERSIST
+    persistence_reason: Optional[str] = None
+
     @property
     def avg_total_duration(self):
         return self.total_durations / self.num_calls
@@ -37,3 +51,36 @@ class ResultMetadata:
     @property
     def num_calls(self):
         return self.num_cache_hits + 1
+
+
+@dataclass
+class ResultMetadataUpdate:
+    """Pending changes to a `ResultMetadata` that have not been written to the persisted store yet."""
+
+    total_load_durations: float = 0
+    num_loads: int = 0
+
+    num_cache_hits: int = 0
+    total_durations: float = 0
+
+    call_duration: Optional[float] = None
+    subcall_duration: Optional[float] = None
+    estimated_nomamo_call_duration: Optional[float] = None
+
+    last_access_time: float = 0
+
+    def apply(self, metadata: ResultMetadata) -> ResultMetadata:
+        changes = dict(
+            total_load_durations=metadata.total_load_durations + self.total_load_durations,
+            num_loads=metadata.num_loads + self.num_loads,
+            num_cache_hits=metadata.num_cache_hits + self.num_cache_hits,
+            total_durations=metadata.total_durations + self.total_durations,
+            last_access_time=max(metadata.last_access_time, self.last_access_time),
+        )
+        if self.call_duration is not None:
+            changes.update(
+                call_duration=self.call_duration,
+                subcall_duration=self.subcall_duration,
+                estimated_nomamo_call_duration=self.estimated_nomamo_call_duration,
+            )
+        return dataclasses.replace(metadata, **changes)
@@ -1,6 +1,15 @@
+import sys
+import threading
+import weakref
+from typing import Optional
+
 from mamo.internal.delayed_interruption_context import delayed_interruption
 from mamo.internal.fingerprints import Fingerprint, ResultFingerprint
-from mamo.internal.common.id_set import IdSet
+from mamo.internal.common.synchronized import synchronized
+from mamo.internal.common.weakref_utils import LazyProxy, ObjectProxy, is_loaded
+from mamo.internal.module_extension import MODULE_EXTENSIONS
+from mamo.internal.online_cache import OnlineCache
+from mamo.internal.persistence_policy import PERSIST, DONT_CACHE
 from mamo.internal.providers import ValueProvider
 from mamo.internal.staleness_registry import StalenessRegistry
 from mamo.internal.value_registries import WeakValueRegistry
@@ -8,16 +17,47 @@ from mamo.internal.identities import ValueIdentity, ComputedValueIdentity
 from mamo.internal.persisted_store import PersistedStore
 
 
+class LazyResultProxy(LazyProxy):
+    """
+    A persisted result that is only loaded on first access.
+
+    Mamo identifies and fingerprints the proxy itself, so it can be passed to other memoized functions without loading
+    it. Use `get_lazy_vid` and `get_lazy_fingerprint` instead of attribute access, which loads the result.
+    """
+    __slots__ = ("mamo_vid", "mamo_fingerprint")
+
+    def __init__(self, func, vid: ComputedValueIdentity, fingerprint: ResultFingerprint):
+        super().__init__(func)
+        object.__setattr__(self, "mamo_vid", vid)
+        object.__setattr__(self, "mamo_fingerprint", fingerprint)
+
+
+def get_lazy_vid(proxy: LazyResultProxy) -> ComputedValueIdentity:
+    return object.__getattribute__(proxy, "mamo_vid")
+
+
+def get_lazy_fingerprint(proxy: LazyResultProxy) -> ResultFingerprint:
+    return object.__getattribute__(proxy, "mamo_fingerprint")
+
+
 class ResultRegistry(ValueProvider):
-    values: IdSet
+    # Keeps results alive (within an optional memory budget). Evicted results can be reloaded from the persisted store.
+    values: OnlineCache
     online_registry: WeakValueRegistry
     persisted_store: PersistedStore
-
-    def __init__(self, staleness_registry: StalenessRegistry, persisted_cache: PersistedStore):
-        self.values = IdSet()
+    # Whether to resolve persisted results as `LazyResultProxy`s.
+    lazy_loading: bool
+    # Guards `values` and keeps the online registry consistent with it.
+    lock: threading.RLock
+
+    def __init__(self, staleness_registry: StalenessRegistry, persisted_cache: PersistedStore,
+                 lazy_loading: bool = False):
+        self.values = OnlineCache(self._estimate_size, self._get_reload_cost_per_byte, self._can_evict)
         self.online_registry = WeakValueRegistry(staleness_registry)
 
         self.persisted_store = persisted_cache
+        self.lazy_loading = lazy_loading
+        self.lock = threading.RLock()
 
     def identify_value(self, value) -> ValueIdentity:
         return self.online_registry.identify_value(value)
@@ -28,13 +68,70 @@ class ResultRegistry(ValueProvider):
     def get_vids(self):
         return self.online_registry.get_vids()
 
+    @synchronized
+    def set_memory_budget(self, memory_budget: Optional[int], eviction_policy="lru"):
+        """
+        Bounds the estimated size of the results we keep alive (in bytes).
+
+        `eviction_policy` is "lru" or "cost_benefit" (the estimated reload duration per byte). Evicted results stay
+        identified as long as they are referenced elsewhere and are reloaded from the persisted store otherwise.
+        Results that are still to be persisted are never evicted.
+        """
+        self.values.set_memory_budget(memory_budget, eviction_policy)
+
+    def _estimate_size(self, value) -> int:
+        vid = get_lazy_vid(value) if isinstance(value, LazyResultProxy) else self.identify_value(value)
+        result_metadata = self.persisted_store.get_result_metadata(vid) if vid is not None else None
+        if result_metadata is not None and result_metadata.result_size:
+            return result_metadata.result_size
+        if isinstance(value, LazyResultProxy) and not is_loaded(value):
+            return 0
+
+        # `PersistedStore.add` asks for the saver of the subject, too, so we share it (see `get_object_saver`).
+        if isinstance(value, ObjectProxy):
+            value = value.__subject__
+        object_saver = MODULE_EXTENSIONS.get_object_saver(value)
+        estimated_size = object_saver.get_estimated_size() if object_saver is not None else None
+        if estimated_size is None:
+            # TODO: log?
+            estimated_size = sys.getsizeof(value)
+        return estimated_size
+
+    def _get_reload_cost_per_byte(self, value) -> float:
+        result_metadata = self.persisted_store.get_result_metadata(self.identify_value(value))
+        if result_metadata is None:
+            return 0.
+        # Until a result has been loaded once, saving it is our best guess.
+        reload_duration = (
+            result_metadata.avg_load_duration if result_metadata.num_loads else result_metadata.save_duration
+        )
+        return reload_duration * result_metadata.num_calls / max(result_metadata.result_size, 1)
+
+    def _can_evict(self, value) -> bool:
+        vid = self.identify_value(value)
+        if vid is None:
+            return False
+        if self.persisted_store.has_vid(vid):
+            return True
+        # Results that we decided not to persist are cheap to recompute.
+        result_metadata = self.persisted_store.get_result_metadata(vid)
+        return result_metadata is not None and result_metadata.persistence != PERSIST
+
+    @synchronized
+    def touch_value(self, value):
+        """Marks a result as recently used."""
+        self.values.touch(value)
+
+    @synchronized
     def flush(self):
         self.values.clear()
 
+    @synchronized
     def flush_value(self, value):
         self.values.remove(value)
 
-    def add(self, vid: ComputedValueIdentity, value, fingerprint: ResultFingerprint):
+    def add(self, vid: ComputedValueIdentity, value, fingerprint: ResultFingerprint,
+            call_duration: Optional[float] = None):
         assert isinstance(vid, ComputedValueIdentity)
         assert isinstance(fingerprint, ResultFingerprint)
         assert value is not None
@@ -43,15 +140,19 @@ class ResultRegistry(ValueProvider):
         if existing_value is value:
             return
 
-        self.persisted_store.add(vid, value, fingerprint)
+        # Persist without holding the lock, so other threads can resolve results in the meantime.
+        decision = self.persisted_store.add(vid, value, fingerprint, call_duration)
 
-        with delayed_interruption():
+        with self.lock, delayed_interruption():
+            existing_value = self.online_registry.resolve_value(vid)
             if existing_value is not None:
                 self.values.discard(existing_value)
 
             self.online_registry.add(vid, value, fingerprint)
-            self.values.add(value)
+            if decision.action != DONT_CACHE:
+                self.values.add(value)
 
+    @synchronized
     def remove_vid(self, vid: ValueIdentity):
         assert isinstance(vid, ComputedValueIdentity)
 
@@ -64,6 +165,7 @@ class ResultRegistry(ValueProvider):
 
             self.persisted_store.remove_vid(vid)
 
+    @synchronized
     @delayed_interruption()
     def remove_value(self, value: object):
         if not self.has_value(value):
@@ -74,14 +176,42 @@ class ResultRegistry(ValueProvider):
         self.online_registry.remove_value(value)
 
     # TODO: rename to something that makes clear it might be very expensive!!
+    @synchronized
     def resolve_value(self, vid: ComputedValueIdentity):
         value = self.online_registry.resolve_value(vid)
-        if value is None and self.persisted_store.has_vid(vid):
-            value = self.persisted_store.load_value(vid)
+        if value is not None:
+            self.values.touch(value)
+        elif self.persisted_store.has_vid(vid):
             fingerprint = self.persisted_store.get_fingerprint(vid)
-            self.values.add(value)
+            if self.lazy_loading:
+                value = self._create_lazy_proxy(vid, fingerprint)
+            else:
+                value = self.persisted_store.load_value(vid)
+            # Register the value first, so we can estimate its size from its metadata.
             self.online_registry.add(vid, value, fingerprint)
+            self.values.add(value)
+
+        return value
 
+    def _create_lazy_proxy(self, vid: ComputedValueIdentity, fingerprint: ResultFingerprint) -> LazyResultProxy:
+        # Don't evict the result before the proxy has loaded it (or is gone).
+        self.persisted_store.pin_vid(vid)
+
+        def load():
+            try:
+                return self._load_lazily(vid)
+            finally:
+                unpin()
+
+        proxy = LazyResultProxy(load, vid, fingerprint)
+        unpin = weakref.finalize(proxy, self.persisted_store.unpin_vid, vid)
+        return proxy
+
+    def _load_lazily(self, vid: ComputedValueIdentity):
+        value = self.persisted_store.load_value(vid)
+        if value is None:
+            # log?
+            raise RuntimeError(f"Couldn't load cached result for {vid}!")
         return value
 
     def resolve_fingerprint(self, vid: ComputedValueIdentity):
@@ -1,3 +1,6 @@
+import threading
+
+from mamo.internal.common.synchronized import synchronized
 from mamo.internal.common.weakref_utils import WeakIdSet, supports_weakrefs
 
 
@@ -12,11 +15,14 @@ class StalenessRegistry:
     def __init__(self):
         super().__init__()
         self.stale_values = WeakIdSet()
+        self.lock = threading.Lock()
 
+    @synchronized
     def mark_stale(self, value):
         if supports_weakrefs(value):
             self.stale_values.add(value)
 
+    @synchronized
     def mark_used(self, value):
         if supports_weakrefs(value):
             self.stale_values.discard(value)
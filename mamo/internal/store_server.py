@@ -0,0 +1,48 @@
+import os
+import sys
+from typing import Optional, Tuple, Callable
+
+# The file name of the store DB (see `PersistedStore.from_file`).
+STORE_FILE_NAME = "mamo_store"
+# The unix socket that the store server listens on by default (in the store path).
+SOCKET_FILE_NAME = "mamo_store.sock"
+
+
+def get_default_address(path: str) -> str:
+    return os.path.abspath(os.path.join(path, SOCKET_FILE_NAME))
+
+
+def _prepare(path: str, address: Optional[str]) -> Tuple[str, str]:
+    os.makedirs(path, exist_ok=True)
+    if address is None:
+        address = get_default_address(path)
+    return os.path.abspath(os.path.join(path, STORE_FILE_NAME)), address
+
+
+def start_store_server(path: str, address: Optional[str] = None) -> Tuple[str, Callable[[], None]]:
+    """
+    Starts a ZEO server for the store in `path` in a background thread of this process.
+
+    The server owns the DB file, and clients connect to it over the unix socket at `address` (see
+    `PersistedStore.from_server`). Returns the address and a function that stops the server.
+    """
+    import ZEO
+
+    storage_path, address = _prepare(path, address)
+    _, stop = ZEO.server(path=storage_path, port=address, threaded=True)
+    return address, stop
+
+
+def serve(path: str, address: Optional[str] = None):
+    """Runs a ZEO server for the store in `path` until it is interrupted (see `start_store_server`)."""
+    from ZEO import runzeo
+
+    storage_path, address = _prepare(path, address)
+    # TODO: log?
+    print(f"Serving {storage_path} on {address}")
+    runzeo.main(["-f", storage_path, "-a", address])
+
+
+if __name__ == "__main__":
+    # python -m mamo.internal.store_server <path> [<address>]
+    serve(*sys.argv[1:3])
@@ -1,3 +1,4 @@
+import threading
 from typing import Optional, Set
 
 from mamo.internal.fingerprints import Fingerprint
@@ -11,6 +12,11 @@ class ValueProviderMediator(ValueProvider):
     result_provider: ValueProvider
     external_value_provider: ValueProvider
 
+    # Incremented whenever a value is added or removed.
+    epoch: int
+    # Guards `epoch` (the registries have their own locks).
+    lock: threading.Lock
+
     def init(self, identity_provider: IdentityProvider,
              fingerprint_provider: FingerprintProvider,
              result_provider: ValueProvider,
@@ -19,6 +25,12 @@ class ValueProviderMediator(ValueProvider):
         self.identity_provider = identity_provider
         self.result_provider = result_provider
         self.external_value_provider = external_value_provider
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def _increment_epoch(self):
+        with self.lock:
+            self.epoch += 1
 
     def identify_value(self, value) -> ValueIdentity:
         return (self.external_value_provider.identify_value(value) or self.result_provider.identify_value(
@@ -40,7 +52,7 @@ class ValueProviderMediator(ValueProvider):
             return self.result_provider.resolve_fingerprint(vid)
         return self.external_value_provider.resolve_fingerprint(vid)
 
-    def add(self, vid: ValueIdentity, value, fingerprint: Fingerprint):
+    def add(self, vid: ValueIdentity, value, fingerprint: Fingerprint, call_duration: Optional[float] = None):
         if self.has_value(value):
             existing_vid = self.identify_value(value)
             assert existing_vid is not None
@@ -54,18 +66,24 @@ class ValueProviderMediator(ValueProvider):
         # Vids are compartmentalized by value registry and thus we don't need any
         # additional error checking here.
 
+        self._increment_epoch()
         if isinstance(vid, ComputedValueIdentity):
+            if call_duration is not None:
+                # See `ResultRegistry.add`.
+                return self.result_provider.add(vid, value, fingerprint, call_duration)
             return self.result_provider.add(vid, value, fingerprint)
         else:
             return self.external_value_provider.add(vid, value, fingerprint)
 
     def remove_vid(self, vid: ValueIdentity):
+        self._increment_epoch()
         if isinstance(vid, ComputedValueIdentity):
             return self.result_provider.remove_vid(vid)
         else:
             return self.external_value_provider.remove_vid(vid)
 
     def remove_value(self, value):
+        self._increment_epoch()
         self.result_provider.remove_value(value)
         self.external_value_provider.remove_value(value)
 
@@ -1,11 +1,13 @@
+import threading
 import weakref
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import MutableMapping, Set
 
 from mamo.internal.common.bimap import MappingBimap
 from mamo.internal.delayed_interruption_context import delayed_interruption
 from mamo.internal.fingerprints import Fingerprint
 from mamo.internal.common.key_id_dict import KeyIdDict
+from mamo.internal.common.synchronized import synchronized
 from mamo.internal.identities import ValueIdentity
 from mamo.internal.providers import ValueProvider
 from mamo.internal.staleness_registry import StalenessRegistry
@@ -17,19 +19,24 @@ class AbstractValueRegistry(ValueProvider):
     vid_value_bimap: MappingBimap[ValueIdentity, object]
     value_fingerprint_map: MutableMapping[object, Fingerprint]
     staleness_registry: StalenessRegistry
+    lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False, compare=False)
 
+    @synchronized
     def identify_value(self, value) -> ValueIdentity:
         return self.vid_value_bimap.get_key(value)
 
+    @synchronized
     def fingerprint_value(self, value) -> Fingerprint:
         return self.value_fingerprint_map.get(value)
 
+    @synchronized
     def resolve_value(self, vid: ValueIdentity):
         return self.vid_value_bimap.get_value(vid)
 
     def resolve_fingerprint(self, vid: ValueIdentity):
         return self.fingerprint_value(self.resolve_value(vid))
 
+    @synchronized
     @delayed_interruption()
     def add(self, vid: ValueIdentity, value, fingerprint: Fingerprint):
         assert value is not None
@@ -46,11 +53,13 @@ class AbstractValueRegistry(ValueProvider):
         self.value_fingerprint_map[value] = fingerprint
         self.staleness_registry.mark_used(value)
 
+    @synchronized
     def remove_vid(self, vid: ValueIdentity):
         value = self.vid_value_bimap.get_value(vid)
         if value is not None:
             self.remove_value(value)
 
+    @synchronized
     @delayed_interruption()
     def remove_value(self, value: object):
         if not self.has_value(value):
@@ -60,12 +69,15 @@ class AbstractValueRegistry(ValueProvider):
         self.vid_value_bimap.del_value(value)
         del self.value_fingerprint_map[value]
 
+    @synchronized
     def has_vid(self, vid: ValueIdentity):
         return vid in self.vid_value_bimap
 
+    @synchronized
     def has_value(self, value):
         return self.vid_value_bimap.has_value(value)
 
+    @synchronized
     def get_vids(self) -> Set[ValueIdentity]:
         return set(self.vid_value_bimap.get_keys())
 
@@ -1,8 +1,10 @@
 import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from typing import Optional
 
 import numpy as np
-import hashlib
 
 from mamo.api_support import (
     DBPickledValue,
@@ -12,32 +14,169 @@ from mamo.api_support import (
     ExternallyCachedFilePath,
     CachedValue,
     MODULE_EXTENSIONS,
+    compute_digest,
+    get_digest_algorithm,
+    choose_codec,
+    open_external_file,
+    COMPRESSION_SAMPLE_SIZE,
 )
+from mamo.internal.common.weakref_utils import WeakIdSet, supports_weakrefs
 
 np_types = (np.ndarray, np.record, np.matrix, np.recarray, np.chararray, np.generic, np.memmap)
 
+# Arrays with more bytes than this are hashed in chunks in parallel.
+# Smaller arrays are digested in one go (whatever their memory layout).
+PARALLEL_DIGEST_MIN_SIZE = 256 * 2 ** 20
+DIGEST_CHUNK_SIZE = 16 * 2 ** 20
+
+# Sampled fingerprints only digest the metadata and a deterministic sample of blocks of an array.
+# This is a deliberate trade-off: changes outside the sampled blocks go unnoticed (see README).
+# Arrays with more bytes than this always use sampled fingerprints (None disables this).
+SAMPLED_FINGERPRINT_MIN_SIZE: Optional[int] = None
+NUM_SAMPLED_BLOCKS = 64
+SAMPLED_BLOCK_SIZE = 2 ** 16
+
+# Arrays that were marked via `sampled_fingerprint`.
+_sampled_values = WeakIdSet()
+
+_digest_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_digest_executor():
+    global _digest_executor
+    if _digest_executor is None:
+        # hashlib (and xxhash) release the GIL for large buffers, so threads hash in parallel.
+        _digest_executor = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="mamo_digest")
+    return _digest_executor
+
+
+def _digest_items(digest_algorithm, value: np.ndarray, start, end):
+    if value.flags.c_contiguous:
+        return digest_algorithm.digest(value.reshape(-1)[start:end])
+    # Only copies the chunk (in C order).
+    return digest_algorithm.digest(value.flat[start:end])
+
+
+def compute_chunked_digest(value: np.ndarray, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Computes a tree digest: the digest of the digests of consecutive chunks of (about) `chunk_size` bytes of the
+    flattened array.
+
+    The chunks only depend on the size, dtype and `chunk_size`, not on the memory layout,
+    so the digest is deterministic and views with the same content have the same digest.
+    """
+    digest_algorithm = get_digest_algorithm()
+    items_per_chunk = max(chunk_size // max(value.itemsize, 1), 1)
+    starts = range(0, value.size, items_per_chunk)
+    chunk_digests = _get_digest_executor().map(
+        lambda start: _digest_items(digest_algorithm, value, start, start + items_per_chunk), starts
+    )
+    return digest_algorithm.digest(b"chunked" + struct.pack("<Q", items_per_chunk), *chunk_digests)
+
+
+def compute_sampled_digest(value: np.ndarray, num_blocks=NUM_SAMPLED_BLOCKS, block_size=SAMPLED_BLOCK_SIZE):
+    """
+    Digests the shape, dtype, strides and `num_blocks` evenly spaced blocks of `block_size` bytes.
+
+    For `np.memmap`s, we also digest the file path, size and modification time (and the offset).
+    """
+    metadata = [value.shape, value.dtype.str, value.strides]
+    filename = getattr(value, "filename", None)
+    if filename is not None:
+        stat = os.stat(filename)
+        metadata += [filename, value.offset, stat.st_size, stat.st_mtime_ns]
+
+    chunks = [repr(metadata).encode()]
+    flat_size = value.size
+    items_per_block = max(block_size // max(value.itemsize, 1), 1)
+    if flat_size <= num_blocks * items_per_block:
+        chunks.append(np.ascontiguousarray(value))
+    else:
+        stride = (flat_size - items_per_block) // (num_blocks - 1)
+        for start in range(0, stride * num_blocks, stride):
+            # Only copies the block.
+            chunks.append(np.ascontiguousarray(value.flat[start:start + items_per_block]))
+    return compute_digest(b"sampled", *chunks)
+
+
+def sampled_fingerprint(value):
+    """Marks `value` to use a sampled fingerprint (when it is fingerprinted for the first time)."""
+    if isinstance(value, np.ndarray) and supports_weakrefs(value):
+        _sampled_values.add(value)
+    return value
+
+
+def sampled_fingerprints(func):
+    """
+    Makes all array arguments of `func` use sampled fingerprints.
+
+    Use it outside of `mamo`:
+    ```
+    @sampled_fingerprints
+    @mamo
+    def f(huge_array): ...
+    ```
+    """
+
+    @wraps(func)
+    def wrapped_func(*args, **kwargs):
+        for arg in (*args, *kwargs.values()):
+            sampled_fingerprint(arg)
+        return func(*args, **kwargs)
+
+    return wrapped_func
+
+
+def _uses_sampled_fingerprint(value: np.ndarray):
+    if value in _sampled_values:
+        return True
+    return SAMPLED_FINGERPRINT_MIN_SIZE is not None and value.nbytes > SAMPLED_FINGERPRINT_MIN_SIZE
+
 
 class NumpyExternallyCachedValue(ExternallyCachedValue):
     def load(self):
-        return np.load(self.path, "r")
+        if self.codec_id is None:
+            return np.load(self.path, "r")
+        with self.open() as external_file:
+            return np.load(external_file)
 
     @staticmethod
-    def save(external_path, value):
-        np.save(external_path, value)
+    def save(external_path, value, codec_id: Optional[str] = None):
+        with open_external_file(external_path, "wb", codec_id) as external_file:
+            np.save(external_file, value)
 
-        return NumpyExternallyCachedValue(external_path)
+        return NumpyExternallyCachedValue(external_path, codec_id, value.nbytes if codec_id else None)
 
 
 class NumpyObjectSaver(ObjectSaver):
     def __init__(self, value):
         super().__init__(value)
         self.value = value
+        self.data_digest = None
 
     def get_estimated_size(self) -> Optional[int]:
         return self.value.nbytes
 
+    def compute_data_digest(self):
+        """Digests all bytes of the array (but not its shape or dtype)."""
+        if self.data_digest is None:
+            value = np.asarray(self.value)
+            if value.nbytes < PARALLEL_DIGEST_MIN_SIZE:
+                # Only copies small non-contiguous arrays.
+                self.data_digest = compute_digest(np.ascontiguousarray(value))
+            else:
+                self.data_digest = compute_chunked_digest(value)
+        return self.data_digest
+
     def compute_digest_(self):
-        return hashlib.md5(self.value).digest()
+        if _uses_sampled_fingerprint(self.value):
+            return compute_sampled_digest(self.value)
+        return self.compute_data_digest()
+
+    def compute_content_digest(self):
+        value = np.asarray(self.value)
+        metadata = repr((type(self.value).__qualname__, value.dtype, value.shape)).encode()
+        return compute_digest(b"numpy", metadata, self.compute_data_digest())
 
     def cache_value(self, external_path_builder: Optional[ExternallyCachedFilePath]) -> Optional[CachedValue]:
         if external_path_builder is None:
@@ -45,8 +184,15 @@ class NumpyObjectSaver(ObjectSaver):
 
         shape_info = "_".join(map(str, self.value.shape))
         external_path = external_path_builder.build(shape_info, "npy")
+        codec_id = choose_codec(external_path_builder.compression, self.get_sample)
+
+        return NumpyExternallyCachedValue.save(external_path, self.value, codec_id)
 
-        return NumpyExternallyCachedValue.save(external_path, self.value)
+    def get_sample(self):
+        value = np.asarray(self.value)
+        num_items = COMPRESSION_SAMPLE_SIZE // max(value.itemsize, 1)
+        # Only copies the sample.
+        return np.ascontiguousarray(value.flat[:num_items]).tobytes()
 
 
 class NumpyModuleExtension(ModuleExtension):
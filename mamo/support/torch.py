@@ -1,8 +1,6 @@
 import torch as th
 from typing import Optional
 
-import hashlib
-
 from mamo.api_support import (
     ExternallyCachedValue,
     ModuleExtension,
@@ -11,6 +9,10 @@ from mamo.api_support import (
     CachedValue,
     DBPickledValue,
     MODULE_EXTENSIONS,
+    compute_digest,
+    choose_codec,
+    open_external_file,
+    COMPRESSION_SAMPLE_SIZE,
 )
 
 
@@ -19,13 +21,21 @@ from mamo.api_support import (
 
 class TorchExternallyCachedValue(ExternallyCachedValue):
     def load(self):
-        return th.load(self.path)
+        if self.codec_id is None:
+            return th.load(self.path)
+        with self.open() as external_file:
+            return th.load(external_file)
 
     @staticmethod
-    def save(external_path, value):
-        th.save(value, external_path)
+    def save(external_path, value, codec_id: Optional[str] = None):
+        if codec_id is None:
+            th.save(value, external_path)
+        else:
+            with open_external_file(external_path, "wb", codec_id) as external_file:
+                th.save(value, external_file)
 
-        return TorchExternallyCachedValue(external_path)
+        raw_size = value.numel() * value.element_size() if codec_id else None
+        return TorchExternallyCachedValue(external_path, codec_id, raw_size)
 
 
 class TorchObjectSaver(ObjectSaver):
@@ -37,7 +47,11 @@ class TorchObjectSaver(ObjectSaver):
         return self.value.numel() * self.value.element_size()
 
     def compute_digest_(self):
-        return hashlib.md5(self.value.numpy()).digest()
+        return compute_digest(self.value.numpy())
+
+    def compute_content_digest(self):
+        metadata = repr((self.value.dtype, tuple(self.value.shape))).encode()
+        return compute_digest(b"torch", metadata, self.value.contiguous().numpy())
 
     def cache_value(self, external_path_builder: Optional[ExternallyCachedFilePath]) -> Optional[CachedValue]:
         if external_path_builder is None:
@@ -45,8 +59,13 @@ class TorchObjectSaver(ObjectSaver):
 
         shape_info = "_".join(map(str, self.value.shape))
         external_path = external_path_builder.build(shape_info, "pth")
+        codec_id = choose_codec(external_path_builder.compression, self.get_sample)
+
+        return TorchExternallyCachedValue.save(external_path, self.value, codec_id)
 
-        return TorchExternallyCachedValue.save(external_path, self.value)
+    def get_sample(self):
+        num_items = COMPRESSION_SAMPLE_SIZE // self.value.element_size()
+        return self.value.reshape(-1)[:num_items].numpy().tobytes()
 
 
 class TorchModuleExtension(ModuleExtension):
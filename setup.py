@@ -54,13 +54,15 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['ZODB', 'objproxies', 'persistent', "pathvalidate"],
+    install_requires=['ZODB', 'BTrees', 'objproxies', 'persistent', "pathvalidate"],
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
         "dev": ["check-manifest", "numpy", "torch<2"],
+        # For sharing a store between processes through a storage server (see mamo.start_store_server).
+        "server": ["ZEO"],
         # See https://github.com/nedbat/coveragepy/blob/master/doc/whatsnew5x.rst
         "test": ["coverage<5", "codecov", "pytest", "pytest-runner", "pytest-benchmark", "pytest-cov"],
     },
@@ -0,0 +1,120 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mamo
+from mamo.internal import main
+from mamo.internal.delayed_interruption_context import delayed_interruption
+
+from tests.testing import BoxedValue
+
+# noinspection PyUnresolvedReferences
+from tests.testing import mamo_fixture
+
+NUM_THREADS = 8
+NUM_ITEMS = 32
+
+load_item = None
+extract_features = None
+
+
+def unwrapped_load_item(i):
+    # I/O-bound.
+    time.sleep(0.002)
+    return BoxedValue(i)
+
+
+def unwrapped_extract_features(i):
+    item = load_item(i)
+    time.sleep(0.001)
+    return BoxedValue(item.value * 2)
+
+
+def test_mamo_concurrent_calls(mamo_fixture):
+    global load_item, extract_features
+    load_item = mamo.mamo(unwrapped_load_item)
+    extract_features = mamo.mamo(unwrapped_extract_features)
+
+    try:
+        with ThreadPoolExecutor(NUM_THREADS) as executor:
+            for _ in range(3):
+                results = list(executor.map(extract_features, list(range(NUM_ITEMS)) * 2))
+                assert [result.value for result in results] == [i * 2 for i in range(NUM_ITEMS)] * 2
+
+        for i in range(NUM_ITEMS):
+            metadata = extract_features.get_metadata(i)
+            # Each thread times its own subcalls.
+            assert metadata.subcall_duration <= metadata.call_duration
+            assert metadata.call_duration <= 1.
+
+        assert main.mamo._call_duration_stacks.call_durations == [0.0]
+    finally:
+        load_item = extract_features = None
+
+
+def test_delayed_interruption_in_worker_thread():
+    errors = []
+
+    def run():
+        try:
+            with delayed_interruption():
+                pass
+        except Exception as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert not errors
+
+
+def test_mamo_concurrent_identical_calls_execute_once(mamo_fixture):
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def unwrapped_slow_square(x):
+        calls.append(x)
+        started.set()
+        release.wait()
+        return BoxedValue(x * x)
+
+    slow_square = mamo.mamo(unwrapped_slow_square)
+
+    with ThreadPoolExecutor(NUM_THREADS) as executor:
+        futures = [executor.submit(slow_square, 3) for _ in range(NUM_THREADS)]
+        started.wait()
+        time.sleep(0.05)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert calls == [3]
+    assert all(result is results[0] for result in results)
+    assert len(main.mamo.call_flights) == 0
+
+
+def test_mamo_concurrent_calls_retry_after_errors(mamo_fixture):
+    calls = []
+
+    def unwrapped_flaky(x):
+        calls.append(x)
+        if len(calls) == 1:
+            time.sleep(0.05)
+            raise ValueError()
+        return BoxedValue(x)
+
+    flaky = mamo.mamo(unwrapped_flaky)
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(flaky, 1) for _ in range(2)]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result().value)
+            except ValueError:
+                outcomes.append("error")
+
+    # The waiting call executes once the first one has failed.
+    assert sorted(map(str, outcomes)) == ["1", "error"]
+    assert calls == [1, 1]
+    assert len(main.mamo.call_flights) == 0
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from mamo.internal.common.canonical_digest import canonical_digest, canonical_encode
+from mamo.internal.common.digest_mapping import PersistentDigestMapping
+from mamo.internal.fingerprints import FingerprintDigestRepr, FingerprintName
+from mamo.internal.identities import FunctionIdentity, ValueCallIdentity, value_name_identity
+from tests.collection_testing.test_mutable_mapping import MutableMappingTests
+
+
+def create_vid(i):
+    return ValueCallIdentity(FunctionIdentity("f"), (value_name_identity(str(i)),),
+                             frozenset({("k", value_name_identity("v"))}))
+
+
+class TestPersistentDigestMapping(MutableMappingTests):
+    mutable_mapping = PersistentDigestMapping
+
+    @staticmethod
+    def get_key(i):
+        return create_vid(i)
+
+
+def test_canonical_digest_is_stable_across_hash_seeds():
+    code = (
+        "from tests.test_digest_mapping import create_vid;"
+        "from mamo.internal.common.canonical_digest import canonical_digest;"
+        "print(canonical_digest(create_vid(1)).hex())"
+    )
+    digests = {
+        subprocess.run([sys.executable, "-c", code], env={"PYTHONHASHSEED": seed}, check=True,
+                       cwd=os.path.dirname(os.path.dirname(__file__)), capture_output=True, text=True).stdout.strip()
+        for seed in ["1", "2", "3"]
+    }
+    assert digests == {canonical_digest(create_vid(1)).hex()}
+
+
+def test_canonical_digest_follows_equality():
+    assert canonical_digest(create_vid(1)) == canonical_digest(create_vid(1))
+    assert canonical_digest(create_vid(1)) != canonical_digest(create_vid(2))
+    assert canonical_encode(1) == canonical_encode(1.0) == canonical_encode(True)
+    assert canonical_encode(frozenset({"a", "b"})) == canonical_encode(frozenset({"b", "a"}))
+    assert canonical_encode(("a", "b")) != canonical_encode(("b", "a"))
+
+    # The repr is only informative and does not take part in comparisons.
+    assert FingerprintDigestRepr(b"digest", "a") == FingerprintDigestRepr(b"digest", "b")
+    assert canonical_digest(FingerprintDigestRepr(b"digest", "a")) == canonical_digest(
+        FingerprintDigestRepr(b"digest", "b"))
+    assert canonical_digest(FingerprintDigestRepr(b"digest", "a")) != canonical_digest(
+        FingerprintName("digest"))
+
+
+def test_canonical_encode_rejects_unsupported_types():
+    with pytest.raises(TypeError):
+        canonical_encode([1, 2])
+    with pytest.raises(TypeError):
+        canonical_encode(object())
@@ -0,0 +1,69 @@
+import pytest
+
+import mamo
+from mamo.internal import digests, main
+from mamo.internal.fingerprints import FingerprintDigest
+from mamo.internal.module_extension import MODULE_EXTENSIONS
+from mamo.internal.reflection import get_func_fingerprint
+
+from tests.testing import BoxedValue
+
+
+@pytest.fixture
+def digest_algorithm(monkeypatch):
+    monkeypatch.setattr(digests, "_digest_algorithm", digests.MD5)
+    return digests.set_digest_algorithm
+
+
+def test_md5_digests_are_not_prefixed(digest_algorithm):
+    digest = MODULE_EXTENSIONS.get_object_saver(BoxedValue(1)).compute_digest()
+    assert len(digest) == 16
+
+
+@pytest.mark.parametrize("algorithm_id", ["sha256", "blake2b-128", "blake2b-256"])
+def test_digests_record_the_algorithm(digest_algorithm, algorithm_id):
+    md5_digest = MODULE_EXTENSIONS.get_object_saver(BoxedValue(1)).compute_digest()
+    md5_code_digest = get_func_fingerprint(test_digests_record_the_algorithm)
+
+    digest_algorithm(algorithm_id)
+    digest = MODULE_EXTENSIONS.get_object_saver(BoxedValue(1)).compute_digest()
+    tuple_digest = MODULE_EXTENSIONS.get_object_saver((1, BoxedValue(1))).compute_digest()
+    code_digest = get_func_fingerprint(test_digests_record_the_algorithm)
+
+    prefix = f"{algorithm_id}:".encode()
+    assert digest.startswith(prefix) and tuple_digest.startswith(prefix) and code_digest.startswith(prefix)
+    assert FingerprintDigest(digest) != FingerprintDigest(md5_digest)
+    assert code_digest != md5_code_digest
+    assert MODULE_EXTENSIONS.get_object_saver(BoxedValue(1)).compute_digest() == digest
+
+
+def test_unknown_digest_algorithm_raises(digest_algorithm):
+    with pytest.raises(ValueError):
+        digest_algorithm("crc32")
+
+
+def test_init_mamo_sets_digest_algorithm():
+    if main.mamo is not None:
+        main.mamo.testing_close()
+        main.mamo = None
+    main.init_mamo(digest_algorithm=digests.blake2b(20))
+    try:
+        assert digests.get_digest_algorithm().algorithm_id == "blake2b-160"
+
+        assert MODULE_EXTENSIONS.get_object_saver(BoxedValue(1)).compute_digest().startswith(b"blake2b-160:")
+        value = mamo.mamo(BoxedValue)(1)
+        assert mamo.mamo(BoxedValue)(1) is value
+    finally:
+        main.mamo.testing_close()
+        main.mamo = None
+        digests.set_digest_algorithm(digests.MD5)
+
+
+@pytest.mark.parametrize("size", [64, 2 ** 16, 2 ** 24])
+@pytest.mark.parametrize("algorithm_id", list(digests.DIGEST_ALGORITHMS))
+def test_benchmark_digest_algorithms(benchmark, algorithm_id, size):
+    data = bytes(size)
+    algorithm = digests.DIGEST_ALGORITHMS[algorithm_id]
+    benchmark.extra_info["bytes"] = size
+
+    benchmark(algorithm.digest, data)
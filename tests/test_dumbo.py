@@ -1,8 +1,11 @@
 from types import FunctionType
 from typing import cast
 
+import numpy as np
+import pytest
+
 import mamo
-from mamo.internal import main
+from mamo.internal import main, hit_cache, default_module_extension
 
 # Here, we just assume mamo as general memoization library.
 from mamo.internal.identities import value_name_identity, ValueCallIdentity
@@ -246,3 +249,261 @@ def test_run_named_cell(mamo_fixture):
 #
 # def test_get_func_qualified_name():
 #     assert reflection.get_func_qualified_name(slow_operation) == "test_mamo.slow_operation"
+
+
+def unwrapped_step(a):
+    return BoxedValue(a.value + 1)
+
+
+def test_mamo_hit_fast_path(mamo_fixture, monkeypatch):
+    step = mamo.mamo(unwrapped_step)
+    arg = BoxedValue(1)
+    result = step(arg)
+
+    # The first cache hit goes through the slow path and populates the hit cache.
+    assert step(arg) is result
+    assert mamo.get_metadata(result).num_cache_hits == 1
+
+    def fail_identify_call(*args, **kwargs):
+        raise AssertionError("The fast path must not identify calls!")
+
+    monkeypatch.setattr(main.mamo.identity_registry, "identify_call", fail_identify_call)
+    assert step(arg) is result
+    assert mamo.get_metadata(result).num_cache_hits == 2
+    monkeypatch.undo()
+
+    # Forgetting the result invalidates the hit cache.
+    mamo.forget(result)
+    assert step(arg) is not result
+
+
+def test_mamo_hit_fast_path_is_invalidated_by_code_changes(mamo_fixture):
+    step = mamo.mamo(unwrapped_step)
+    arg = BoxedValue(1)
+    result = step(arg)
+    assert step(arg) is result
+
+    epoch = main.mamo.get_epoch()
+    main.mamo.fingerprint_registry.invalidate_deep_fingerprints()
+    assert main.mamo.get_epoch() != epoch
+
+    # The call is validated again, which is still a cache hit.
+    assert step(arg) is result
+    assert mamo.get_metadata(result).num_cache_hits == 2
+
+
+def unwrapped_step_by_two(a):
+    return BoxedValue(a.value + 2)
+
+
+@fixture
+def fail_identify_call(monkeypatch):
+    def fail_identify_call(*args, **kwargs):
+        raise AssertionError("The fast path must not identify calls!")
+
+    def enable():
+        monkeypatch.setattr(main.mamo.identity_registry, "identify_call", fail_identify_call)
+
+    return enable
+
+
+def test_mamo_hit_fast_path_is_invalidated_by_code_replacement(mamo_fixture):
+    step = mamo.mamo(FunctionType(unwrapped_step.__code__, globals(), "unwrapped_step"))
+    arg = BoxedValue(1)
+    result = step(arg)
+    assert step(arg) is result
+
+    # Replace the code in-place like IPython's autoreload does.
+    step.mamo_unwrapped_func.__code__ = unwrapped_step_by_two.__code__
+    assert step(arg) == BoxedValue(3)
+
+
+def test_mamo_hit_fast_path_is_invalidated_by_policy_changes(mamo_fixture):
+    step = mamo.mamo(unwrapped_step)
+    arg = BoxedValue(1)
+    result = step(arg)
+    assert step(arg) is result
+
+    main.mamo.re_execution_policy = lambda *args: True
+    assert step(arg) is not result
+
+
+def test_mamo_hit_fast_path_skips_cell_results(mamo_fixture):
+    class Dummy:
+        pass
+
+    user_ns_obj = Dummy()
+    user_ns = user_ns_obj.__dict__
+    user_ns_obj.x = BoxedValue(1)
+    user_ns_obj.step = unwrapped_step
+    main.mamo.run_cell("cell", "global y; y = step(x)", user_ns)
+
+    step = mamo.mamo(unwrapped_step)
+    result = step(user_ns_obj.y)
+    assert step(user_ns_obj.y) is result
+
+    # The cell result depends on x, so the result is stale now.
+    user_ns_obj.x = BoxedValue(5)
+    assert step(user_ns_obj.y) is not result
+
+
+def test_mamo_hit_fast_path_evicts_least_recently_used(mamo_fixture, monkeypatch, fail_identify_call):
+    monkeypatch.setattr(hit_cache, "MAX_HIT_CACHE_ENTRIES", 2)
+
+    step = mamo.mamo(unwrapped_step)
+    arg_a, arg_b, arg_c = BoxedValue(1), BoxedValue(2), BoxedValue(3)
+    for arg in [arg_a, arg_b, arg_c]:
+        step(arg)
+    # Populate the hit cache after all executions (which change the epoch).
+    for arg in [arg_a, arg_b, arg_a, arg_c]:
+        step(arg)
+
+    fail_identify_call()
+    step(arg_a)
+    step(arg_c)
+    with pytest.raises(AssertionError):
+        step(arg_b)
+
+
+def test_benchmark_mamo_hit(mamo_fixture, benchmark):
+    step = mamo.mamo(unwrapped_step)
+    arg = BoxedValue(1)
+    result = step(arg)
+
+    assert benchmark(step, arg) is result
+
+
+def test_mamo_hits_do_not_commit(mamo_fixture):
+    step = mamo.mamo(unwrapped_step)
+    arg = BoxedValue(1)
+    result = step(arg)
+
+    db = main.mamo.persisted_store.db
+    last_transaction = db.lastTransaction()
+    for _ in range(3):
+        assert step(arg) is result
+    assert db.lastTransaction() == last_transaction
+    assert mamo.get_metadata(result).num_cache_hits == 3
+
+    mamo.flush_metadata()
+    assert db.lastTransaction() != last_transaction
+
+
+def test_mamo_write_behind():
+    if main.mamo is not None:
+        main.mamo.testing_close()
+        main.mamo = None
+    main.init_mamo(max_pending_writes=4)
+    try:
+        step = mamo.mamo(unwrapped_step)
+        result = step(BoxedValue(1))
+        mamo.flush_writes()
+
+        assert main.mamo.persisted_store.get_cached_value(main.mamo._get_vid(result)) is not None
+        assert mamo.get_metadata(result).call_duration > 0
+        assert step(BoxedValue(1)) is result
+    finally:
+        main.mamo.testing_close()
+        main.mamo = None
+
+
+def test_mamo_lazy_loading(monkeypatch):
+    if main.mamo is not None:
+        main.mamo.testing_close()
+        main.mamo = None
+    main.init_mamo(lazy_loading=True)
+    try:
+        step = mamo.mamo(unwrapped_step)
+        step(step(BoxedValue(1)))
+        mamo.flush_online_cache()
+
+        loads = []
+        load_value = main.mamo.persisted_store.load_value
+        monkeypatch.setattr(main.mamo.persisted_store, "load_value", lambda vid: loads.append(vid) or load_value(vid))
+
+        # Chained hits only pass the lazy proxy along.
+        result = step(step(BoxedValue(1)))
+        assert not loads
+
+        assert result.value == 3
+        assert len(loads) == 1
+    finally:
+        main.mamo.testing_close()
+        main.mamo = None
+
+
+def unwrapped_make_array(i):
+    return np.full(100000, i, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("eviction_policy", ["cost_benefit", "lru", "lfu"])
+def test_mamo_disk_budget_keeps_lazy_results(eviction_policy):
+    if main.mamo is not None:
+        main.mamo.testing_close()
+        main.mamo = None
+    main.init_mamo(lazy_loading=True, disk_budget=210000, eviction_policy=eviction_policy)
+    try:
+        make_array = mamo.mamo(unwrapped_make_array)
+        make_array(0)
+        mamo.flush_online_cache()
+
+        lazy_array = make_array(0)
+        # Needs to evict both other arrays, but the lazy one hasn't been loaded yet.
+        make_array(1)
+        make_array(2)
+        assert (lazy_array == 0).all()
+
+        # Once loaded (or gone), results can be evicted again.
+        assert not main.mamo.persisted_store.pinned_vids
+    finally:
+        main.mamo.testing_close()
+        main.mamo = None
+
+
+def test_mamo_memory_budget(mamo_fixture, monkeypatch):
+    make_array = mamo.mamo(unwrapped_make_array)
+    mamo.set_memory_budget(250000)
+
+    kept = make_array(0)
+    make_array(1)
+    make_array(2)
+    make_array(3)
+
+    # The least recently used arrays have been evicted, but we still know the one that is referenced elsewhere.
+    vids = mamo.get_cached_value_identities(False)
+    assert len(vids) == 3
+    assert make_array(0) is kept
+
+    # Evicted arrays are reloaded from the persisted store.
+    loads = []
+    load_value = main.mamo.persisted_store.load_value
+    monkeypatch.setattr(main.mamo.persisted_store, "load_value", lambda vid: loads.append(vid) or load_value(vid))
+    assert (make_array(1) == 1).all()
+    assert len(loads) == 1
+    assert len(main.mamo.result_registry.values) <= 3
+
+    with pytest.raises(ValueError):
+        mamo.set_memory_budget(0, "unknown")
+
+
+def unwrapped_make_list(i):
+    return [i] * 1000
+
+
+@pytest.mark.parametrize("memory_budget", [None, 10 ** 6])
+def test_mamo_memory_budget_pickles_results_once(mamo_fixture, monkeypatch, memory_budget):
+    make_list = mamo.mamo(unwrapped_make_list)
+    mamo.set_memory_budget(memory_budget)
+
+    writers = []
+
+    class CountingWriter(default_module_extension.DigestingWriter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            writers.append(self)
+
+    monkeypatch.setattr(default_module_extension, "DigestingWriter", CountingWriter)
+    result = make_list(0)
+    writers = [writer for writer in writers if writer.size > 1000]
+    assert len(writers) == 1
+    assert make_list(0) is result
@@ -1,3 +1,5 @@
+import pytest
+
 from mamo.internal import main
 from mamo.internal import reflection
 
@@ -97,3 +99,87 @@ def test_deep_function_fingerprint_global_calls(mamo_fixture):
 
     assert func_c_fingerprint_1 != func_c_fingerprint_2
     assert func_d_fingerprint_1 != func_d_fingerprint_2
+
+
+def test_deep_function_fingerprint_is_cached(mamo_fixture):
+    # Enable deep signatures.
+    main.mamo.deep_fingerprint_source_prefix = ""
+    fingerprint_registry = main.mamo.fingerprint_registry
+
+    func_d_fingerprint_1 = fingerprint_registry.fingerprint_function(func_d)
+    code_epoch = fingerprint_registry.code_epoch
+    func_d_fingerprint_2 = fingerprint_registry.fingerprint_function(func_d)
+
+    assert func_d_fingerprint_1 is func_d_fingerprint_2
+    assert fingerprint_registry.code_epoch == code_epoch
+
+
+def test_deep_function_fingerprint_cache_invalidation(mamo_fixture):
+    # Enable deep signatures.
+    main.mamo.deep_fingerprint_source_prefix = ""
+    fingerprint_registry = main.mamo.fingerprint_registry
+
+    func_d_fingerprint_1 = fingerprint_registry.fingerprint_function(func_d)
+    code_epoch = fingerprint_registry.code_epoch
+
+    fingerprint_registry.invalidate_deep_fingerprints()
+    func_d_fingerprint_2 = fingerprint_registry.fingerprint_function(func_d)
+
+    assert fingerprint_registry.code_epoch == code_epoch + 1
+    assert func_d_fingerprint_1 == func_d_fingerprint_2
+
+    # Changing the prefix changes which functions are fingerprinted deeply.
+    main.mamo.deep_fingerprint_source_prefix = None
+    assert fingerprint_registry.code_epoch == code_epoch + 2
+    assert fingerprint_registry.fingerprint_function(func_d) != func_d_fingerprint_2
+
+
+@pytest.fixture
+def forced_func_calls(mamo_fixture, monkeypatch):
+    # Newer bytecode is not analyzed correctly yet, so we force the calls of func_c and func_d.
+    func_calls = {
+        func_c.__code__: frozenset({("global_func",)}),
+        func_d.__code__: frozenset({("func_c",)}),
+    }
+
+    def get_code_object_deps(code_object):
+        return reflection.FunctionDependencies(frozenset(), frozenset(), func_calls.get(code_object, frozenset()))
+
+    monkeypatch.setattr(main.mamo.fingerprint_registry, "_get_code_object_deps", get_code_object_deps)
+    # Enable deep signatures.
+    main.mamo.deep_fingerprint_source_prefix = ""
+
+
+def test_deep_function_fingerprint_cache_rebinding(forced_func_calls):
+    fingerprint_registry = main.mamo.fingerprint_registry
+
+    global global_func
+    global_func = global_func1
+    func_d_fingerprint_1 = fingerprint_registry.fingerprint_function(func_d)
+    assert fingerprint_registry.fingerprint_function(func_d) is func_d_fingerprint_1
+
+    global_func = global_func2
+    func_d_fingerprint_2 = fingerprint_registry.fingerprint_function(func_d)
+    assert func_d_fingerprint_2 != func_d_fingerprint_1
+
+    global_func = global_func1
+    assert fingerprint_registry.fingerprint_function(func_d) == func_d_fingerprint_1
+
+
+def test_deep_function_fingerprint_cache_code_replacement(forced_func_calls):
+    fingerprint_registry = main.mamo.fingerprint_registry
+
+    global global_func
+    global_func = global_func1
+    func_d_fingerprint_1 = fingerprint_registry.fingerprint_function(func_d)
+
+    # Replace the code in-place like IPython's autoreload does.
+    original_code = global_func1.__code__
+    global_func1.__code__ = global_func2.__code__
+    try:
+        func_d_fingerprint_2 = fingerprint_registry.fingerprint_function(func_d)
+    finally:
+        global_func1.__code__ = original_code
+
+    assert func_d_fingerprint_2 != func_d_fingerprint_1
+    assert fingerprint_registry.fingerprint_function(func_d) == func_d_fingerprint_1
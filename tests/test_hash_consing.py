@@ -0,0 +1,65 @@
+import copyreg
+import pickle
+
+import pytest
+
+from mamo.internal.common.hash_consing import hash_cons
+from mamo.internal.fingerprints import CallFingerprint, DeepFunctionFingerprint, FunctionFingerprint
+from mamo.internal.identities import FunctionIdentity, ValueCallIdentity, value_name_identity
+
+
+def create_vid(name="f", arg="a"):
+    return ValueCallIdentity(FunctionIdentity(name), (value_name_identity(arg),), frozenset())
+
+
+def create_fingerprint():
+    func_fingerprint = DeepFunctionFingerprint(b"code", frozenset({(("g",), FunctionFingerprint(b"g"))}))
+    return CallFingerprint(func_fingerprint, (value_name_identity("a").fingerprint,), frozenset())
+
+
+@pytest.mark.parametrize("factory", [create_vid, create_fingerprint])
+def test_hash_consed_values_compare_by_value(factory):
+    value_a = factory()
+    value_b = factory()
+
+    assert value_a is not value_b
+    assert value_a == value_b
+    assert hash(value_a) == hash(value_b)
+    assert value_a != create_vid("g")
+
+
+@pytest.mark.parametrize("factory", [create_vid, create_fingerprint])
+def test_hash_cons_returns_canonical_instance(factory):
+    value_a = hash_cons(factory())
+    value_b = hash_cons(factory())
+
+    assert value_a is value_b
+
+
+def test_hash_consed_values_use_slots():
+    vid = create_vid()
+
+    assert not hasattr(vid, "__dict__")
+    with pytest.raises(AttributeError):
+        vid.fid = FunctionIdentity("g")
+
+
+@pytest.mark.parametrize("factory", [create_vid, create_fingerprint])
+def test_hash_consed_values_unpickle_canonically(factory):
+    value = hash_cons(factory())
+
+    unpickled_value = pickle.loads(pickle.dumps(value))
+
+    assert unpickled_value is value
+
+
+def test_hash_consed_values_unpickle_from_dict_state():
+    # Values that were pickled as plain frozen dataclasses.
+    vid = create_vid()
+    legacy_state = dict(fid=vid.fid, args_vid=vid.args_vid, kwargs_vid=vid.kwargs_vid)
+
+    legacy_vid = copyreg.__newobj__(ValueCallIdentity)
+    legacy_vid.__setstate__(legacy_state)
+
+    assert legacy_vid == vid
+    assert hash(legacy_vid) == hash(vid)
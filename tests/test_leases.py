@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from mamo.internal.identities import value_name_identity
+from mamo.internal.leases import LeaseManager, supports_leases
+from mamo.internal.persisted_store import PersistedStore
+
+from tests.testing import BoxedValue
+
+pytestmark = pytest.mark.skipif(not supports_leases(), reason="needs fcntl")
+
+VID = value_name_identity("popular")
+
+
+def hold_lease(path, acquired, hold_duration, crash, lease_duration):
+    leases = LeaseManager(path, lease_duration)
+    fd = leases.try_acquire(VID)
+    assert fd is not None
+    acquired.set()
+    time.sleep(hold_duration)
+    if crash:
+        os._exit(1)
+    leases.release(VID, fd)
+
+
+def run_lease_holder(path, hold_duration, crash=False, lease_duration=60.):
+    context = multiprocessing.get_context("fork")
+    acquired = context.Event()
+    process = context.Process(target=hold_lease, args=(path, acquired, hold_duration, crash, lease_duration))
+    process.start()
+    assert acquired.wait(10)
+    return process
+
+
+def test_lease_waits_for_other_process():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        process = run_lease_holder(temp_dir, 0.2)
+
+        leases = LeaseManager(temp_dir)
+        assert leases.try_acquire(VID) is None
+        start_time = time.time()
+        with leases.lease(VID) as acquired:
+            assert acquired
+            assert time.time() - start_time > 0.05
+        process.join()
+
+        assert not os.listdir(temp_dir)
+
+
+def test_lease_of_crashed_process_is_released():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        process = run_lease_holder(temp_dir, 0., crash=True)
+        process.join()
+
+        leases = LeaseManager(temp_dir)
+        fd = leases.try_acquire(VID)
+        assert fd is not None
+        leases.release(VID, fd)
+
+
+def test_lease_expires():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The holder hangs for longer than its lease.
+        process = run_lease_holder(temp_dir, 10., lease_duration=0.1)
+
+        leases = LeaseManager(temp_dir)
+        with leases.lease(VID) as acquired:
+            assert not acquired
+        process.terminate()
+        process.join()
+
+
+def test_persisted_store_lease():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = PersistedStore.from_file(temp_dir, max_pending_writes=1)
+        store.set_lease_duration(60.)
+
+        in_lease = threading.Event()
+        observed = []
+
+        def compute():
+            with store.lease(VID):
+                in_lease.set()
+                time.sleep(0.05)
+                store.add(VID, BoxedValue(1), VID.fingerprint)
+
+        def wait():
+            in_lease.wait()
+            with store.lease(VID):
+                observed.append(store.has_vid(VID) and not store.has_pending_write(VID))
+
+        threads = [threading.Thread(target=compute), threading.Thread(target=wait)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The result has been written before the lease was released.
+        assert observed == [True]
+
+        with pytest.raises(ValueError):
+            PersistedStore.from_memory().set_lease_duration(1.)
+
+        store.close()
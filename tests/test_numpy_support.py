@@ -1,8 +1,12 @@
 import mamo
 import mamo.support.numpy
+from mamo.internal.identities import value_name_identity
+from mamo.internal.persisted_store import PersistedStore
 
 import numpy as np
 
+import hashlib
+import os
 import tempfile
 
 import pytest
@@ -75,3 +79,138 @@ def test_add_np_persistent(size):
 
         mamo.main.mamo.testing_close()
         mamo.main.mamo = None
+
+
+def test_chunked_digest_is_independent_of_memory_layout():
+    a = np.random.normal(size=(300, 200))
+
+    digest = mamo.support.numpy.compute_chunked_digest(a, chunk_size=4096)
+    assert mamo.support.numpy.compute_chunked_digest(np.asfortranarray(a), chunk_size=4096) == digest
+    assert mamo.support.numpy.compute_chunked_digest(a.copy(), chunk_size=4096) == digest
+
+    b = a.copy()
+    b[-1, -1] += 1
+    assert mamo.support.numpy.compute_chunked_digest(b, chunk_size=4096) != digest
+
+
+def test_numpy_digest_uses_chunks_for_large_arrays(monkeypatch):
+    a = np.random.normal(size=(300, 200))
+    small_digest = mamo.support.numpy.NumpyObjectSaver(a).compute_digest_()
+
+    monkeypatch.setattr(mamo.support.numpy, "PARALLEL_DIGEST_MIN_SIZE", 1024)
+    large_digest = mamo.support.numpy.NumpyObjectSaver(a).compute_digest_()
+
+    assert large_digest != small_digest
+    assert large_digest == mamo.support.numpy.compute_chunked_digest(a)
+    # Non-contiguous arrays are hashed without copying them first.
+    strided_digest = mamo.support.numpy.NumpyObjectSaver(a[:, ::2]).compute_digest_()
+    assert strided_digest == mamo.support.numpy.compute_chunked_digest(a[:, ::2].copy())
+
+
+@pytest.mark.parametrize("parallel_digest_min_size", [1024, 2 ** 30])
+def test_numpy_digest_is_independent_of_memory_layout(monkeypatch, parallel_digest_min_size):
+    monkeypatch.setattr(mamo.support.numpy, "PARALLEL_DIGEST_MIN_SIZE", parallel_digest_min_size)
+    a = np.random.normal(size=(300, 200))
+
+    def digest(value):
+        return mamo.support.numpy.NumpyObjectSaver(value).compute_digest_()
+
+    assert digest(a[:, ::2]) == digest(a[:, ::2].copy())
+    assert digest(np.asfortranarray(a)) == digest(a)
+
+
+def test_chunked_digest_chunks_by_bytes_not_rows(monkeypatch):
+    a = np.random.normal(size=(3, 10000))
+    chunks = []
+    monkeypatch.setattr(mamo.support.numpy, "_digest_items",
+                        lambda digest_algorithm, value, start, end: chunks.append((start, end)) or b"")
+
+    mamo.support.numpy.compute_chunked_digest(a, chunk_size=4096)
+    assert len(chunks) == a.size * a.itemsize // 4096 + 1
+    assert all(end - start == 512 for start, end in chunks)
+
+
+@pytest.mark.parametrize("digest", ["md5", "chunked"])
+def test_benchmark_numpy_digest(benchmark, digest):
+    a = np.random.normal(size=(2 ** 25,))
+    benchmark.extra_info["bytes"] = a.nbytes
+
+    if digest == "md5":
+        benchmark(lambda: hashlib.md5(a).digest())
+    else:
+        benchmark(mamo.support.numpy.compute_chunked_digest, a)
+
+
+def test_sampled_digest_only_sees_sampled_blocks():
+    a = np.arange(10 ** 6, dtype=float)
+    digest = mamo.support.numpy.compute_sampled_digest(a)
+
+    b = a.copy()
+    b[0] += 1
+    assert mamo.support.numpy.compute_sampled_digest(b) != digest
+    # Deliberately not covered by the sample.
+    b = a.copy()
+    b[10000] += 1
+    assert mamo.support.numpy.compute_sampled_digest(b) == digest
+
+    assert mamo.support.numpy.compute_sampled_digest(a.reshape(1000, 1000)) != digest
+
+
+def test_sampled_digest_covers_memmap_files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "array.dat")
+        a = np.memmap(path, dtype=np.float32, mode="w+", shape=(1000,))
+        a.flush()
+        digest = mamo.support.numpy.compute_sampled_digest(a)
+
+        os.utime(path, ns=(0, 0))
+        assert mamo.support.numpy.compute_sampled_digest(a) != digest
+
+
+def test_sampled_fingerprints(monkeypatch):
+    a = np.arange(10 ** 6, dtype=float)
+    full_digest = mamo.support.numpy.NumpyObjectSaver(a).compute_digest()
+
+    mamo.support.numpy.sampled_fingerprints(lambda x: x)(a)
+    assert mamo.support.numpy.NumpyObjectSaver(a).compute_digest() == mamo.support.numpy.compute_sampled_digest(a)
+    assert mamo.support.numpy.NumpyObjectSaver(a.copy()).compute_digest() == full_digest
+
+    monkeypatch.setattr(mamo.support.numpy, "SAMPLED_FINGERPRINT_MIN_SIZE", 2 ** 20)
+    assert mamo.support.numpy.NumpyObjectSaver(a.copy()).compute_digest() != full_digest
+
+
+def test_numpy_deduplication_distinguishes_shapes_and_dtypes():
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+        vid_f = value_name_identity("f")
+        vid_g = value_name_identity("g")
+        # Same bytes.
+        store.add(vid_f, np.zeros((100, 100)), vid_f.fingerprint)
+        store.add(vid_g, np.zeros(80000, np.uint8), vid_g.fingerprint)
+        assert store.get_cached_value(vid_f).path != store.get_cached_value(vid_g).path
+        store.close()
+
+        store = PersistedStore.from_file(temp_storage_dir)
+        g = store.load_value(vid_g)
+        assert g.shape == (80000,) and g.dtype == np.uint8
+        store.close()
+
+
+def test_numpy_deduplication_ignores_sampled_fingerprints(monkeypatch):
+    monkeypatch.setattr(mamo.support.numpy, "SAMPLED_FINGERPRINT_MIN_SIZE", 1024)
+    a = np.arange(10 ** 6, dtype=float)
+    b = a.copy()
+    # Not covered by the sample.
+    b[10000] += 1
+    assert (mamo.support.numpy.NumpyObjectSaver(a).compute_digest() ==
+            mamo.support.numpy.NumpyObjectSaver(b).compute_digest())
+
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+        vid_a = value_name_identity("a")
+        vid_b = value_name_identity("b")
+        store.add(vid_a, a, vid_a.fingerprint)
+        store.add(vid_b, b, vid_b.fingerprint)
+        assert store.get_cached_value(vid_a).path != store.get_cached_value(vid_b).path
+        assert np.array_equal(store.load_value(vid_b), b)
+        store.close()
@@ -0,0 +1,39 @@
+from mamo.internal.online_cache import OnlineCache
+from tests.collection_testing.test_mutable_set import MutableSetTests
+
+
+def create_online_cache():
+    return OnlineCache(len, lambda value: 0, lambda value: True)
+
+
+class TestOnlineCache(MutableSetTests):
+    mutable_set = create_online_cache
+
+    @staticmethod
+    def get_element(i):
+        return [i]
+
+
+def test_online_cache_evicts_lru():
+    cache = create_online_cache()
+    cache.set_memory_budget(10)
+
+    values = [[i] * 4 for i in range(3)]
+    cache.add(values[0])
+    cache.add(values[1])
+    cache.touch(values[0])
+    cache.add(values[2])
+
+    assert set(map(id, cache)) == {id(values[0]), id(values[2])}
+    assert cache.total_size == 8
+
+
+def test_online_cache_evicts_by_score_and_keeps_pinned():
+    values = [[i] * 4 for i in range(4)]
+    cache = OnlineCache(len, lambda value: -value[0], lambda value: value is not values[3])
+
+    for value in values:
+        cache.add(value)
+    cache.set_memory_budget(10, "cost_benefit")
+
+    assert set(map(id, cache)) == {id(values[0]), id(values[3])}
@@ -1,9 +1,21 @@
+import os
+import pickle
+import threading
+import weakref
 from os import mkdir, listdir, path
 
+import numpy as np
 import pytest
-
-from mamo.internal.identities import value_name_identity
+from persistent.mapping import PersistentMapping
+from ZODB.POSException import ReadOnlyError
+
+from mamo.internal import default_module_extension
+from mamo.internal.common.digest_mapping import PersistentDigestMapping
+from mamo.internal.module_extension import MODULE_EXTENSIONS
+from mamo.internal.cached_values import choose_codec, ADAPTIVE_CODECS
+from mamo.internal.identities import value_name_identity, ValueCallIdentity, FunctionIdentity
 from mamo.internal.persisted_store import PersistedStore
+from mamo.internal.persistence_policy import persist_if_worth_it, PERSIST, MEMORY_ONLY
 from mamo.internal.common.weakref_utils import ObjectProxy
 
 from tests.testing import BoxedValue
@@ -68,15 +80,43 @@ def test_persisted_store_get_metadata_works():
 
     assert store.load_value(vid) == value
 
+    result_metadata = store.get_result_metadata(vid)
     assert result_metadata.num_loads == 1
     first_load_duration = result_metadata.total_load_durations
     assert first_load_duration > 0.0
 
     assert store.load_value(vid) == value
+    result_metadata = store.get_result_metadata(vid)
     assert result_metadata.num_loads == 2
     assert result_metadata.total_load_durations > first_load_duration
 
 
+def test_persisted_store_batches_metadata_updates():
+    store = PersistedStore.from_memory()
+
+    vid = value_name_identity("test")
+    value = BoxedValue(1)
+
+    store.add(vid, value, vid.fingerprint)
+    last_transaction = store.db.lastTransaction()
+
+    # Loads and cache hits do not commit transactions.
+    assert store.load_value(vid) == value
+    store.record_cache_hit(vid, 1.0)
+    assert store.db.lastTransaction() == last_transaction
+    assert store.storage.vid_to_result_metadata[vid].num_loads == 0
+
+    result_metadata = store.get_result_metadata(vid)
+    assert result_metadata.num_loads == 1
+    assert result_metadata.num_cache_hits == 1
+    assert result_metadata.total_durations == 1.0
+
+    store.flush_metadata()
+    assert store.db.lastTransaction() != last_transaction
+    assert store.storage.vid_to_result_metadata[vid] == result_metadata
+    assert not store.pending_metadata_updates
+
+
 @pytest.mark.parametrize("size", [10, 1000])
 def test_persisted_store_persists(size):
     with tempfile.TemporaryDirectory() as temp_storage_dir:
@@ -166,3 +206,445 @@ def test_persisted_store_unwraps_objproxies():
         )
 
         store.close()
+
+
+def test_persisted_store_migrates_persistent_mappings():
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+
+        vid = value_name_identity("test")
+        value = BoxedValue(1)
+        store.add(vid, value, vid.fingerprint)
+
+        # Downgrade to the old layout.
+        storage = store.storage
+        with store.transaction_manager:
+            storage.vid_to_cached_value = PersistentMapping(storage.vid_to_cached_value.items())
+            storage.vid_to_fingerprint = PersistentMapping(storage.vid_to_fingerprint.items())
+            storage.vid_to_result_metadata = PersistentMapping(storage.vid_to_result_metadata.items())
+        assert storage.needs_migration()
+        store.close()
+
+        store = PersistedStore.from_file(temp_storage_dir)
+        assert not store.storage.needs_migration()
+        assert isinstance(store.storage.vid_to_cached_value, PersistentDigestMapping)
+        assert store.get_vids() == {vid}
+        assert store.load_value(vid) == value
+        assert store.get_fingerprint(vid) == vid.fingerprint
+        assert store.get_result_metadata(vid).num_loads == 1
+        store.close()
+
+
+@pytest.mark.parametrize("num_entries", [100, 10000])
+def test_benchmark_persisted_store_add(benchmark, num_entries):
+    store = PersistedStore.from_memory()
+
+    storage = store.storage
+    with store.transaction_manager:
+        for i in range(num_entries):
+            vid = value_name_identity(f"value_{i}")
+            cached_value = store.try_create_cached_value(vid, i).cached_value
+            storage.vid_to_cached_value[vid] = cached_value
+            storage.vid_to_fingerprint[vid] = vid.fingerprint
+
+    vid = value_name_identity("test")
+    value = BoxedValue(1)
+
+    # The commit cost should not grow with the number of entries.
+    benchmark(store.add, vid, value, vid.fingerprint)
+    store.close()
+
+
+class BlockingValue:
+    """Pickling blocks until `event` is set."""
+
+    def __init__(self, event: threading.Event, value):
+        self.event = event
+        self.value = value
+
+    def __reduce__(self):
+        assert self.event.wait(10)
+        return BoxedValue, (self.value,)
+
+
+def test_persisted_store_write_behind():
+    store = PersistedStore.from_memory(max_pending_writes=4)
+
+    vid = value_name_identity("test")
+    event = threading.Event()
+    value = BlockingValue(event, 1)
+
+    store.add(vid, value, vid.fingerprint)
+    store.record_call(vid, 1.0, 0.5, 1.0, 1.5)
+
+    # The result is visible while it is being written.
+    assert store.has_vid(vid)
+    assert store.get_vids() == {vid}
+    assert store.get_fingerprint(vid) == vid.fingerprint
+    assert store.load_value(vid) is value
+    assert store.get_cached_value(vid) is None
+
+    event.set()
+    store.flush_writes()
+
+    assert not store.pending_writes
+    assert store.load_value(vid) == BoxedValue(1)
+    assert store.get_result_metadata(vid).call_duration == 1.0
+    store.close()
+
+
+def test_persisted_store_write_behind_remove_pending():
+    store = PersistedStore.from_memory(max_pending_writes=4)
+
+    vid = value_name_identity("test")
+    event = threading.Event()
+
+    store.add(vid, BlockingValue(event, 1), vid.fingerprint)
+    store.remove_vid(vid)
+    assert not store.has_vid(vid)
+
+    event.set()
+    store.flush_writes()
+
+    assert not store.has_vid(vid)
+    assert store.get_vids() == set()
+    store.close()
+
+
+def test_persisted_store_write_behind_back_pressure():
+    store = PersistedStore.from_memory(max_pending_writes=1)
+
+    event = threading.Event()
+    vid_a = value_name_identity("a")
+    vid_b = value_name_identity("b")
+
+    store.add(vid_a, BlockingValue(event, 1), vid_a.fingerprint)
+    adder = threading.Thread(target=store.add, args=(vid_b, BoxedValue(2), vid_b.fingerprint))
+    adder.start()
+
+    # The second add waits for the first write.
+    adder.join(0.1)
+    assert adder.is_alive()
+
+    event.set()
+    adder.join(10)
+    assert not adder.is_alive()
+
+    store.flush_writes()
+    assert store.load_value(vid_a) == BoxedValue(1)
+    assert store.load_value(vid_b) == BoxedValue(2)
+    store.close()
+
+
+def test_persisted_store_reuses_object_savers(monkeypatch):
+    dumps_calls = []
+    dump = default_module_extension.pickle.dump
+    monkeypatch.setattr(default_module_extension.pickle, "dump",
+                        lambda obj, file: dumps_calls.append(obj) or dump(obj, file))
+
+    value = BoxedValue(1)
+    fingerprint = MODULE_EXTENSIONS.get_object_saver(value).compute_fingerprint()
+    assert len(dumps_calls) == 1
+
+    store = PersistedStore.from_memory()
+    vid = value_name_identity("test")
+    store.add(vid, value, fingerprint)
+    assert len(dumps_calls) == 1
+    assert store.load_value(vid) == value
+    store.close()
+
+    # Cached ObjectSavers don't keep their values alive.
+    value_ref = weakref.ref(value)
+    del value
+    dumps_calls.clear()
+    assert value_ref() is None
+
+
+def test_persisted_store_streams_large_pickles(monkeypatch):
+    monkeypatch.setattr(default_module_extension, "MAX_IN_MEMORY_PICKLE_SIZE", 1024)
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        external_path = path.join(temp_storage_dir, "ext")
+        mkdir(external_path)
+
+        store = PersistedStore.from_file(temp_storage_dir, external_path)
+
+        vid = value_name_identity("test")
+        value = list(range(100000))
+
+        object_saver = MODULE_EXTENSIONS.get_object_saver(value)
+        assert object_saver.pickled_bytes is None
+        assert object_saver.get_estimated_size() == len(pickle.dumps(value))
+
+        store.add(vid, value, vid.fingerprint)
+        assert store.load_value(vid) == value
+
+        store.close()
+
+
+def test_persisted_store_memory_maps_out_of_band_buffers():
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        external_path = path.join(temp_storage_dir, "ext")
+        mkdir(external_path)
+
+        store = PersistedStore.from_file(temp_storage_dir, external_path)
+
+        vid = value_name_identity("test")
+        value = dict(array=np.arange(2 ** 18), nested=[np.ones(2 ** 18)], small=np.zeros(4))
+        store.add(vid, value, vid.fingerprint)
+        assert isinstance(store.get_cached_value(vid), default_module_extension.OutOfBandExternallyCachedValue)
+
+        loaded_value = store.load_value(vid)
+        assert np.array_equal(loaded_value["array"], value["array"])
+        assert np.array_equal(loaded_value["nested"][0], value["nested"][0])
+        assert np.array_equal(loaded_value["small"], value["small"])
+        # Zero-copy views of the memory-mapped file.
+        assert not loaded_value["array"].flags.writeable
+        assert not loaded_value["array"].flags.owndata
+
+        store.close()
+
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma", "bz2"])
+@pytest.mark.parametrize("make_value", [lambda: list(range(100000)), lambda: [0] * 10 ** 6, lambda: np.zeros(10 ** 5)])
+def test_persisted_store_compresses_external_values(compression, make_value):
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        external_path = path.join(temp_storage_dir, "ext")
+        mkdir(external_path)
+
+        store = PersistedStore.from_file(temp_storage_dir, external_path)
+        store.set_compression(compression)
+
+        vid = value_name_identity("test")
+        value = make_value()
+        store.add(vid, value, vid.fingerprint)
+
+        cached_value = store.get_cached_value(vid)
+        assert cached_value.codec_id == compression
+        assert np.array_equal(store.load_value(vid), value)
+
+        result_metadata = store.get_result_metadata(vid)
+        assert result_metadata.stored_size == cached_value.get_stored_size() < result_metadata.raw_stored_size
+
+        store.close()
+
+
+def test_adaptive_compression_skips_incompressible_values():
+    assert choose_codec("adaptive", lambda: np.random.bytes(2 ** 16)) is None
+    assert choose_codec("adaptive", lambda: bytes(2 ** 16)) in ADAPTIVE_CODECS
+    assert choose_codec(None, lambda: bytes(2 ** 16)) is None
+    with pytest.raises(ValueError):
+        choose_codec("snappy", lambda: bytes(2 ** 16))
+
+
+def test_persisted_store_compression_per_function():
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+        store.set_compression("lzma", "tests.f")
+
+        call_vid = ValueCallIdentity(FunctionIdentity("tests.f"), (), frozenset())
+        other_call_vid = ValueCallIdentity(FunctionIdentity("tests.g"), (), frozenset())
+        assert store.get_compression(call_vid) == "lzma"
+        assert store.get_compression(other_call_vid) is None
+        assert store.get_compression(value_name_identity("test")) is None
+
+        store.close()
+
+
+def test_persisted_store_deduplicates_external_values():
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        external_path = path.join(temp_storage_dir, "ext")
+        mkdir(external_path)
+
+        store = PersistedStore.from_file(temp_storage_dir, external_path)
+
+        vid_a = value_name_identity("a")
+        vid_b = value_name_identity("b")
+        store.add(vid_a, list(range(100000)), vid_a.fingerprint)
+        store.add(vid_b, list(range(100000)), vid_b.fingerprint)
+        assert store.get_cached_value(vid_a).path == store.get_cached_value(vid_b).path
+        assert len(listdir(external_path)) == 1
+
+        # Different content gets a new file.
+        vid_d = value_name_identity("d")
+        store.add(vid_d, list(range(100001)), vid_d.fingerprint)
+        assert store.get_cached_value(vid_d).path != store.get_cached_value(vid_a).path
+        assert store.load_value(vid_a) == list(range(100000))
+        store.remove_vid(vid_d)
+
+        # Re-adding identical content keeps the file.
+        store.add(vid_a, list(range(100000)), vid_a.fingerprint)
+        assert len([file_name for file_name in listdir(external_path) if not file_name.endswith(".unlinked")]) == 1
+
+        store.remove_vid(vid_a)
+        assert store.load_value(vid_b) == list(range(100000))
+
+        store.remove_vid(vid_b)
+        assert all(file_name.endswith(".unlinked") for file_name in listdir(external_path))
+
+        # Identical tuple items are stored once, too.
+        vid_c = value_name_identity("c")
+        store.add(vid_c, (list(range(100000)), list(range(100000))), vid_c.fingerprint)
+        assert store.load_value(vid_c) == (list(range(100000)), list(range(100000)))
+        assert len([file_name for file_name in listdir(external_path) if not file_name.endswith(".unlinked")]) == 1
+
+        store.close()
+
+
+def test_persisted_store_gc(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+
+        vid_a = value_name_identity("a")
+        vid_b = value_name_identity("b")
+        for i in range(10):
+            store.add(vid_a, list(range(100000 + i)), vid_a.fingerprint)
+        store.add(vid_b, list(range(50000)), vid_b.fingerprint)
+        store.remove_vid(vid_b)
+
+        old_orphan_path = path.join(temp_storage_dir, "crashed_builtins.list_0000001000.pickle")
+        new_orphan_path = path.join(temp_storage_dir, "writing_builtins.list_0000001001.pickle")
+        for orphan_path in (old_orphan_path, new_orphan_path):
+            with open(orphan_path, "wb") as orphan_file:
+                orphan_file.write(bytes(1000))
+        os.utime(old_orphan_path, (0, 0))
+
+        report = store.gc()
+        assert report.num_unlinked_files == 10
+        assert report.num_orphaned_files == 1
+        assert report.reclaimed_file_bytes > 1000
+        assert report.reclaimed_db_bytes > 0
+
+        file_names = set(listdir(temp_storage_dir))
+        assert "mamo_store" in file_names
+        assert path.basename(new_orphan_path) in file_names
+        assert path.basename(old_orphan_path) not in file_names
+        assert store.load_value(vid_a) == list(range(100009))
+
+        # Background collection.
+        report = store.start_gc(min_orphan_age=0).result()
+        assert report.num_orphaned_files == 1
+        assert store.load_value(vid_a) == list(range(100009))
+
+        store.close()
+
+
+def test_persisted_store_gc_recounts_blob_references(tmp_path):
+    store = PersistedStore.from_file(str(tmp_path))
+    vid = value_name_identity("a")
+    store.add(vid, list(range(100000)), vid.fingerprint)
+    digest, = store.storage.vid_to_blob_digests[vid]
+
+    # A write that never finishes (e.g. because the process crashes) leaves its pending reference behind.
+    store.acquire_blob(digest)
+    store.pending_blob_refs.clear()
+    assert store.storage.blobs[digest][1] == 2
+
+    store.gc(pack=False)
+    assert store.storage.blobs[digest][1] == 1
+    assert store.load_value(vid) == list(range(100000))
+
+    store.remove_vid(vid)
+    assert digest not in store.storage.blobs
+    store.close()
+
+
+@pytest.mark.parametrize("eviction_policy", ["cost_benefit", "lru", "lfu"])
+def test_persisted_store_evicts_within_disk_budget(eviction_policy):
+    with tempfile.TemporaryDirectory() as temp_storage_dir:
+        store = PersistedStore.from_file(temp_storage_dir)
+
+        vids = [value_name_identity(f"v{i}") for i in range(4)]
+        for i, vid in enumerate(vids[:3]):
+            store.add(vid, np.full(100000, i, dtype=np.uint8), vid.fingerprint)
+        stored_size = store.get_result_metadata(vids[0]).stored_size
+
+        # vids[0] is tagged, vids[1] is expensive, often used and recently used, so vids[2] has to go first.
+        store.tag("pinned", vids[0])
+        store.record_call(vids[1], 10.0, 0.0, 10.0, 10.0)
+        store.record_call(vids[2], 0.1, 0.0, 0.1, 0.1)
+        store.record_cache_hit(vids[1], 0.0)
+        store.record_load(vids[1], 0.0)
+
+        store.set_disk_budget(int(stored_size * 3.5), eviction_policy)
+        store.add(vids[3], np.full(100000, 3, dtype=np.uint8), vids[3].fingerprint)
+
+        assert set(store.get_vids()) == {vids[0], vids[1], vids[3]}
+        assert sum(store.get_result_metadata(vid).stored_size for vid in store.get_vids()) <= stored_size * 3.5
+
+        # Only the tagged value is left when we shrink the budget.
+        store.set_disk_budget(int(stored_size * 1.5), eviction_policy)
+        store.add(vids[3], np.full(100000, 4, dtype=np.uint8), vids[3].fingerprint)
+        assert set(store.get_vids()) == {vids[0], vids[3]}
+
+        with pytest.raises(ValueError):
+            store.set_disk_budget(0, "unknown")
+
+        store.close()
+
+
+def test_persisted_store_persistence_policy():
+    store = PersistedStore.from_memory()
+    store.set_persistence_policy(persist_if_worth_it())
+
+    cheap_vid = value_name_identity("cheap")
+    expensive_vid = value_name_identity("expensive")
+    store.add(cheap_vid, BoxedValue(1), cheap_vid.fingerprint, 1e-6)
+    store.add(expensive_vid, BoxedValue(2), expensive_vid.fingerprint, 10.)
+
+    assert not store.has_vid(cheap_vid)
+    cheap_metadata = store.get_result_metadata(cheap_vid)
+    assert cheap_metadata.persistence == MEMORY_ONLY
+    assert "too fast" in cheap_metadata.persistence_reason
+
+    assert store.load_value(expensive_vid) == BoxedValue(2)
+    assert store.get_result_metadata(expensive_vid).persistence == PERSIST
+
+    # A cheap recomputation replaces the persisted result.
+    store.add(expensive_vid, BoxedValue(3), expensive_vid.fingerprint, 1e-6)
+    assert not store.has_vid(expensive_vid)
+    assert store.get_result_metadata(expensive_vid).persistence == MEMORY_ONLY
+
+    store.remove_vid(cheap_vid)
+    assert store.get_result_metadata(cheap_vid) is None
+
+
+def test_persisted_store_read_only(tmp_path):
+    path = str(tmp_path)
+    with pytest.raises(ValueError):
+        PersistedStore.from_file(path, read_only=True)
+
+    writer = PersistedStore.from_file(path)
+    first_vid = value_name_identity("first")
+    second_vid = value_name_identity("second")
+    writer.add(first_vid, BoxedValue(list(range(1000))), first_vid.fingerprint)
+
+    # Readers don't lock the store, so they can open it while the writer has it open.
+    readers = [PersistedStore.from_file(path, read_only=True) for _ in range(2)]
+    for reader in readers:
+        assert reader.load_value(first_vid) == BoxedValue(list(range(1000)))
+        assert not reader.has_vid(second_vid)
+
+    writer.add(second_vid, BoxedValue(2), second_vid.fingerprint)
+    writer.record_load(first_vid, 1.)
+    writer.flush_metadata()
+    for reader in readers:
+        reader.sync()
+        assert reader.load_value(second_vid) == BoxedValue(2)
+        # The writer's load and the reader's own (unflushed) one.
+        assert reader.get_result_metadata(first_vid).num_loads == 2
+
+    # Readers only keep their results in memory.
+    reader = readers[0]
+    reader.add(second_vid, BoxedValue(3), second_vid.fingerprint)
+    assert reader.get_result_metadata(second_vid).persistence == MEMORY_ONLY
+    reader.remove_vid(first_vid)
+    assert writer.load_value(first_vid) == BoxedValue(list(range(1000)))
+    assert writer.load_value(second_vid) == BoxedValue(2)
+    with pytest.raises(ReadOnlyError):
+        reader.tag("tag", first_vid)
+    with pytest.raises(ReadOnlyError):
+        reader.gc()
+
+    for reader in readers:
+        reader.close()
+    writer.close()
@@ -0,0 +1,33 @@
+import pytest
+
+from mamo.internal.persistence_policy import (
+    DurationModel,
+    PersistenceEstimate,
+    persist_if_worth_it,
+    PERSIST,
+    MEMORY_ONLY,
+    DONT_CACHE,
+)
+
+
+def test_persist_if_worth_it():
+    policy = persist_if_worth_it(max_memory_only_size=1000)
+
+    assert policy(PersistenceEstimate(1., 100, 0.1, 0.1)).action == PERSIST
+    assert policy(PersistenceEstimate(0.18, 100, 0.1, 0.1)).action == MEMORY_ONLY
+    assert policy(PersistenceEstimate(0.05, 100, 0.1, 0.1)).action == MEMORY_ONLY
+    assert policy(PersistenceEstimate(0.05, 10000, 0.1, 0.1)).action == DONT_CACHE
+    assert policy(PersistenceEstimate(0.05, None, None, None)).action == PERSIST
+
+    # Saving pays off over more reuses.
+    assert persist_if_worth_it(expected_reuses=2)(PersistenceEstimate(0.18, 100, 0.1, 0.1)).action == PERSIST
+
+
+def test_duration_model():
+    model = DurationModel(default_overhead=1., default_throughput=10.)
+    assert model.predict(10) == pytest.approx(2.)
+
+    model.observe(100, 0.2)
+    model.observe(300, 0.4)
+    assert model.predict(200) == pytest.approx(0.3)
+    assert model.predict(0) == pytest.approx(0.1)
@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+from mamo.internal.common.single_flight import SingleFlight
+
+
+def test_single_flight_serializes_by_key():
+    single_flight = SingleFlight()
+    inside = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def leader():
+        with single_flight.flight("key"):
+            inside.append("leader")
+            entered.set()
+            release.wait()
+
+    def follower():
+        with single_flight.flight("key"):
+            inside.append("follower")
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    entered.wait()
+
+    follower_thread = threading.Thread(target=follower)
+    follower_thread.start()
+    # Other keys don't wait.
+    with single_flight.flight("other key"):
+        pass
+
+    follower_thread.join(0.05)
+    assert inside == ["leader"]
+
+    release.set()
+    leader_thread.join()
+    follower_thread.join()
+    assert inside == ["leader", "follower"]
+    assert len(single_flight) == 0
+
+
+def test_single_flight_is_reentrant_and_cleans_up_on_errors():
+    single_flight = SingleFlight()
+
+    with pytest.raises(ValueError):
+        with single_flight.flight("key"):
+            with single_flight.flight("key"):
+                assert len(single_flight) == 1
+                raise ValueError()
+
+    assert len(single_flight) == 0
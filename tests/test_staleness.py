@@ -0,0 +1,144 @@
+import pytest
+
+import mamo
+from mamo.internal import main
+
+from tests.testing import BoxedValue
+
+# noinspection PyUnresolvedReferences
+from tests.testing import mamo_fixture
+
+
+def unwrapped_step(a):
+    return BoxedValue(a.value + 1)
+
+
+def unwrapped_combine(*args):
+    return BoxedValue(sum(arg.value for arg in args))
+
+
+@pytest.fixture
+def counted_fingerprints(mamo_fixture, monkeypatch):
+    fingerprint_registry = mamo_fixture.fingerprint_registry
+    fingerprint_computed_value = fingerprint_registry.fingerprint_computed_value
+    counter = dict(num_calls=0)
+
+    def counting_fingerprint_computed_value(vid):
+        counter["num_calls"] += 1
+        return fingerprint_computed_value(vid)
+
+    monkeypatch.setattr(fingerprint_registry, "fingerprint_computed_value", counting_fingerprint_computed_value)
+    return counter
+
+
+def create_chain(length):
+    step = mamo.mamo(unwrapped_step)
+    value = step(BoxedValue(0))
+    for _ in range(length - 1):
+        value = step(value)
+    return value
+
+
+def create_lattice(depth, width=2):
+    combine = mamo.mamo(unwrapped_combine)
+    layer = [combine(BoxedValue(i)) for i in range(width)]
+    for _ in range(depth - 1):
+        layer = [combine(*layer[i:], *layer[:i]) for i in range(width)]
+    return combine(*layer)
+
+
+def create_fan_out(width):
+    step = mamo.mamo(unwrapped_step)
+    combine = mamo.mamo(unwrapped_combine)
+    dataset = step(BoxedValue(0))
+    return combine(*[combine(dataset, BoxedValue(i)) for i in range(width)])
+
+
+def test_is_stale_evaluates_shared_vids_once(counted_fingerprints):
+    depth, width = 8, 2
+    result = create_lattice(depth, width)
+
+    counted_fingerprints["num_calls"] = 0
+    assert not main.mamo.is_stale(result)
+    assert counted_fingerprints["num_calls"] == depth * width + 1
+
+
+def test_is_stale_is_evaluated_per_check(counted_fingerprints):
+    depth, width = 4, 2
+    result = create_lattice(depth, width)
+
+    for _ in range(2):
+        counted_fingerprints["num_calls"] = 0
+        assert not main.mamo.is_stale(result)
+        assert counted_fingerprints["num_calls"] == depth * width + 1
+
+
+def test_is_stale_after_forgetting_an_ancestor(counted_fingerprints):
+    first = create_chain(1)
+    step = mamo.mamo(unwrapped_step)
+    chain = step(step(step(first)))
+
+    assert not main.mamo.is_stale(chain)
+
+    epoch = main.mamo.value_provider_mediator.epoch
+    mamo.forget(first)
+    assert main.mamo.value_provider_mediator.epoch != epoch
+
+    counted_fingerprints["num_calls"] = 0
+    assert main.mamo.is_stale(chain)
+    assert counted_fingerprints["num_calls"] > 0
+
+
+def test_is_stale_after_rebinding_cell_global(mamo_fixture):
+    class Dummy:
+        pass
+
+    user_ns_obj = Dummy()
+    user_ns = user_ns_obj.__dict__
+    user_ns_obj.x = BoxedValue(1)
+    user_ns_obj.step = unwrapped_step
+
+    main.mamo.run_cell("cell_a", "global y; y = step(x)", user_ns)
+    main.mamo.run_cell("cell_b", "global z; z = step(y)", user_ns)
+
+    assert not main.mamo.is_stale(user_ns_obj.z)
+
+    user_ns_obj.x = BoxedValue(5)
+    assert main.mamo.is_stale(user_ns_obj.y)
+    assert main.mamo.is_stale(user_ns_obj.z)
+
+
+@pytest.mark.parametrize("length", [10, 100])
+def test_benchmark_is_stale_deep_chain(mamo_fixture, benchmark, length):
+    result = create_chain(length)
+
+    # Uncached check.
+    def is_stale():
+        main.mamo.fingerprint_registry.invalidate_deep_fingerprints()
+        return main.mamo.is_stale(result)
+
+    assert not benchmark(is_stale)
+
+
+@pytest.mark.parametrize("depth", [4, 16])
+def test_benchmark_is_stale_wide_lattice(mamo_fixture, benchmark, depth):
+    result = create_lattice(depth, width=4)
+
+    # Uncached check.
+    def is_stale():
+        main.mamo.fingerprint_registry.invalidate_deep_fingerprints()
+        return main.mamo.is_stale(result)
+
+    assert not benchmark(is_stale)
+
+
+@pytest.mark.parametrize("width", [10, 200])
+def test_benchmark_is_stale_fan_out(mamo_fixture, benchmark, width):
+    result = create_fan_out(width)
+
+    # Uncached check.
+    def is_stale():
+        main.mamo.fingerprint_registry.invalidate_deep_fingerprints()
+        return main.mamo.is_stale(result)
+
+    assert not benchmark(is_stale)
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+from mamo.internal.identities import value_name_identity
+from mamo.internal.fingerprints import FingerprintName
+from mamo.internal.persisted_store import PersistedStore, EXTERNAL_ID_BLOCK_SIZE
+from mamo.internal.store_server import start_store_server
+
+from tests.testing import BoxedValue
+
+pytest.importorskip("ZEO")
+
+VID = value_name_identity("shared")
+
+
+@pytest.fixture
+def store_server(tmp_path, monkeypatch):
+    # ZEO writes its configuration into the working directory.
+    monkeypatch.chdir(tmp_path)
+    address, stop = start_store_server(str(tmp_path / "store"))
+    yield address, str(tmp_path / "external")
+    stop()
+
+
+def test_store_server_clients_see_each_others_results(store_server):
+    address, externally_cached_path = store_server
+    assert os.path.exists(address)
+
+    writer = PersistedStore.from_server(address, externally_cached_path)
+    reader = PersistedStore.from_server(address, externally_cached_path)
+    try:
+        assert reader.get_fingerprint(VID) is None
+
+        value = BoxedValue(list(range(1000)))
+        fingerprint = FingerprintName("shared")
+        writer.add(VID, value, fingerprint)
+
+        # Misses process the invalidations from the server.
+        assert reader.get_fingerprint(VID) == fingerprint
+        assert reader.has_vid(VID)
+        assert reader.load_value(VID) == value
+
+        writer.remove_vid(VID)
+        reader.sync()
+        assert not reader.has_vid(VID)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_store_server_clients_merge_metadata_updates(store_server):
+    address, externally_cached_path = store_server
+
+    stores = [PersistedStore.from_server(address, externally_cached_path) for _ in range(2)]
+    try:
+        stores[0].add(VID, BoxedValue(1), FingerprintName("shared"))
+        for store in stores:
+            store.sync()
+            store.record_load(VID, 0.1)
+        for store in stores:
+            store.flush_metadata()
+
+        stores[0].sync()
+        assert stores[0].get_result_metadata(VID).num_loads == 2
+    finally:
+        for store in stores:
+            store.close()
+
+
+def test_store_server_clients_reserve_external_ids(store_server):
+    address, externally_cached_path = store_server
+
+    stores = [PersistedStore.from_server(address, externally_cached_path) for _ in range(2)]
+    try:
+        external_ids = [store.get_new_external_id() for store in stores for _ in range(EXTERNAL_ID_BLOCK_SIZE + 1)]
+        assert len(set(external_ids)) == len(external_ids)
+    finally:
+        for store in stores:
+            store.close()
+
+
+def test_store_server_read_only_clients(store_server):
+    address, externally_cached_path = store_server
+
+    writer = PersistedStore.from_server(address, externally_cached_path)
+    reader = PersistedStore.from_server(address, externally_cached_path, read_only=True)
+    try:
+        writer.add(VID, BoxedValue(1), FingerprintName("shared"))
+        assert reader.get_fingerprint(VID) == FingerprintName("shared")
+        assert reader.load_value(VID) == BoxedValue(1)
+
+        reader.add(VID, BoxedValue(2), FingerprintName("shared"))
+        assert writer.load_value(VID) == BoxedValue(1)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_store_server_clients_share_blobs(store_server):
+    address, externally_cached_path = store_server
+
+    a = PersistedStore.from_server(address, externally_cached_path)
+    b = PersistedStore.from_server(address, externally_cached_path)
+    try:
+        vid_x = value_name_identity("x")
+        vid_y = value_name_identity("y")
+        value = list(range(100000))
+        assert not b.get_vids()
+        # Reserves external ids, so b's add doesn't need a transaction to get one.
+        b.get_new_external_id()
+
+        # b hasn't synced since, but must not overwrite a's blob.
+        a.add(vid_x, value, vid_x.fingerprint)
+        b.add(vid_y, value, vid_y.fingerprint)
+        assert b.get_cached_value(vid_y).path == a.get_cached_value(vid_x).path
+
+        b.remove_vid(vid_y)
+        a.sync()
+        assert a.load_value(vid_x) == value
+        a.remove_vid(vid_x)
+    finally:
+        a.close()
+        b.close()
+
+
+def test_store_server_gc_keeps_other_clients_results(store_server):
+    address, externally_cached_path = store_server
+
+    a = PersistedStore.from_server(address, externally_cached_path)
+    b = PersistedStore.from_server(address, externally_cached_path)
+    try:
+        assert not b.get_vids()
+
+        value = list(range(100000))
+        a.add(VID, value, VID.fingerprint)
+        report = b.gc(pack=False, min_orphan_age=0)
+        assert report.num_orphaned_files == 0
+        assert a.load_value(VID) == value
+    finally:
+        a.close()
+        b.close()
+
@@ -9,6 +9,7 @@ from mamo.internal.db_stored_value import DBPickledValue
 from mamo.internal.fingerprints import Fingerprint
 from mamo.internal.identities import ValueIdentity
 from mamo.internal.persisted_store import CacheOperationResult
+from mamo.internal.persistence_policy import NO_POLICY
 from mamo.internal.result_metadata import ResultMetadata
 
 
@@ -37,11 +38,12 @@ class DummyPersistedStore(persisted_store.PersistedStore):
     def try_create_cached_value(self, vid, value):
         return CacheOperationResult(DBPickledValue.cache_value(value), 0, 0, 0)
 
-    def add(self, vid, value: object, fingerprint):
+    def add(self, vid, value: object, fingerprint, call_duration=None):
         result = self.try_create_cached_value(vid, value)
         self.vid_to_cached_value[vid] = result.cached_value
         self.vid_to_fingerprint[vid] = fingerprint
         self.vid_to_metadata[vid] = ResultMetadata(0, 0, 0.)
+        return NO_POLICY
 
     def remove_vid(self, vid):
         if vid in self.vid_to_cached_value:
@@ -65,6 +67,21 @@ class DummyPersistedStore(persisted_store.PersistedStore):
     def get_result_metadata(self, vid: ValueIdentity) -> ResultMetadata:
         return self.vid_to_metadata.get(vid)
 
+    def record_load(self, vid, load_duration):
+        pass
+
+    def record_cache_hit(self, vid, total_duration):
+        pass
+
+    def record_call(self, vid, call_duration, subcall_duration, estimated_nomamo_call_duration, total_duration):
+        pass
+
+    def flush_metadata(self):
+        pass
+
+    def flush_writes(self):
+        pass
+
     def tag(self, tag_name: str, vid: ValueIdentity):
         self.tag_to_vid[tag_name] = vid
 